@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 import os
 import json
-import glob
 import sys
+import threading
 
 # Base directories
 CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
 ACTIONS_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "actions")
 TASKS_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "tasks")
+TONES_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "tone")
+FAQ_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "faq")
+REGISTRY_PATH = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "registry.json")
 
 # Default schemas
 DEFAULT_ACTION_SCHEMA = {
@@ -15,7 +18,9 @@ DEFAULT_ACTION_SCHEMA = {
     "requires_second_form": False,
     "prompt_template": "Process the following text in {target_language}: \n\n\"{input_text}\"",
     "temperature": 0.6,
-    "max_tokens": 2000
+    "max_tokens": 2000,
+    "stream": False,
+    "cache": False
 }
 
 DEFAULT_TASK_SCHEMA = {
@@ -25,7 +30,10 @@ DEFAULT_TASK_SCHEMA = {
     "system_message_template": "You are a helpful AI assistant.",
     "description": "No description provided.",
     "temperature": 0.3,
-    "max_tokens": 2000
+    "max_tokens": 2000,
+    "recent_images": 1,
+    "older_images": "downscale",
+    "history_token_budget": 6000
 }
 
 def ensure_directories():
@@ -33,75 +41,192 @@ def ensure_directories():
     os.makedirs(ACTIONS_DIR, exist_ok=True)
     os.makedirs(TASKS_DIR, exist_ok=True)
 
+# --- Config Registry ---
+# One index file holding every action, task, tone and FAQ (parsed, defaults merged,
+# validated). Entries are only re-read when a file's mtime or size changes, so
+# listing and lookups no longer glob + json.load on every call.
+REGISTRY_VERSION = 2
+REGISTRY_SOURCES = {
+    # kind: (directory, extension)
+    "actions": (ACTIONS_DIR, ".json"),
+    "tasks": (TASKS_DIR, ".json"),
+    "tones": (TONES_DIR, ".txt"),
+    "faqs": (FAQ_DIR, ".md"),
+}
+_registry_memo = {"mtime_ns": None, "registry": None}
+
+def _schema_fingerprint():
+    """Changes whenever the default schemas change, so merged entries get rebuilt."""
+    return json.dumps([REGISTRY_VERSION, DEFAULT_ACTION_SCHEMA, DEFAULT_TASK_SCHEMA], sort_keys=True)
+
+def _validate_config(kind, data):
+    """Returns a list of problems with a parsed action/task config."""
+    problems = []
+    template_field = "prompt_template" if kind == "actions" else "system_message_template"
+    if not isinstance(data.get(template_field), str):
+        problems.append(f"'{template_field}' must be a string")
+    if not isinstance(data.get("temperature"), (int, float)):
+        problems.append("'temperature' must be a number")
+    if not isinstance(data.get("max_tokens"), int):
+        problems.append("'max_tokens' must be an integer")
+    policy = data.get("max_tokens_policy")
+    if policy is not None:
+        if not isinstance(policy, dict):
+            problems.append("'max_tokens_policy' must be an object")
+        else:
+            if not isinstance(policy.get("ratio", 1.0), (int, float)) or policy.get("ratio", 1.0) <= 0:
+                problems.append("'max_tokens_policy.ratio' must be a positive number")
+            if not isinstance(policy.get("floor", 1), int) or policy.get("floor", 1) < 1:
+                problems.append("'max_tokens_policy.floor' must be a positive integer")
+    return problems
+
+def _parse_registry_entry(kind, path):
+    """Reads one source file into its registry entry."""
+    entry = {"data": None, "errors": []}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = f.read()
+    except Exception as e:
+        entry["errors"].append(f"Could not read file: {e}")
+        return entry
+
+    if kind in ("actions", "tasks"):
+        defaults = DEFAULT_ACTION_SCHEMA if kind == "actions" else DEFAULT_TASK_SCHEMA
+        try:
+            parsed = json.loads(raw)
+        except ValueError as e:
+            entry["errors"].append(f"Invalid JSON: {e}")
+            return entry
+        if not isinstance(parsed, dict):
+            entry["errors"].append("Top-level JSON value must be an object")
+            return entry
+        # Merge with defaults for any missing fields
+        entry["data"] = {**defaults, **parsed}
+        entry["errors"].extend(_validate_config(kind, entry["data"]))
+    elif kind == "tones":
+        entry["data"] = raw.strip()
+    else:
+        entry["data"] = raw
+    return entry
+
+def _read_registry_file():
+    try:
+        mtime_ns = os.stat(REGISTRY_PATH).st_mtime_ns
+    except OSError:
+        return {}
+    if _registry_memo["mtime_ns"] == mtime_ns:
+        return _registry_memo["registry"]
+    try:
+        with open(REGISTRY_PATH, "r", encoding="utf-8") as f:
+            registry = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if registry.get("schema") != _schema_fingerprint():
+        return {}
+    _registry_memo.update(mtime_ns=mtime_ns, registry=registry)
+    return registry
+
+def _write_registry_file(registry):
+    try:
+        os.makedirs(os.path.dirname(REGISTRY_PATH), exist_ok=True)
+        tmp_path = f"{REGISTRY_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(registry, f, ensure_ascii=False)
+        os.replace(tmp_path, REGISTRY_PATH)
+        _registry_memo.update(mtime_ns=os.stat(REGISTRY_PATH).st_mtime_ns, registry=registry)
+    except OSError as e:
+        print(f"Error writing config registry {REGISTRY_PATH}: {e}", file=sys.stderr)
+
+def load_registry():
+    """Returns the config registry, re-reading only source files whose mtime or size changed."""
+    ensure_directories()
+    registry = _read_registry_file()
+    changed = not registry
+    updated = {"schema": _schema_fingerprint()}
+
+    for kind, (directory, extension) in REGISTRY_SOURCES.items():
+        previous_entries = registry.get(kind, {})
+        entries = {}
+        try:
+            dir_entries = [e for e in os.scandir(directory) if e.is_file() and e.name.endswith(extension)]
+        except OSError:
+            dir_entries = []
+        for dir_entry in dir_entries:
+            name = dir_entry.name[:-len(extension)]
+            st = dir_entry.stat()
+            previous = previous_entries.get(name)
+            if previous and previous.get("mtime_ns") == st.st_mtime_ns and previous.get("size") == st.st_size:
+                entries[name] = previous
+                continue
+            entry = _parse_registry_entry(kind, dir_entry.path)
+            entry.update(file=dir_entry.name, mtime_ns=st.st_mtime_ns, size=st.st_size)
+            entries[name] = entry
+            changed = True
+        if set(entries) != set(previous_entries):
+            changed = True
+        updated[kind] = entries
+
+    if changed:
+        _write_registry_file(updated)
+        return updated
+    return registry
+
+def _get_registry_names(kind):
+    return sorted(load_registry().get(kind, {}))
+
+def _get_registry_entry(kind, name):
+    return load_registry().get(kind, {}).get(name)
+
 def get_actions_list():
     """Get a list of available action names (without .json extension)."""
-    ensure_directories()
-    action_files = glob.glob(os.path.join(ACTIONS_DIR, "*.json"))
-    if not action_files:
-        return ["NoActionsFound"]
-    
-    action_names = []
-    for path in sorted(action_files):
-        base_name = os.path.basename(path)
-        name, _ = os.path.splitext(base_name)
-        action_names.append(name)
-    
-    return action_names
+    action_names = _get_registry_names("actions")
+    return action_names or ["NoActionsFound"]
 
 def get_tasks_list():
     """Get a list of available task names (without .json extension)."""
-    ensure_directories()
-    task_files = glob.glob(os.path.join(TASKS_DIR, "*.json"))
-    if not task_files:
-        return ["NoTasksFound"]
-    
-    task_names = []
-    for path in sorted(task_files):
-        base_name = os.path.basename(path)
-        name, _ = os.path.splitext(base_name)
-        task_names.append(name)
-    
-    return task_names
+    task_names = _get_registry_names("tasks")
+    return task_names or ["NoTasksFound"]
+
+def get_tones_list():
+    """Get a list of available tone names (without .txt extension)."""
+    return _get_registry_names("tones")
+
+def get_faq_list():
+    """Get a list of available FAQ file names (with .md extension)."""
+    return [f"{name}.md" for name in _get_registry_names("faqs")]
+
+def _get_config(kind, name, defaults):
+    entry = _get_registry_entry(kind, name)
+    label = "Action" if kind == "actions" else "Task"
+    if entry is None:
+        print(f"Warning: {label} file not found: {name}", file=sys.stderr)
+        return defaults
+    for problem in entry.get("errors", []):
+        print(f"Error loading {label.lower()} {name}: {problem}", file=sys.stderr)
+    return entry["data"] if entry.get("data") is not None else defaults
 
 def get_action(action_name):
     """Get the configuration for a specific action."""
     if not action_name or action_name == "NoActionsFound":
         return DEFAULT_ACTION_SCHEMA
-    
-    action_path = os.path.join(ACTIONS_DIR, f"{action_name}.json")
-    
-    try:
-        if os.path.exists(action_path):
-            with open(action_path, 'r', encoding='utf-8') as f:
-                action_data = json.load(f)
-                # Merge with defaults for any missing fields
-                return {**DEFAULT_ACTION_SCHEMA, **action_data}
-        else:
-            print(f"Warning: Action file not found: {action_path}", file=sys.stderr)
-            return DEFAULT_ACTION_SCHEMA
-    except Exception as e:
-        print(f"Error loading action {action_name}: {e}", file=sys.stderr)
-        return DEFAULT_ACTION_SCHEMA
+    return _get_config("actions", action_name, DEFAULT_ACTION_SCHEMA)
 
 def get_task(task_name):
     """Get the configuration for a specific task."""
     if not task_name or task_name == "NoTasksFound":
         return DEFAULT_TASK_SCHEMA
-    
-    task_path = os.path.join(TASKS_DIR, f"{task_name}.json")
-    
-    try:
-        if os.path.exists(task_path):
-            with open(task_path, 'r', encoding='utf-8') as f:
-                task_data = json.load(f)
-                # Merge with defaults for any missing fields
-                return {**DEFAULT_TASK_SCHEMA, **task_data}
-        else:
-            print(f"Warning: Task file not found: {task_path}", file=sys.stderr)
-            return DEFAULT_TASK_SCHEMA
-    except Exception as e:
-        print(f"Error loading task {task_name}: {e}", file=sys.stderr)
-        return DEFAULT_TASK_SCHEMA
+    return _get_config("tasks", task_name, DEFAULT_TASK_SCHEMA)
+
+def get_tone(tone_name):
+    """Get the instruction text of a tone, or None if the tone file does not exist."""
+    entry = _get_registry_entry("tones", tone_name)
+    return entry.get("data") if entry else None
+
+def get_faq(faq_filename):
+    """Get the content of an FAQ file (name including .md), or None if it does not exist."""
+    name, _ = os.path.splitext(faq_filename)
+    entry = _get_registry_entry("faqs", name)
+    return entry.get("data") if entry else None
 
 # Simple testing
 if __name__ == "__main__":
@@ -129,6 +254,46 @@ if __name__ == "__main__":
             task_name = sys.argv[2]
             task = get_task(task_name)
             print(json.dumps(task, indent=2))
+
+        elif command == "list_tones":
+            # Print all tone names
+            for tone in get_tones_list():
+                print(tone)
+
+        elif command == "list_faqs":
+            # Print all FAQ file names
+            for faq in get_faq_list():
+                print(faq)
+
+        elif command == "rebuild_registry":
+            # Force a full rebuild of the config registry
+            if os.path.exists(REGISTRY_PATH):
+                os.remove(REGISTRY_PATH)
+            _registry_memo.update(mtime_ns=None, registry=None)
+            registry = load_registry()
+            for kind in REGISTRY_SOURCES:
+                print(f"{kind}: {len(registry.get(kind, {}))}")
+                for name, entry in sorted(registry.get(kind, {}).items()):
+                    for problem in entry.get("errors", []):
+                        print(f"  {name}: {problem}")
+
+        elif command == "cache_stats":
+            # Print response cache counters and size
+            from response_cache import get_stats
+            stats = get_stats()
+            lookups = stats["hits"] + stats["misses"]
+            hit_rate = (stats["hits"] / lookups * 100) if lookups else 0.0
+            print(f"Hits:     {stats['hits']}")
+            print(f"Misses:   {stats['misses']}")
+            print(f"Hit rate: {hit_rate:.1f}%")
+            print(f"Entries:  {stats['entries']}")
+            print(f"Bytes:    {stats['bytes']} / {stats['max_bytes']}")
+
+        elif command == "cache_clear":
+            # Delete all cached responses
+            from response_cache import clear_cache
+            clear_cache()
+            print("Response cache cleared.")
             
         else:
             print("Usage:", file=sys.stderr)
@@ -136,5 +301,10 @@ if __name__ == "__main__":
             print("  action_reader.py list_tasks", file=sys.stderr)
             print("  action_reader.py get_action <action_name>", file=sys.stderr)
             print("  action_reader.py get_task <task_name>", file=sys.stderr)
+            print("  action_reader.py list_tones", file=sys.stderr)
+            print("  action_reader.py list_faqs", file=sys.stderr)
+            print("  action_reader.py rebuild_registry", file=sys.stderr)
+            print("  action_reader.py cache_stats", file=sys.stderr)
+            print("  action_reader.py cache_clear", file=sys.stderr)
     else:
-        print("No command specified. Use 'list_actions', 'list_tasks', 'get_action', or 'get_task'.", file=sys.stderr) 
\ No newline at end of file
+        print("No command specified. Use 'list_actions', 'list_tasks', 'list_tones', 'list_faqs', 'get_action', 'get_task', 'rebuild_registry', 'cache_stats' or 'cache_clear'.", file=sys.stderr) 
\ No newline at end of file
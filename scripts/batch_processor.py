@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Runs the gpt_tools/actions/ pipeline over many texts at once.
+#
+# Reads JSONL records (one per line) from a file or stdin:
+#   {"text": "...", "action": "Translate", "tone": "Formal", "language": "English", "custom_instructions": ""}
+# Only "text" is required; the other fields default to the :rephrase: form defaults.
+# Requests run concurrently on a bounded thread pool with an optional request-rate
+# limit, and results are written as JSONL in input order as soon as they are ready.
+import sys
+import io
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from text_processor import process_text
+from action_reader import load_registry
+
+# Same defaults as the :rephrase: form (match/text_actions.yml)
+DEFAULT_ACTION = "Rephrase"
+DEFAULT_TONE = "Friendly"
+DEFAULT_LANGUAGE = "French"
+
+class RateLimiter:
+    """Spaces out request starts so no more than `rate` start per second (0 disables the limit)."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start_at = max(now, self.next_start)
+            self.next_start = start_at + self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+def read_records(stream):
+    """Yields (index, record) for each non-empty JSONL line; bad lines become error records."""
+    for index, line in enumerate(line for line in stream if line.strip()):
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict) or not isinstance(record.get("text"), str):
+                raise ValueError("each record must be an object with a string 'text' field")
+            yield index, record
+        except ValueError as e:
+            yield index, {"_error": f"Invalid input line: {e}"}
+
+def process_record(index, record, rate_limiter):
+    """Transforms one record and returns its output record."""
+    if "_error" in record:
+        return {"index": index, "output": None, "error": record["_error"]}
+    rate_limiter.wait()
+    started_at = time.time()
+    run_metrics = metrics.start_run("batch", record.get("action", DEFAULT_ACTION))
+    result = process_text(
+        record.get("action", DEFAULT_ACTION),
+        record.get("tone", DEFAULT_TONE),
+        record["text"],
+        record.get("language", DEFAULT_LANGUAGE),
+        record.get("custom_instructions", ""),
+        stream=False,
+    )
+    run_metrics.finish(ok=not result["error"])
+    output = {
+        "index": index,
+        "output": None if result["error"] else result["text"],
+        "error": result["text"] if result["error"] else None,
+        "usage": result["usage"],
+        "cached": result["cached"],
+        "seconds": round(time.time() - started_at, 3),
+    }
+    if "id" in record:
+        output["id"] = record["id"]
+    return output
+
+def run_batch(input_stream, output_stream, workers, rate):
+    """Processes every record and returns summary counters."""
+    rate_limiter = RateLimiter(rate)
+    totals = {"items": 0, "errors": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    started_at = time.time()
+
+    def emit(result):
+        output_stream.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output_stream.flush()
+        totals["items"] += 1
+        totals["errors"] += 1 if result["error"] else 0
+        totals["cached"] += 1 if result.get("cached") else 0
+        usage = result.get("usage") or {}
+        totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        totals["completion_tokens"] += usage.get("completion_tokens", 0)
+        totals["cached_tokens"] += usage.get("cached_tokens", 0)
+
+    # Keep at most 2x workers records in flight so huge inputs are never fully buffered,
+    # and write results strictly in input order.
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, record in read_records(input_stream):
+            pending.append(executor.submit(process_record, index, record, rate_limiter))
+            while pending and (pending[0].done() or len(pending) >= workers * 2):
+                emit(pending.popleft().result())
+        while pending:
+            emit(pending.popleft().result())
+
+    totals["seconds"] = time.time() - started_at
+    return totals
+
+def print_throughput(totals):
+    seconds = max(totals["seconds"], 1e-9)
+    total_tokens = totals["prompt_tokens"] + totals["completion_tokens"]
+    print(f"Processed {totals['items']} items in {seconds:.2f}s "
+          f"({totals['errors']} errors, {totals['cached']} from cache)", file=sys.stderr)
+    print(f"Throughput: {totals['items'] / seconds:.2f} items/s, "
+          f"{total_tokens / seconds:.1f} tokens/s "
+          f"({totals['completion_tokens'] / seconds:.1f} completion tokens/s)", file=sys.stderr)
+    if totals["prompt_tokens"]:
+        print(f"Prompt cache: {totals['cached_tokens']} of {totals['prompt_tokens']} prompt tokens "
+              f"({totals['cached_tokens'] / totals['prompt_tokens'] * 100:.0f}%)", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transform many texts concurrently with the gpt_tools/actions/ pipeline.")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL input file, or - for stdin (default)")
+    parser.add_argument("-o", "--output", default="-", help="JSONL output file, or - for stdout (default)")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Concurrent requests (default 4)")
+    parser.add_argument("-r", "--rate", type=float, default=0.0, help="Max requests started per second (default: unlimited)")
+    args = parser.parse_args()
+
+    # Build/refresh the config registry once before the worker threads start reading it
+    load_registry()
+
+    input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8") if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    output_stream = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8") if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        totals = run_batch(input_stream, output_stream, max(1, args.workers), args.rate)
+    finally:
+        input_stream.close()
+        output_stream.flush()
+        if args.output != "-":
+            output_stream.close()
+    print_throughput(totals)
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import tempfile
+import itertools
+import platform
+import subprocess
+import contextlib
+
+from mock_openai_server import start_server
+
+# Offline benchmarks for the trigger scripts. Every entry point runs end-to-end against
+# mock_openai_server.py instead of the real API, in a scratch copy of gpt_tools/ (so no
+# conversations, cache entries or metrics land in the real config), and the timing spans
+# the scripts already record (see metrics.py) are collected per run:
+#   cold_start     interpreter start + module-level imports of each script (fresh process each time)
+#   action         text_processor.run() for a text action: config load, prompt render, API, total
+#   action_stream  the same, streamed (adds time to first token)
+#   action_retry   the same with injected 429s, to see what retries cost
+#   action_prefetch the same, submitted with the form's defaults PREFETCH_FORM_SECONDS after prefetch.py
+#                  started (in a thread, as in the daemon): prefetch_wait and total, compare with action.total
+#   action_long    the same with a reply longer than the action's sized max_tokens, so it is cut off and
+#                  continued: api, total and continuations (a reply still cut off counts as a failure)
+#   variants       text_processor.py variants mode: 4 tones at once, and 4 samples in one request
+#                  (first_variant and api, the wall time until all are in, compare with action.api)
+#   screenshot     resize + encode of a synthetic 2560x1440 screen (needs Pillow)
+#   support        customer_support.run() with a ~2k-token FAQ, in changing languages
+#   task           multi-form.py run() for a one-turn Customer Support task with the same FAQ, changing sentiment
+#   faq_search     faq_index.py (BM25) and faq_embeddings.py (semantic, needs numpy) over a synthetic knowledge
+#                  base (ESPANSO_GPT_BENCH_FAQ_SECTIONS sections, default 10000): full build, incremental
+#                  update after one file changed, query
+# support and task also report prompt_tokens and cached_pct, the share of prompt tokens the (mock)
+# provider served from its prefix cache, which shows whether the prompt layout keeps a stable prefix.
+# Results are compared with a stored baseline (gpt_tools/benchmarks/baseline.json, local to
+# the machine); a metric whose p50 got slower by more than the tolerance is a regression.
+# The mock's latency, token rate and error rate come from the ESPANSO_GPT_MOCK_* variables.
+#
+# `benchmark.py imports` is the startup budget check: it profiles each entry point's
+# module-level imports with python -X importtime and fails if one exceeds its budget or
+# loads a module that must only be imported on demand (openai, the GUI and screenshot stacks).
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(SCRIPTS_DIR, ".."))
+BASELINE_PATH = os.path.join(CONFIG_DIR, "gpt_tools", "benchmarks", "baseline.json")
+CONFIG_SUBDIRS = ("actions", "tasks", "tone", "faq")
+DEFAULT_RUNS = int(os.environ.get("ESPANSO_GPT_BENCH_RUNS", 10))
+TOLERANCE = float(os.environ.get("ESPANSO_GPT_BENCH_TOLERANCE", 0.2)) # 20% slower p50 is a regression...
+MIN_REGRESSION_MS = 5.0 # ...if it is also at least this many ms (sub-ms spans are mostly noise)
+RETRY_ERROR_RATE = 0.3
+
+SCENARIOS = ("cold_start", "action", "action_stream", "action_retry", "action_prefetch", "action_long", "variants", "screenshot", "support", "task", "faq_search")
+COLD_START_SCRIPTS = ("text_processor", "customer_support", "multi-form")
+IMPORT_BUDGETS_MS = {"text_processor": 100, "customer_support": 100, "multi-form": 100, "handle_form_step1": 100, "prefetch": 100}
+DEFERRED_MODULES = ("openai", "httpx", "tkinter", "customtkinter", "PIL", "pyautogui", "pyperclip")
+IMPORT_MARKER = "benchmark: script imports start"
+SAMPLE_TEXT = "hey, can u send me the report by friday? i need it for the meeting with the client"
+ACTION_ARGS = ["Rephrase", "Friendly", SAMPLE_TEXT, "English", ""]
+PREFETCH_FORM_SECONDS = 0.5 # How long the form stays open before it is submitted
+LONG_REPLY_TOKENS = 400 # More than Rephrase's sized budget for SAMPLE_TEXT (its policy floor, 256)
+VARIANT_SPECS = {"variants": "Friendly, Formal, Conspiro, Walking on eggshells", "variants_samples": "4 samples"}
+BENCHMARK_FAQ = "benchmark_faq.md"
+SUPPORT_ARGS = ["friendly", "customer", BENCHMARK_FAQ, "English", "false", "Hi, can I still return my order?", ""]
+SUPPORT_LANGUAGES = ("English", "French", "Spanish")
+TASK_STATE = {"task_objective": "Customer Support Task", "conversation_mode": "Start New", "output_language": "English",
+              "selected_faq": BENCHMARK_FAQ, "relation": "client", "include_screenshot": "false",
+              "initial_prompt": "Hi, my order arrived damaged. What can I do?"}
+TASK_SENTIMENTS = ("neutre", "affirmatif", "empathetic")
+FAQ_BENCH_SECTIONS = int(os.environ.get("ESPANSO_GPT_BENCH_FAQ_SECTIONS", 10000))
+FAQ_BENCH_FILES = 20
+FAQ_BENCH_BUILDS = 3 # Full builds are slow at this size; the p50 of a few is enough
+NON_TIMING_SUFFIXES = (".attempts", ".kb", ".cached_pct", ".prompt_tokens", ".continuations")
+
+_records = []
+
+def prepare_environment(server):
+    """Points everything at a scratch config dir and the mock server; returns the scratch dir."""
+    scratch_dir = tempfile.mkdtemp(prefix="espanso-gpt-bench-")
+    for subdir in CONFIG_SUBDIRS:
+        source = os.path.join(CONFIG_DIR, "gpt_tools", subdir)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(scratch_dir, "gpt_tools", subdir))
+    # A realistically large FAQ (~2k tokens), the case prompt caching matters most for
+    os.makedirs(os.path.join(scratch_dir, "gpt_tools", "faq"), exist_ok=True)
+    with open(os.path.join(scratch_dir, "gpt_tools", "faq", BENCHMARK_FAQ), "w", encoding="utf-8") as f:
+        for number in range(1, 41):
+            f.write(f"## Question {number}: How does policy {number} apply to my order?\n"
+                    f"Policy {number} applies to every order placed in the last {number * 3} days. Contact support with "
+                    f"your order number and we will process the request within {number % 5 + 1} business days.\n\n")
+    os.environ.update({
+        "ESPANSO_CONFIG_DIR": scratch_dir,
+        "OPENAI_BASE_URL": server.base_url,
+        "OPENAI_API_KEY": "mock-key", # Set before .env is loaded, so a real key is never used
+        "ESPANSO_GPT_NO_DAEMON": "1",
+    })
+    # Imported only now: these modules resolve their paths from the environment at import time
+    import metrics
+    metrics.write_record = _records.append # Keep run records in memory instead of the metrics log
+    return scratch_dir
+
+def measure_runs(fn, runs):
+    """Calls fn() once to warm up, then runs times; returns the metrics record of each timed run."""
+    records = []
+    for index in range(runs + 1):
+        del _records[:]
+        with contextlib.redirect_stderr(io.StringIO()): # The scripts' popups and debug output
+            fn()
+        if index and _records:
+            records.append(_records[-1])
+    return records
+
+def spans_to_samples(name, records, span_names):
+    samples = {f"{name}.{span_name}": [] for span_name in span_names}
+    for record in records:
+        for span_name in span_names:
+            if span_name in record["spans"]:
+                samples[f"{name}.{span_name}"].append(record["spans"][span_name])
+    return {metric: values for metric, values in samples.items() if values}
+
+def cached_samples(name, records):
+    """Prompt tokens of each run, and the percent of them served from the provider's prompt cache."""
+    prompt_tokens, cached_pct = [], []
+    for record in records:
+        usage = record.get("usage") or {}
+        if usage.get("prompt_tokens"):
+            prompt_tokens.append(usage["prompt_tokens"])
+            cached_pct.append(usage.get("cached_tokens", 0) / usage["prompt_tokens"] * 100)
+    return {f"{name}.prompt_tokens": prompt_tokens, f"{name}.cached_pct": cached_pct} if prompt_tokens else {}
+
+def import_script_code(script_name):
+    """Python code that runs a script's module-level code (imports included) without its __main__ block."""
+    path = os.path.join(SCRIPTS_DIR, f"{script_name}.py")
+    return (f"import sys, importlib.util; sys.path.insert(0, {SCRIPTS_DIR!r}); "
+            f"sys.stderr.write({IMPORT_MARKER!r} + '\\n'); sys.stderr.flush(); "
+            f"spec = importlib.util.spec_from_file_location('benchmark_import', {path!r}); "
+            f"spec.loader.exec_module(importlib.util.module_from_spec(spec))")
+
+def profile_imports(script_name):
+    """Imports a script under python -X importtime.
+
+    Returns (total_ms, {module: cumulative_ms} for the modules the script imports directly,
+    set of every module loaded), or None if the import failed.
+    """
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY") or "mock-key", ESPANSO_GPT_NO_DAEMON="1")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", import_script_code(script_name)],
+                            capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        error_lines = result.stderr.strip().splitlines()
+        print(f"WARN benchmark: importing {script_name} failed: {error_lines[-1] if error_lines else result.returncode}", file=sys.stderr)
+        return None
+    lines = result.stderr.splitlines()
+    lines = lines[lines.index(IMPORT_MARKER) + 1:] if IMPORT_MARKER in lines else lines
+    direct, loaded = {}, set()
+    for line in lines:
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit(): # The header line
+            continue
+        module = name.strip()
+        loaded.add(module.split(".")[0])
+        if not name[1:].startswith(" "): # Not indented: imported by the script itself
+            direct[module] = int(cumulative) / 1000
+    return sum(direct.values()), direct, loaded
+
+def check_import_budgets(budgets=IMPORT_BUDGETS_MS):
+    """Prints each entry point's import time against its budget; returns the list of violations."""
+    violations = []
+    print(f"{'script':<20} {'imports ms':>10} {'budget':>8}  slowest imports")
+    for script_name, budget in budgets.items():
+        profile = profile_imports(script_name)
+        if profile is None:
+            violations.append(f"{script_name}: import failed")
+            continue
+        total_ms, direct, loaded = profile
+        slowest = sorted(direct.items(), key=lambda item: item[1], reverse=True)[:4]
+        print(f"{script_name:<20} {total_ms:>10.1f} {budget:>8}  " + ", ".join(f"{module} {ms:.1f}" for module, ms in slowest))
+        if total_ms > budget:
+            violations.append(f"{script_name}: imports take {total_ms:.1f} ms, budget is {budget} ms")
+        for module in DEFERRED_MODULES:
+            if module in loaded:
+                violations.append(f"{script_name}: imports {module} at startup (it must be imported on demand)")
+    return violations
+
+def bench_cold_start(runs):
+    """Wall time of a fresh interpreter importing each script (what every trigger pays without the daemon)."""
+    samples = {}
+    commands = {"python": [sys.executable, "-c", "pass"]}
+    for script_name in COLD_START_SCRIPTS:
+        commands[script_name] = [sys.executable, "-c", import_script_code(script_name)]
+    for name, command in commands.items():
+        values = []
+        for _ in range(runs):
+            started_at = time.perf_counter()
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                error_lines = result.stderr.strip().splitlines()
+                print(f"WARN benchmark: cold start of {name} failed: {error_lines[-1] if error_lines else result.returncode}", file=sys.stderr)
+                break
+            values.append((time.perf_counter() - started_at) * 1000)
+        if values:
+            samples[f"cold_start.{name}"] = values
+    return samples, {}
+
+def bench_action(runs, server, stream=False, error_rate=0.0, name="action"):
+    from gpt_daemon import load_script
+    text_processor = load_script("text_processor")
+    previous = (os.environ.get("ESPANSO_GPT_STREAM"), server.config["error_rate"])
+    os.environ["ESPANSO_GPT_STREAM"] = "1" if stream else "0"
+    server.config["error_rate"] = error_rate
+    try:
+        records = measure_runs(lambda: text_processor.run(list(ACTION_ARGS)), runs)
+    finally:
+        if previous[0] is None:
+            os.environ.pop("ESPANSO_GPT_STREAM", None)
+        else:
+            os.environ["ESPANSO_GPT_STREAM"] = previous[0]
+        server.config["error_rate"] = previous[1]
+    span_names = ("config_load", "tone_read", "prompt_render", "ttft", "api", "total")
+    samples = spans_to_samples(name, records, span_names)
+    samples[f"{name}.attempts"] = [record.get("attempts", 0) for record in records]
+    return samples, {name: sum(1 for record in records if not record.get("ok", True))}
+
+def bench_prefetch(runs):
+    from gpt_daemon import load_script
+    text_processor = load_script("text_processor")
+    prefetch = load_script("prefetch")
+    args = [prefetch.DEFAULT_ACTION, prefetch.DEFAULT_TONE, SAMPLE_TEXT, prefetch.DEFAULT_LANGUAGE, ""]
+    def submit_after_form():
+        prefetch.run([SAMPLE_TEXT])
+        time.sleep(PREFETCH_FORM_SECONDS)
+        return text_processor.run(list(args))
+    records = measure_runs(submit_after_form, runs)
+    samples = spans_to_samples("action_prefetch", records, ("prefetch_wait", "api", "total"))
+    return samples, {"action_prefetch": sum(1 for record in records if not record.get("prefetched"))}
+
+def bench_long_reply(runs, server):
+    from gpt_daemon import load_script
+    text_processor = load_script("text_processor")
+    previous = server.config["tokens"]
+    server.config["tokens"] = LONG_REPLY_TOKENS
+    try:
+        records = measure_runs(lambda: text_processor.run(list(ACTION_ARGS)), runs)
+    finally:
+        server.config["tokens"] = previous
+    samples = spans_to_samples("action_long", records, ("api", "total"))
+    samples["action_long.continuations"] = [record.get("continuations", 0) for record in records]
+    return samples, {"action_long": sum(1 for record in records if record.get("truncated") or not record.get("ok", True))}
+
+def wait_for_all_variants(slots):
+    """Benchmark chooser: waits until every variant is in, then picks the first."""
+    from concurrent.futures import wait
+    wait([slot["future"] for slot in slots])
+    return 0
+
+def bench_variants(runs):
+    from gpt_daemon import load_script
+    text_processor = load_script("text_processor")
+    samples = {}
+    for name, spec in VARIANT_SPECS.items():
+        args = ACTION_ARGS + [spec]
+        records = measure_runs(lambda: text_processor.run_variants(list(args), choose=wait_for_all_variants), runs)
+        samples.update(spans_to_samples(name, records, ("first_variant", "api", "total")))
+    return samples, {}
+
+def synthetic_screen(width=2560, height=1440):
+    """A screen-like test image: flat panels with rows of text-like strokes."""
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, width, 60), fill=(40, 44, 52))
+    draw.rectangle((0, 60, 320, height), fill=(230, 232, 236))
+    for row, y in enumerate(range(100, height - 40, 28)):
+        for x in range(360, width - 200, 90):
+            draw.text((x, y), f"item {row}:{x}", fill=(30 + row % 90, 30, 30))
+    return img
+
+def bench_screenshot(runs):
+    try:
+        screen = synthetic_screen()
+    except ImportError:
+        print("WARN benchmark: Pillow is not installed, skipping the screenshot benchmark", file=sys.stderr)
+        return {}, {}
+    from screen_capture import capture_screenshot
+    samples = {"screenshot.resize": [], "screenshot.encode": [], "screenshot.kb": []}
+    for _ in range(runs):
+        shot = capture_screenshot(grab=screen.copy)
+        samples["screenshot.resize"].append(shot["timings"]["resize"] * 1000)
+        samples["screenshot.encode"].append(shot["timings"]["encode"] * 1000)
+        samples["screenshot.kb"].append(shot["bytes"] / 1024)
+    return samples, {}
+
+def bench_support(runs):
+    from gpt_daemon import load_script
+    customer_support = load_script("customer_support")
+    languages = itertools.cycle(SUPPORT_LANGUAGES)
+    records = measure_runs(lambda: customer_support.run(SUPPORT_ARGS[:3] + [next(languages)] + SUPPORT_ARGS[4:]), runs)
+    samples = spans_to_samples("support", records, ("faq_read", "prompt_render", "api", "total"))
+    samples.update(cached_samples("support", records))
+    return samples, {"support": sum(1 for record in records if not record.get("ok", True))}
+
+def bench_task(runs):
+    from gpt_daemon import load_script
+    try:
+        multi_form = load_script("multi-form")
+    except ImportError as e:
+        print(f"WARN benchmark: skipping the task benchmark ({e})", file=sys.stderr)
+        return {}, {}
+    sentiments = itertools.cycle(TASK_SENTIMENTS)
+    records = measure_runs(lambda: multi_form.run(dict(TASK_STATE, sentiment=next(sentiments))), runs)
+    samples = spans_to_samples("task", records, ("config_load", "faq_read", "history_window", "prompt_render", "api", "total"))
+    samples.update(cached_samples("task", records))
+    return samples, {"task": sum(1 for record in records if not record.get("ok", True))}
+
+def write_faq_knowledge_base(faq_dir, sections=FAQ_BENCH_SECTIONS, files=FAQ_BENCH_FILES):
+    """Writes a synthetic FAQ set (bench_kb_*.md) with sections of random words; returns the paths and query words."""
+    rng = random.Random(42)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 10))) for _ in range(5000)]
+    paths = []
+    for file_number in range(files):
+        path = os.path.join(faq_dir, f"bench_kb_{file_number}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            for number in range(file_number, sections, files):
+                f.write(f"## {' '.join(rng.sample(vocabulary, 6))} ({number})\n{' '.join(rng.choices(vocabulary, k=60))}\n\n")
+        paths.append(path)
+    return paths, vocabulary
+
+def bench_faq_search(runs):
+    import faq_index
+    from action_reader import FAQ_DIR
+    paths, vocabulary = write_faq_knowledge_base(FAQ_DIR)
+    try:
+        faq_index.load_index() # Registry parse of the new files, so builds below time only the index
+        samples = _time_faq_store("faq_search", runs, paths, vocabulary, faq_index.INDEX_DIR,
+                                  lambda: faq_index.load_index(), lambda query: faq_index.bm25_search(query),
+                                  lambda: faq_index._index_memo.update(files=None, search=None))
+        try:
+            import faq_embeddings
+        except ImportError:
+            print("WARN benchmark: numpy is not installed, skipping the semantic FAQ search benchmark", file=sys.stderr)
+        else:
+            samples.update(_time_faq_store("faq_semantic", runs, paths, vocabulary, faq_embeddings.STORE_DIR,
+                                           lambda: faq_embeddings.load_store(), lambda query: faq_embeddings.search(query),
+                                           lambda: faq_embeddings._store_memo.update(meta_mtime_ns=None, store=None)))
+    finally:
+        for path in paths:
+            os.remove(path)
+    return samples, {}
+
+def _time_faq_store(name, runs, paths, vocabulary, store_dir, build, query, forget):
+    """Times a full build, the update after one file changed (plus a query), and a query of an FAQ search store."""
+    rng = random.Random(7)
+    samples = {f"{name}.build": [], f"{name}.update": [], f"{name}.query": []}
+    for _ in range(min(runs, FAQ_BENCH_BUILDS)):
+        shutil.rmtree(store_dir, ignore_errors=True)
+        forget()
+        started_at = time.perf_counter()
+        build()
+        samples[f"{name}.build"].append((time.perf_counter() - started_at) * 1000)
+    for number in range(runs):
+        with open(paths[number % len(paths)], "a", encoding="utf-8") as f:
+            f.write(f"## Update {name} {number}\n{' '.join(rng.choices(vocabulary, k=60))}\n\n")
+        started_at = time.perf_counter()
+        query(" ".join(rng.choices(vocabulary, k=8)))
+        samples[f"{name}.update"].append((time.perf_counter() - started_at) * 1000)
+    for _ in range(runs):
+        words = " ".join(rng.choices(vocabulary, k=8))
+        started_at = time.perf_counter()
+        query(words)
+        samples[f"{name}.query"].append((time.perf_counter() - started_at) * 1000)
+    return samples
+
+def run_benchmarks(runs=DEFAULT_RUNS, scenarios=SCENARIOS):
+    """Runs the selected scenarios and returns {"metrics": {metric: {"runs", "p50", "p95", "max"}}, "failures": {...}, ...}."""
+    server = start_server()
+    scratch_dir = prepare_environment(server)
+    from metrics import percentile
+    samples, failures = {}, {}
+    try:
+        for scenario in scenarios:
+            started_at = time.time()
+            if scenario == "cold_start":
+                result = bench_cold_start(runs)
+            elif scenario == "action":
+                result = bench_action(runs, server)
+            elif scenario == "action_stream":
+                result = bench_action(runs, server, stream=True, name="action_stream")
+            elif scenario == "action_retry":
+                result = bench_action(runs, server, error_rate=RETRY_ERROR_RATE, name="action_retry")
+            elif scenario == "action_prefetch":
+                result = bench_prefetch(runs)
+            elif scenario == "action_long":
+                result = bench_long_reply(runs, server)
+            elif scenario == "variants":
+                result = bench_variants(runs)
+            elif scenario == "screenshot":
+                result = bench_screenshot(runs)
+            elif scenario == "support":
+                result = bench_support(runs)
+            elif scenario == "task":
+                result = bench_task(runs)
+            elif scenario == "faq_search":
+                result = bench_faq_search(runs)
+            else:
+                print(f"WARN benchmark: unknown scenario {scenario}", file=sys.stderr)
+                continue
+            samples.update(result[0])
+            failures.update(result[1])
+            print(f"{scenario}: done in {time.time() - started_at:.1f}s", file=sys.stderr)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    summary = {}
+    for metric, values in samples.items():
+        values = sorted(values)
+        summary[metric] = {"runs": len(values), "p50": round(percentile(values, 0.50), 2),
+                           "p95": round(percentile(values, 0.95), 2), "max": round(values[-1], 2)}
+    return {"ts": time.time(), "python": platform.python_version(), "platform": platform.platform(),
+            "mock": {key: value for key, value in server.config.items() if key != "error_rate"},
+            "metrics": summary, "failures": failures}
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_baseline(results, path=BASELINE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+def find_regressions(results, baseline, tolerance=TOLERANCE):
+    """Returns [(metric, baseline_p50, p50)] for timing metrics whose p50 is slower than the baseline allows."""
+    regressions = []
+    for metric, stats in results["metrics"].items():
+        if metric.endswith(NON_TIMING_SUFFIXES):
+            continue
+        previous = baseline["metrics"].get(metric)
+        if previous is None:
+            continue
+        if stats["p50"] > previous["p50"] * (1 + tolerance) and stats["p50"] - previous["p50"] >= MIN_REGRESSION_MS:
+            regressions.append((metric, previous["p50"], stats["p50"]))
+    return regressions
+
+def print_results(results, baseline=None):
+    print(f"{'metric':<36} {'runs':>5} {'p50':>10} {'p95':>10} {'max':>10} {'base p50':>10} {'change':>8}")
+    for metric, stats in sorted(results["metrics"].items()):
+        line = f"{metric:<36} {stats['runs']:>5} {stats['p50']:>10.1f} {stats['p95']:>10.1f} {stats['max']:>10.1f}"
+        previous = (baseline or {}).get("metrics", {}).get(metric)
+        if previous:
+            change = f"{(stats['p50'] - previous['p50']) / previous['p50'] * 100:+.0f}%" if previous["p50"] else "-"
+            line += f" {previous['p50']:>10.1f} {change:>8}"
+        print(line)
+    for scenario, count in results["failures"].items():
+        if count:
+            print(f"{scenario}: {count} failed run(s)")
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+
+    if command in ("run", "save"):
+        # Optional: number of runs per scenario, then the scenarios to run (default: all)
+        runs = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_RUNS
+        scenarios = tuple(sys.argv[3:]) or SCENARIOS
+        results = run_benchmarks(runs, scenarios)
+        baseline = load_baseline()
+        print_results(results, baseline)
+        if command == "save":
+            save_baseline(results)
+            print(f"Baseline saved to {BASELINE_PATH}")
+        elif baseline is None:
+            print("No baseline yet; record one with: benchmark.py save")
+        else:
+            if baseline.get("mock") != results["mock"]:
+                print("WARN benchmark: the mock server settings differ from the baseline's", file=sys.stderr)
+            regressions = find_regressions(results, baseline)
+            for metric, previous_p50, p50 in regressions:
+                print(f"REGRESSION {metric}: p50 {previous_p50:.1f} -> {p50:.1f} ms")
+            sys.exit(1 if regressions else 0)
+
+    elif command == "imports":
+        violations = check_import_budgets()
+        for violation in violations:
+            print(f"OVER BUDGET {violation}")
+        sys.exit(1 if violations else 0)
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  benchmark.py run [runs] [scenario ...]   Run and compare with the baseline (exit 1 on regression)", file=sys.stderr)
+        print("  benchmark.py save [runs] [scenario ...]  Run and store the results as the baseline", file=sys.stderr)
+        print("  benchmark.py imports                     Check each entry point's startup import budget", file=sys.stderr)
+        print(f"Scenarios: {' '.join(SCENARIOS)}", file=sys.stderr)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import os
+import sys
+import io
+import base64
+import hashlib
+
+# Screenshots are stored once in gpt_tools/blobs/<sha256> and conversation messages
+# reference them with an "image_ref" content part:
+#   {"type": "image_ref", "image_ref": {"sha256": "...", "mime_type": "image/png"}}
+# materialize_messages() turns those references into data URLs right before a request.
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
+BLOBS_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "blobs")
+
+OLDER_IMAGE_MAX_SIDE = 512 # Long side (px) of downscaled older images when replaying history
+OMITTED_IMAGE_TEXT = "(An earlier screenshot was omitted here.)"
+
+def blob_path(sha256):
+    return os.path.join(BLOBS_DIR, sha256)
+
+def put_blob(data):
+    """Stores bytes under their SHA-256 (once) and returns the hash."""
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = blob_path(sha256)
+    if not os.path.exists(path):
+        os.makedirs(BLOBS_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return sha256
+
+def get_blob(sha256):
+    """Returns the stored bytes, or None if the blob is missing."""
+    try:
+        with open(blob_path(sha256), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def make_image_ref(data, mime_type):
+    """Stores image bytes and returns the message content part that references them."""
+    return {"type": "image_ref", "image_ref": {"sha256": put_blob(data), "mime_type": mime_type}}
+
+def _data_url(data, mime_type):
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def _downscaled_blob(sha256, max_side):
+    """Returns (bytes, mime_type) of a downscaled copy, cached as its own blob file."""
+    derived_path = f"{blob_path(sha256)}@{max_side}"
+    if os.path.exists(derived_path):
+        with open(derived_path, "rb") as f:
+            return f.read(), "image/jpeg"
+    data = get_blob(sha256)
+    if data is None:
+        return None, None
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=70, optimize=True)
+    with open(derived_path, "wb") as f:
+        f.write(buffer.getvalue())
+    return buffer.getvalue(), "image/jpeg"
+
+def externalize_images(messages):
+    """Returns messages with inline base64 image_url parts replaced by blob references."""
+    converted = []
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            converted.append(message)
+            continue
+        parts = []
+        for part in content:
+            url = part.get("image_url", {}).get("url", "") if part.get("type") == "image_url" else ""
+            if url.startswith("data:") and ";base64," in url:
+                header, encoded = url.split(",", 1)
+                mime_type = header[len("data:"):].split(";", 1)[0] or "image/png"
+                parts.append(make_image_ref(base64.b64decode(encoded), mime_type))
+            else:
+                parts.append(part)
+        converted.append({**message, "content": parts})
+    return converted
+
+def materialize_messages(messages, recent_images=1, older_images="downscale"):
+    """Builds the API payload for a stored history, resolving image references.
+
+    The `recent_images` most recent images are sent at full size. Older ones are
+    sent downscaled ("downscale"), replaced by a short note ("drop"), or sent
+    unchanged ("keep").
+    """
+    ref_positions = [
+        (i, j) for i, message in enumerate(messages) if isinstance(message.get("content"), list)
+        for j, part in enumerate(message["content"]) if part.get("type") == "image_ref"
+    ]
+    full_size = set(ref_positions[-recent_images:]) if recent_images > 0 else set()
+
+    materialized = []
+    for i, message in enumerate(messages):
+        content = message.get("content")
+        if not isinstance(content, list):
+            materialized.append(message)
+            continue
+        parts = []
+        for j, part in enumerate(content):
+            if part.get("type") != "image_ref":
+                parts.append(part)
+                continue
+            ref = part["image_ref"]
+            data, mime_type = None, ref.get("mime_type", "image/png")
+            if (i, j) in full_size or older_images == "keep":
+                data = get_blob(ref["sha256"])
+            elif older_images == "downscale":
+                try:
+                    data, mime_type = _downscaled_blob(ref["sha256"], OLDER_IMAGE_MAX_SIDE)
+                except Exception as e:
+                    print(f"WARN blob_store: Could not downscale {ref['sha256']}: {e}", file=sys.stderr)
+            if data is None:
+                parts.append({"type": "text", "text": OMITTED_IMAGE_TEXT})
+            else:
+                parts.append({"type": "image_url", "image_url": {"url": _data_url(data, mime_type)}})
+        materialized.append({**message, "content": parts})
+    return materialized
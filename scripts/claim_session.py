@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+from state_io import claim_handoff
+
+# Script var of the :gpt_form_step2 match: runs as the form opens, claims the session
+# handle_form_step1.py handed off and prints its ID, which the form passes on to
+# handle_form_step2.py (see state_io.py).
+print(claim_handoff() or "")
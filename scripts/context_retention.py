@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import time
+
+from conversation_store import (CONFIG_DIR, CONTEXT_DIR_PATH, HEADER_SUFFIX, MESSAGES_SUFFIX, COMPRESSED_SUFFIX, LEGACY_SUFFIX,
+                                list_conversation_ids, header_path, messages_path, compressed_path, legacy_path,
+                                compact_conversation, compress_conversation, delete_conversation)
+
+# Retention for gpt_tools/context/, which otherwise only ever grows. One run:
+#   1. deletes conversations older than MAX_AGE_DAYS,
+#   2. gzips the logs of conversations untouched for COMPRESS_AFTER_DAYS (at most
+#      MAX_COMPRESS_PER_RUN per run; the rest waits for the next run); cold conversations
+#      still in the old single-file <id>.json format (pretty-printed, screenshots inline)
+#      are first converted (screenshots moved to gpt_tools/blobs/, messages to a log),
+#   3. deletes the oldest conversations until the directory fits in MAX_BYTES,
+#   4. removes the screenshots (gpt_tools/blobs/) no remaining conversation refers to.
+# The KEEP_LAST most recent conversations are never deleted, and a conversation touched
+# in the last ACTIVE_SECONDS is left alone entirely (it may be in use right now).
+# Age is the time since the conversation was last saved (its header file's mtime).
+# Deleting is off until a limit is set; compressing is on. The :gpt: form handler starts
+# a run in the background at most once every RUN_INTERVAL_HOURS.
+MAX_AGE_DAYS = float(os.environ.get("ESPANSO_GPT_CONTEXT_MAX_AGE_DAYS", 0)) # 0 = no age limit
+MAX_BYTES = int(os.environ.get("ESPANSO_GPT_CONTEXT_MAX_BYTES", 0)) # 0 = no size limit
+KEEP_LAST = int(os.environ.get("ESPANSO_GPT_CONTEXT_KEEP_LAST", 20))
+COMPRESS_AFTER_DAYS = float(os.environ.get("ESPANSO_GPT_CONTEXT_COMPRESS_DAYS", 7)) # 0 = never compress
+RUN_INTERVAL_HOURS = float(os.environ.get("ESPANSO_GPT_RETENTION_INTERVAL_HOURS", 24)) # 0 = only by hand
+MAX_COMPRESS_PER_RUN = 500
+ACTIVE_SECONDS = 3600
+STATE_PATH = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "retention.json")
+BLOB_REF_PATTERN = re.compile(rb'"sha256":\s*"([0-9a-f]{64})"')
+
+def scan():
+    """Lists the conversations with one pass over the directory: [{"id", "updated_at", "bytes", "compressed", "has_log", "legacy"}]."""
+    conversations = {}
+    try:
+        entries = list(os.scandir(CONTEXT_DIR_PATH))
+    except OSError:
+        return []
+    for entry in entries:
+        # Header before legacy: ".header.json" also ends with ".json"
+        for suffix in (COMPRESSED_SUFFIX, MESSAGES_SUFFIX, HEADER_SUFFIX, LEGACY_SUFFIX):
+            if entry.name.endswith(suffix):
+                break
+        else:
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        conversation = conversations.setdefault(entry.name[:-len(suffix)], {
+            "id": entry.name[:-len(suffix)], "updated_at": 0.0, "bytes": 0, "compressed": False, "has_log": False,
+            "legacy": False})
+        conversation["bytes"] += stat.st_size
+        if suffix == COMPRESSED_SUFFIX:
+            conversation["compressed"] = True # Written when compressed, so its mtime says nothing about use
+        else:
+            conversation["updated_at"] = max(conversation["updated_at"], stat.st_mtime)
+            conversation["has_log"] = conversation["has_log"] or suffix == MESSAGES_SUFFIX
+            conversation["legacy"] = conversation["legacy"] or suffix == LEGACY_SUFFIX
+    return sorted(conversations.values(), key=lambda conversation: conversation["updated_at"], reverse=True)
+
+def plan(conversations, now, max_age_days=MAX_AGE_DAYS, keep_last=KEEP_LAST, compress_after_days=COMPRESS_AFTER_DAYS):
+    """Splits scan() results (newest first) into (expired, to_compress, deletable), each oldest first.
+
+    deletable is what the size limit may delete (after compression), in that order.
+    """
+    protected = {conversation["id"] for conversation in conversations[:keep_last]}
+    expired, to_compress, deletable = [], [], []
+    for conversation in reversed(conversations):
+        age = now - conversation["updated_at"]
+        if age < ACTIVE_SECONDS:
+            continue
+        if conversation["id"] not in protected:
+            if max_age_days and age > max_age_days * 86400:
+                expired.append(conversation)
+                continue
+            deletable.append(conversation)
+        if (compress_after_days and (conversation["has_log"] or conversation["legacy"])
+                and age > compress_after_days * 86400):
+            to_compress.append(conversation)
+    return expired, to_compress, deletable
+
+def referenced_blobs(exclude=()):
+    """Hashes of every screenshot referenced by a stored conversation (except those in exclude)."""
+    from gzip import open as gzip_open
+    hashes = set()
+    exclude = set(exclude)
+    for conversation_id in list_conversation_ids():
+        if conversation_id in exclude:
+            continue
+        for path, opener in ((messages_path(conversation_id), open), (compressed_path(conversation_id), gzip_open),
+                             (legacy_path(conversation_id), open)):
+            try:
+                with opener(path, "rb") as f:
+                    hashes.update(match.decode("ascii") for match in BLOB_REF_PATTERN.findall(f.read()))
+            except OSError:
+                continue
+    return hashes
+
+def sweep_blobs(dry_run=False, deleted_ids=()):
+    """Removes blobs (and their downscaled copies) no conversation refers to. Returns (count, bytes).
+
+    deleted_ids are conversations counted as gone (a dry run has not deleted them).
+    """
+    from blob_store import BLOBS_DIR
+    try:
+        entries = list(os.scandir(BLOBS_DIR))
+    except OSError:
+        return 0, 0
+    referenced = referenced_blobs(deleted_ids)
+    count = freed = 0
+    cutoff = time.time() - ACTIVE_SECONDS # A run in progress stores its screenshot before saving the message
+    for entry in entries:
+        sha256 = entry.name.split("@", 1)[0].split(".", 1)[0]
+        try:
+            stat = entry.stat()
+            if sha256 in referenced or stat.st_mtime > cutoff:
+                continue
+            if not dry_run:
+                os.remove(entry.path)
+        except OSError:
+            continue
+        count += 1
+        freed += stat.st_size
+    return count, freed
+
+def convert_legacy(conversation_id, counted_blobs=None):
+    """Converts a single-file <id>.json conversation to a header and a gzipped log, keeping its age.
+
+    Returns (bytes_before, bytes_after, blob_bytes): blob_bytes is what its screenshots
+    added to gpt_tools/blobs/ (screenshots already stored there, or in counted_blobs, cost nothing).
+    """
+    from gzip import open as gzip_open
+    from blob_store import blob_path
+    started_at = time.time()
+    mtime = os.stat(legacy_path(conversation_id)).st_mtime
+    bytes_before, _ = compact_conversation(conversation_id)
+    _, bytes_after = compress_conversation(conversation_id)
+    os.utime(header_path(conversation_id), (mtime, mtime)) # Age is read from the header's mtime
+    with gzip_open(compressed_path(conversation_id), "rb") as f:
+        hashes = {match.decode("ascii") for match in BLOB_REF_PATTERN.findall(f.read())}
+    blob_bytes = 0
+    counted_blobs = set() if counted_blobs is None else counted_blobs
+    for sha256 in hashes - counted_blobs:
+        try:
+            stat = os.stat(blob_path(sha256))
+        except OSError:
+            continue
+        if stat.st_mtime >= started_at - 1: # Written by this conversion
+            blob_bytes += stat.st_size
+            counted_blobs.add(sha256)
+    return bytes_before, bytes_after, blob_bytes
+
+def _delete(conversations, report, dry_run):
+    for conversation in conversations:
+        report["deleted_bytes"] += conversation["bytes"] if dry_run else delete_conversation(conversation["id"])
+        report["deleted"] += 1
+    report["deleted_ids"].extend(conversation["id"] for conversation in conversations)
+
+def run(dry_run=False, max_bytes=MAX_BYTES):
+    """Applies the retention policy once and returns a report of what it did (or would do, with dry_run)."""
+    started_at = time.time()
+    conversations = scan()
+    report = {"conversations": len(conversations), "bytes_before": sum(c["bytes"] for c in conversations),
+              "deleted": 0, "deleted_bytes": 0, "deleted_ids": [], "compressed": 0, "compressed_saved_bytes": 0, "converted": 0,
+              "compress_pending": 0, "blobs_deleted": 0, "blob_bytes": 0, "dry_run": dry_run}
+    expired, to_compress, deletable = plan(conversations, started_at)
+    _delete(expired, report, dry_run)
+
+    # Oldest first, so a capped run picks up where the last one stopped
+    report["compress_pending"] = max(0, len(to_compress) - MAX_COMPRESS_PER_RUN)
+    counted_blobs = set() # Screenshots shared by several converted conversations are stored (and counted) once
+    for conversation in to_compress[:MAX_COMPRESS_PER_RUN]:
+        if dry_run:
+            report["compress_pending"] += 1 # The saving is only known once compressed
+            continue
+        try:
+            blob_bytes = 0
+            if conversation["legacy"]:
+                before, after, blob_bytes = convert_legacy(conversation["id"], counted_blobs)
+                report["converted"] += 1
+            else:
+                before, after = compress_conversation(conversation["id"])
+        except (OSError, ValueError) as e:
+            print(f"WARN context_retention: Could not compress {conversation['id']}: {e}", file=sys.stderr)
+            continue
+        conversation["bytes"] -= before - after # Size limit: gpt_tools/context/ only
+        report["compressed"] += 1
+        report["compressed_saved_bytes"] += before - after - blob_bytes # Screenshots moved out still take space
+
+    if max_bytes:
+        expired_ids = {conversation["id"] for conversation in expired}
+        total = sum(c["bytes"] for c in conversations if c["id"] not in expired_ids)
+        over_budget = []
+        for conversation in deletable: # Oldest first
+            if total <= max_bytes:
+                break
+            over_budget.append(conversation)
+            total -= conversation["bytes"]
+        _delete(over_budget, report, dry_run)
+
+    if report["deleted"]:
+        if not dry_run:
+            from conversation_index import connect, remove_conversations
+            connection = connect()
+            try:
+                remove_conversations(connection, report["deleted_ids"])
+            finally:
+                connection.close()
+        report["blobs_deleted"], report["blob_bytes"] = sweep_blobs(dry_run, report["deleted_ids"])
+    report["reclaimed_bytes"] = report["deleted_bytes"] + report["compressed_saved_bytes"] + report["blob_bytes"]
+    report["seconds"] = round(time.time() - started_at, 2)
+    if not dry_run:
+        _save_state({"last_run": started_at, "report": dict(report, deleted_ids=len(report["deleted_ids"]))})
+    return report
+
+def _load_state():
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_state(state):
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    tmp_path = f"{STATE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_PATH)
+
+def maybe_run_in_background():
+    """Starts a run in a detached process if the last one is more than RUN_INTERVAL_HOURS old."""
+    if RUN_INTERVAL_HOURS <= 0:
+        return False
+    state = _load_state()
+    if time.time() - state.get("last_run", 0) < RUN_INTERVAL_HOURS * 3600:
+        return False
+    state["last_run"] = time.time() # Claimed now, so triggers fired meanwhile don't start another run
+    _save_state(state)
+    from daemon_client import spawn_detached
+    spawn_detached([os.path.abspath(__file__), "run"])
+    return True
+
+def _size(size):
+    return f"{size / (1024 * 1024):.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
+
+def print_report(report):
+    verb = "Would delete" if report["dry_run"] else "Deleted"
+    print(f"{report['conversations']} conversation(s), {_size(report['bytes_before'])} before this run")
+    print(f"{verb} {report['deleted']} conversation(s): {_size(report['deleted_bytes'])}")
+    if report["dry_run"]:
+        print(f"Would compress {report['compress_pending']} conversation(s)")
+    else:
+        print(f"Compressed {report['compressed']} conversation(s) ({report['converted']} converted from the old format): "
+              f"{_size(report['compressed_saved_bytes'])} saved"
+              + (f", {report['compress_pending']} left for the next run" if report["compress_pending"] else ""))
+    print(f"{verb} {report['blobs_deleted']} unreferenced screenshot(s): {_size(report['blob_bytes'])}")
+    print(f"Reclaimed: {_size(report['reclaimed_bytes'])} in {report['seconds']}s")
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "run":
+        print_report(run(dry_run="--dry-run" in sys.argv[2:]))
+
+    elif command == "status":
+        conversations = scan()
+        compressed = sum(1 for conversation in conversations if conversation["compressed"])
+        print(f"{len(conversations)} conversation(s), {compressed} compressed, {_size(sum(c['bytes'] for c in conversations))} in {CONTEXT_DIR_PATH}")
+        print(f"Policy: max age {f'{MAX_AGE_DAYS:g} days' if MAX_AGE_DAYS else 'none'}, "
+              f"max size {_size(MAX_BYTES) if MAX_BYTES else 'none'}, keep last {KEEP_LAST}, "
+              f"compress after {f'{COMPRESS_AFTER_DAYS:g} days' if COMPRESS_AFTER_DAYS else 'never'}")
+        state = _load_state()
+        if state.get("report"):
+            last = state["report"]
+            print(f"Last run {time.strftime('%Y-%m-%d %H:%M', time.localtime(state['last_run']))}: "
+                  f"deleted {last['deleted']}, compressed {last['compressed']}, reclaimed {_size(last['reclaimed_bytes'])}")
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  context_retention.py run [--dry-run]   # Apply the retention policy and report the space reclaimed", file=sys.stderr)
+        print("  context_retention.py status            # Directory size, policy and last run", file=sys.stderr)
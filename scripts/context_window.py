@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import sys
+import json
+import math
+import hashlib
+
+# Keeps the history sent to the API within a token budget: the system prompt and the
+# most recent turns are sent as-is, and older turns are folded into a rolling summary
+# stored in the conversation itself ("summary" / "summarized_count"), so request size
+# stays bounded however long a conversation runs. The same token counts size each
+# action's output budget from its input (output_token_budget).
+
+IMAGE_TOKEN_ESTIMATE = 800 # Rough cost of one screenshot in a request
+MESSAGE_OVERHEAD_TOKENS = 4 # Role/separator tokens per message
+FOLD_TARGET_RATIO = 0.75 # When folding, shrink the window to this share of the budget so it isn't redone every turn
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation:\n"
+OUTPUT_FLOOR_TOKENS = 256 # Smallest sized output budget when a "max_tokens_policy" sets no "floor"
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception: # tiktoken is optional; fall back to a character-based estimate
+    _encoding = None
+
+def count_text_tokens(text):
+    """Counts tokens in a string (exactly with tiktoken, ~4 chars per token otherwise)."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+def output_token_budget(config, input_text):
+    """max_tokens for one request of an action/task config, sized from input_text.
+
+    With a "max_tokens_policy" ({"ratio", "floor"}) the budget is ratio x the input's
+    tokens, at least floor and at most the config's "max_tokens"; without one it is
+    "max_tokens" as before. A reply that still hits the budget is continued by the
+    caller (see openai_client.complete_with_continuation), so a low guess costs a
+    second request rather than a truncated answer.
+    """
+    cap = config.get("max_tokens", 2000)
+    policy = config.get("max_tokens_policy")
+    if not isinstance(policy, dict): # None, or invalid (reported by action_reader)
+        return cap
+    ratio = policy.get("ratio", 1.0)
+    floor = policy.get("floor", OUTPUT_FLOOR_TOKENS)
+    # Same rules as action_reader's validation; a broken policy falls back to the cap, like a missing one
+    if isinstance(ratio, bool) or not isinstance(ratio, (int, float)) or not math.isfinite(ratio) or ratio <= 0:
+        return cap
+    if isinstance(floor, bool) or not isinstance(floor, int) or floor < 1:
+        return cap
+    sized = math.ceil(ratio * count_text_tokens(input_text))
+    return min(cap, max(floor, sized))
+
+def _message_key(message):
+    return hashlib.sha1(json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def count_message_tokens(message):
+    """Estimates the tokens one message adds to a request."""
+    content = message.get("content")
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_text_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKEN_ESTIMATE
+    else:
+        tokens = count_text_tokens(content or "")
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+def message_as_text(message):
+    """Flattens a message to plain text for summarization (images become a placeholder)."""
+    content = message.get("content")
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") if part.get("type") == "text" else "[screenshot]" for part in content)
+    return f"{message.get('role', 'user')}: {content or ''}"
+
+def window_history(conversation, budget_tokens, summarize_fn=None):
+    """Returns the messages to send for this turn, folding old turns into the summary when over budget.
+
+    conversation is the stored conversation object; its "summary", "summarized_count"
+    and "token_counts" fields are updated in place so they are saved with it.
+    summarize_fn(previous_summary, messages) -> str produces the new rolling summary.
+    Turns only count as summarized once it has succeeded: without it, or if it fails,
+    they are left out of this request but stay in line to be folded on the next turn.
+    """
+    messages = conversation.get("messages", [])
+    previous_counts = conversation.get("token_counts", {})
+    token_cache = {}
+    def count(message):
+        key = _message_key(message)
+        if key not in token_cache:
+            token_cache[key] = previous_counts.get(key) or count_message_tokens(message)
+        return token_cache[key]
+    has_system = bool(messages) and messages[0].get("role") == "system"
+    head = messages[:1] if has_system else []
+    turns = messages[len(head):]
+    summarized_count = min(conversation.get("summarized_count", 0), max(len(turns) - 1, 0))
+    live_turns = turns[summarized_count:]
+
+    def summary_messages():
+        summary = conversation.get("summary")
+        return [{"role": "system", "content": SUMMARY_PREFIX + summary}] if summary else []
+
+    fixed_tokens = sum(count(m) for m in head + summary_messages())
+    turn_tokens = [count(m) for m in live_turns]
+    # Only counts for messages still sent are kept, so the stored cache stays small
+    conversation["token_counts"] = token_cache
+    if fixed_tokens + sum(turn_tokens) <= budget_tokens:
+        return head + summary_messages() + live_turns
+
+    # Over budget: keep the newest turns that fit in the fold target, always keeping the latest message
+    target = max(budget_tokens * FOLD_TARGET_RATIO - fixed_tokens, 0)
+    keep_from = len(live_turns) - 1
+    used = turn_tokens[-1]
+    while keep_from > 0 and used + turn_tokens[keep_from - 1] <= target:
+        keep_from -= 1
+        used += turn_tokens[keep_from]
+    # Start the window on a user message so the model never sees an orphaned assistant reply
+    while keep_from < len(live_turns) - 1 and live_turns[keep_from].get("role") != "user":
+        keep_from += 1
+
+    folded = live_turns[:keep_from]
+    if folded and summarize_fn is not None:
+        try:
+            summary = summarize_fn(conversation.get("summary", ""), folded)
+        except Exception as e:
+            summary = None
+            print(f"WARN context_window: Summarization failed, leaving {len(folded)} old message(s) out of this request only: {e}", file=sys.stderr)
+        if summary:
+            conversation["summary"] = summary
+            conversation["summarized_count"] = summarized_count + len(folded)
+    return head + summary_messages() + live_turns[keep_from:]
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import time
+import sqlite3
+
+from conversation_store import CONFIG_DIR, list_conversation_ids, load_header, iter_messages, header_path, legacy_path
+
+# SQLite index over the conversations of gpt_tools/context/ (the files stay the source of
+# truth; the index can always be rebuilt from them with `sync`). It holds one row per
+# conversation (task, language, title, last update) for the "continue conversation"
+# picker, and one row per message with an FTS5 full-text index over the message text.
+# conversation_store.save_conversation() updates it on every save with just the new
+# messages. WAL mode lets the picker read while a :gpt: run is writing.
+# SQLite builds without FTS5 still work: search then falls back to LIKE.
+INDEX_PATH = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "conversations.sqlite3")
+SCHEMA_VERSION = 1
+BUSY_TIMEOUT_MS = 5000
+TITLE_CHARS = 80
+PICKER_SIZE = int(os.environ.get("ESPANSO_GPT_PICKER_SIZE", 15)) # Recent conversations offered in the :gpt: form
+# Entries of the :gpt: form's CONVERSATION MODE list besides the recent conversations (see list_conversations.py)
+START_NEW = "Start New"
+CONTINUE_LAST = "Continue Last"
+SEARCH_HISTORY = "Search history..."
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    task TEXT,
+    language TEXT,
+    title TEXT,
+    created_at REAL,
+    updated_at REAL,
+    message_count INTEGER,
+    file_mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at DESC);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT,
+    text TEXT,
+    UNIQUE (conversation_id, position)
+);
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(text, content='turns', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS turns_ai AFTER INSERT ON turns BEGIN
+    INSERT INTO turns_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS turns_ad AFTER DELETE ON turns BEGIN
+    INSERT INTO turns_fts (turns_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+_has_fts = None
+
+def connect():
+    """Opens the index (creating or upgrading it as needed) in WAL mode."""
+    global _has_fts
+    os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+    connection = sqlite3.connect(INDEX_PATH, timeout=BUSY_TIMEOUT_MS / 1000)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL") # Durable enough for data that can be rebuilt from the files
+    if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        with connection:
+            for table in ("turns_fts", "turns", "conversations"):
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if _has_fts is not False:
+        try:
+            connection.executescript(FTS_SCHEMA)
+            _has_fts = True
+        except sqlite3.OperationalError as e:
+            print(f"WARN conversation_index: FTS5 unavailable ({e}); search falls back to LIKE", file=sys.stderr)
+            _has_fts = False
+    return connection
+
+def message_text(message):
+    """The searchable text of a message: its text content, or its text parts (images are skipped)."""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text")
+    return ""
+
+def _one_line(text, limit=TITLE_CHARS):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def _file_mtime_ns(conversation_id):
+    for path in (header_path(conversation_id), legacy_path(conversation_id)):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+    return None
+
+def index_conversation(connection, header, messages, first_new=0):
+    """Indexes a conversation's header and its messages from position first_new on (0 reindexes every message)."""
+    conversation_id = header["conversation_id"]
+    form_inputs = header.get("original_form_inputs") or {}
+    with connection:
+        if first_new == 0:
+            connection.execute("DELETE FROM turns WHERE conversation_id = ?", (conversation_id,))
+        else:
+            connection.execute("DELETE FROM turns WHERE conversation_id = ? AND position >= ?", (conversation_id, first_new))
+        connection.executemany(
+            "INSERT INTO turns (conversation_id, position, role, text) VALUES (?, ?, ?, ?)",
+            [(conversation_id, position, message.get("role"), message_text(message))
+             for position, message in enumerate(messages[first_new:], first_new) if message.get("role") != "system"])
+        title = connection.execute(
+            "SELECT text FROM turns WHERE conversation_id = ? AND role = 'user' ORDER BY position LIMIT 1",
+            (conversation_id,)).fetchone()
+        connection.execute(
+            "INSERT OR REPLACE INTO conversations (id, task, language, title, created_at, updated_at, message_count, file_mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (conversation_id, form_inputs.get("task_objective"), form_inputs.get("output_language"),
+             _one_line(title[0]) if title else "", header.get("created_at"),
+             header.get("last_updated_at") or header.get("created_at"), len(messages), _file_mtime_ns(conversation_id)))
+
+def remove_conversations(connection, conversation_ids):
+    """Drops conversations (e.g. deleted files) from the index."""
+    with connection:
+        for conversation_id in conversation_ids:
+            connection.execute("DELETE FROM turns WHERE conversation_id = ?", (conversation_id,))
+            connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+def update_on_save(header, messages, first_new):
+    """Called by conversation_store.save_conversation(); index errors never fail the save."""
+    try:
+        connection = connect()
+        try:
+            index_conversation(connection, header, messages, first_new)
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f"WARN conversation_index: Could not index {header.get('conversation_id')}: {e}", file=sys.stderr)
+
+def sync(connection=None):
+    """Brings the index in line with the files: indexes new or changed conversations, drops deleted ones.
+
+    Returns (indexed, removed).
+    """
+    own_connection = connection is None
+    connection = connection or connect()
+    try:
+        known = dict(connection.execute("SELECT id, file_mtime_ns FROM conversations"))
+        on_disk = list_conversation_ids()
+        indexed = 0
+        for conversation_id in on_disk:
+            mtime_ns = _file_mtime_ns(conversation_id)
+            if conversation_id in known and known[conversation_id] == mtime_ns:
+                continue
+            header = load_header(conversation_id)
+            if header is None:
+                continue
+            header.setdefault("conversation_id", conversation_id)
+            index_conversation(connection, header, list(iter_messages(conversation_id)))
+            indexed += 1
+        removed = set(known) - set(on_disk)
+        remove_conversations(connection, removed)
+        return indexed, len(removed)
+    finally:
+        if own_connection:
+            connection.close()
+
+def _row_to_dict(row):
+    return {"id": row[0], "task": row[1], "language": row[2], "title": row[3], "updated_at": row[4], "message_count": row[5]}
+
+def recent_conversations(limit=PICKER_SIZE, connection=None):
+    """Returns the most recently updated conversations, newest first."""
+    own_connection = connection is None
+    connection = connection or connect()
+    try:
+        if own_connection and connection.execute("SELECT 1 FROM conversations LIMIT 1").fetchone() is None:
+            sync(connection) # First use: index the conversations saved before the index existed
+        rows = connection.execute(
+            "SELECT id, task, language, title, updated_at, message_count FROM conversations "
+            "ORDER BY updated_at DESC LIMIT ?", (limit,))
+        return [_row_to_dict(row) for row in rows]
+    finally:
+        if own_connection:
+            connection.close()
+
+def _fts_query(query):
+    """Turns free text into an FTS5 query: every word must match, the last one as a prefix (it may still be typed)."""
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"' for word in words[:-1]) + (f' "{words[-1]}"*' if words else "")
+
+def search(query, limit=20, connection=None):
+    """Returns the conversations whose messages best match query, each with a "snippet" of the best match."""
+    own_connection = connection is None
+    connection = connection or connect()
+    try:
+        fts_query = _fts_query(query)
+        if not fts_query:
+            return recent_conversations(limit, connection)
+        columns = "c.id, c.task, c.language, c.title, c.updated_at, c.message_count"
+        if _has_fts:
+            rows = connection.execute(
+                f"SELECT {columns}, snippet(turns_fts, 0, '[', ']', '…', 10) FROM turns_fts "
+                "JOIN turns t ON t.id = turns_fts.rowid JOIN conversations c ON c.id = t.conversation_id "
+                "WHERE turns_fts MATCH ? ORDER BY rank LIMIT ?", (fts_query, limit * 5))
+        else:
+            rows = connection.execute(
+                f"SELECT {columns}, substr(t.text, 1, 120) FROM turns t JOIN conversations c ON c.id = t.conversation_id "
+                "WHERE t.text LIKE ? ORDER BY c.updated_at DESC LIMIT ?", (f"%{query.strip()}%", limit * 5))
+        results = {}
+        for row in rows: # Best match first; one result per conversation
+            if row[0] not in results:
+                results[row[0]] = dict(_row_to_dict(row), snippet=_one_line(row[6], 160))
+                if len(results) == limit:
+                    break
+        return list(results.values())
+    finally:
+        if own_connection:
+            connection.close()
+
+def format_choice(conversation):
+    """One conversation as an entry of the :gpt: form's CONVERSATION MODE list (the ID is parsed back by parse_choice)."""
+    updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(conversation["updated_at"] or 0))
+    task = conversation["task"] or "Conversation"
+    return f"{updated} · {task} · {conversation['title'] or '(no message)'} (#{conversation['id']})"
+
+def parse_choice(choice):
+    """The conversation ID in a format_choice() entry, or None."""
+    match = re.search(r"\(#([^()\s]+)\)$", choice.strip())
+    return match.group(1) if match else None
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "sync":
+        started_at = time.time()
+        indexed, removed = sync()
+        print(f"Indexed {indexed} conversation(s), removed {removed}, in {time.time() - started_at:.2f}s ({INDEX_PATH})")
+
+    elif command == "rebuild":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(INDEX_PATH + suffix):
+                os.remove(INDEX_PATH + suffix)
+        indexed, _ = sync()
+        print(f"Indexed {indexed} conversation(s) ({INDEX_PATH})")
+
+    elif command == "recent":
+        for conversation in recent_conversations(int(sys.argv[2]) if len(sys.argv) > 2 else PICKER_SIZE):
+            print(format_choice(conversation))
+
+    elif command == "search" and len(sys.argv) > 2:
+        for conversation in search(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 20):
+            print(format_choice(conversation))
+            print(f"    {conversation['snippet']}")
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  conversation_index.py sync                   # Index new/changed conversation files, drop deleted ones", file=sys.stderr)
+        print("  conversation_index.py rebuild                # Recreate the index from the files", file=sys.stderr)
+        print("  conversation_index.py recent [n]", file=sys.stderr)
+        print("  conversation_index.py search \"<words>\" [n]", file=sys.stderr)
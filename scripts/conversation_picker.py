@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import sys
+
+from conversation_index import connect, search, recent_conversations, format_choice
+
+# The "Search history..." window of the :gpt: form: a search box over every saved
+# conversation (full-text, through the SQLite index in conversation_index.py) and the
+# matching conversations below it, best match first. Typing re-runs the search after a
+# short pause; Enter or a click picks, Escape cancels (a new conversation is started).
+SEARCH_DELAY_MS = 150
+RESULT_LIMIT = 30
+WINDOW_WIDTH = 760
+WINDOW_HEIGHT = 560
+
+def pick_conversation():
+    """Shows the search window and returns the picked conversation ID, or None."""
+    try:
+        import customtkinter
+        root = customtkinter.CTk()
+    except Exception as e: # No display (or no customtkinter)
+        print(f"conversation_picker: cannot open the picker ({e}); starting a new conversation", file=sys.stderr)
+        return None
+
+    connection = connect() # One connection for every keystroke
+    picked = {"id": None, "pending": None, "results": []}
+    root.title("Continue a conversation")
+    root.attributes("-topmost", True)
+    x = (root.winfo_screenwidth() // 2) - (WINDOW_WIDTH // 2)
+    y = (root.winfo_screenheight() // 2) - (WINDOW_HEIGHT // 2)
+    root.geometry(f"{WINDOW_WIDTH}x{WINDOW_HEIGHT}+{x}+{y}")
+
+    def pick(conversation_id):
+        picked["id"] = conversation_id
+        if picked["pending"]:
+            root.after_cancel(picked["pending"])
+        root.destroy()
+
+    query_entry = customtkinter.CTkEntry(root, placeholder_text="Search your conversations")
+    query_entry.pack(padx=10, pady=(12, 6), fill="x")
+    results_frame = customtkinter.CTkScrollableFrame(root)
+    results_frame.pack(padx=10, pady=(0, 10), fill="both", expand=True)
+
+    def show_results():
+        picked["pending"] = None
+        query = query_entry.get()
+        picked["results"] = search(query, RESULT_LIMIT, connection) if query.strip() else recent_conversations(RESULT_LIMIT, connection)
+        for child in results_frame.winfo_children():
+            child.destroy()
+        if not picked["results"]:
+            customtkinter.CTkLabel(results_frame, text="No conversation matches.").pack(pady=10)
+        for conversation in picked["results"]:
+            text = format_choice(conversation)
+            if conversation.get("snippet"):
+                text += f"\n{conversation['snippet']}"
+            customtkinter.CTkButton(results_frame, text=text, anchor="w", fg_color="transparent", border_width=1,
+                                    command=lambda conversation_id=conversation["id"]: pick(conversation_id)).pack(pady=3, padx=5, fill="x")
+
+    def schedule_search(event=None):
+        if picked["pending"]:
+            root.after_cancel(picked["pending"])
+        picked["pending"] = root.after(SEARCH_DELAY_MS, show_results)
+
+    query_entry.bind("<KeyRelease>", schedule_search)
+    query_entry.bind("<Return>", lambda event: pick(picked["results"][0]["id"]) if picked["results"] else None)
+    root.bind("<Escape>", lambda event: pick(None))
+    root.protocol("WM_DELETE_WINDOW", lambda: pick(None))
+
+    try:
+        show_results()
+        query_entry.focus_force()
+        root.mainloop()
+    finally:
+        connection.close()
+    return picked["id"]
+
+if __name__ == "__main__":
+    print(pick_conversation() or "")
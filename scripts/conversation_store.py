@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import gzip
+
+# Each conversation is stored as two files in gpt_tools/context/:
+#   <id>.header.json     - metadata (everything except the messages), small and rewritten on save
+#   <id>.messages.jsonl  - one JSON record per message, only ever appended to
+# so saving a turn costs the size of the new messages, not of the whole history.
+# Older conversations saved as a single <id>.json are still read, and are
+# converted on their next save (or by the compact command).
+# Every save also updates the SQLite index used to search and pick conversations
+# (conversation_index.py).
+# Cold conversations can have their log gzip-compressed to <id>.messages.jsonl.gz
+# (context_retention.py does it); it is read back transparently, and decompressed again
+# when the conversation is continued.
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
+CONTEXT_DIR_NAME = "gpt_tools/context"
+CONTEXT_DIR_PATH = os.path.join(CONFIG_DIR, CONTEXT_DIR_NAME)
+
+HEADER_SUFFIX = ".header.json"
+MESSAGES_SUFFIX = ".messages.jsonl"
+COMPRESSED_SUFFIX = ".messages.jsonl.gz"
+LEGACY_SUFFIX = ".json"
+
+def ensure_context_dir():
+    os.makedirs(CONTEXT_DIR_PATH, exist_ok=True)
+
+def header_path(conversation_id):
+    return os.path.join(CONTEXT_DIR_PATH, f"{conversation_id}{HEADER_SUFFIX}")
+
+def messages_path(conversation_id):
+    return os.path.join(CONTEXT_DIR_PATH, f"{conversation_id}{MESSAGES_SUFFIX}")
+
+def compressed_path(conversation_id):
+    return os.path.join(CONTEXT_DIR_PATH, f"{conversation_id}{COMPRESSED_SUFFIX}")
+
+def legacy_path(conversation_id):
+    return os.path.join(CONTEXT_DIR_PATH, f"{conversation_id}{LEGACY_SUFFIX}")
+
+def conversation_paths(conversation_id):
+    """Every file a conversation can have, in any format."""
+    return [header_path(conversation_id), messages_path(conversation_id), compressed_path(conversation_id),
+            legacy_path(conversation_id)]
+
+def conversation_bytes(conversation_id):
+    """Bytes on disk of one conversation (all its files)."""
+    return sum(os.path.getsize(p) for p in conversation_paths(conversation_id) if os.path.exists(p))
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _serialize_message(message):
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def _load_legacy(conversation_id):
+    try:
+        with open(legacy_path(conversation_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_header(conversation_id):
+    """Returns the conversation metadata without reading any messages, or None if unknown."""
+    try:
+        with open(header_path(conversation_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        legacy = _load_legacy(conversation_id)
+        if legacy is None:
+            return None
+        header = {k: v for k, v in legacy.items() if k != "messages"}
+        header["message_count"] = len(legacy.get("messages", []))
+        return header
+
+def iter_messages(conversation_id):
+    """Yields the messages of a conversation one at a time by replaying its log."""
+    path = messages_path(conversation_id)
+    if not os.path.exists(path):
+        path = compressed_path(conversation_id)
+    if not os.path.exists(path):
+        legacy = _load_legacy(conversation_id)
+        for message in (legacy or {}).get("messages", []):
+            yield message
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A torn last line (e.g. crash mid-append) is skipped; compaction drops it for good.
+                print(f"WARN conversation_store: Skipping unreadable record in {path}", file=sys.stderr)
+
+def load_conversation(conversation_id):
+    """Returns the full conversation object (header fields plus "messages"), or None if unknown."""
+    header = load_header(conversation_id)
+    if header is None:
+        return None
+    conversation = dict(header)
+    conversation["messages"] = list(iter_messages(conversation_id))
+    conversation.pop("message_count", None)
+    return conversation
+
+def _rewrite_messages(conversation_id, messages):
+    path = messages_path(conversation_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for message in messages:
+            f.write(_serialize_message(message))
+    os.replace(tmp_path, path)
+
+def save_conversation(conversation_object):
+    """Persists a conversation, appending only the messages added since the last save."""
+    ensure_context_dir()
+    conversation_id = conversation_object["conversation_id"]
+    messages = conversation_object.get("messages", [])
+    if os.path.exists(compressed_path(conversation_id)):
+        decompress_conversation(conversation_id) # Continued: it is no longer cold
+    previous_header = None
+    if os.path.exists(messages_path(conversation_id)):
+        try:
+            with open(header_path(conversation_id), "r", encoding="utf-8") as f:
+                previous_header = json.load(f)
+        except (OSError, ValueError):
+            previous_header = None
+    persisted_count = previous_header.get("message_count") if previous_header else None
+
+    if persisted_count is not None and persisted_count <= len(messages):
+        first_new = persisted_count
+        new_messages = messages[persisted_count:]
+        if new_messages:
+            with open(messages_path(conversation_id), "a", encoding="utf-8") as f:
+                f.write("".join(_serialize_message(m) for m in new_messages))
+    else:
+        # First save, legacy conversation, or history that shrank: write the log from scratch.
+        first_new = 0
+        _rewrite_messages(conversation_id, messages)
+
+    header = {k: v for k, v in conversation_object.items() if k != "messages"}
+    header["message_count"] = len(messages)
+    _write_json_atomic(header_path(conversation_id), header)
+
+    if os.path.exists(legacy_path(conversation_id)):
+        os.remove(legacy_path(conversation_id))
+
+    # Keep the search/picker index (conversation_index.py) current with just the new messages
+    from conversation_index import update_on_save
+    update_on_save(header, messages, first_new)
+
+def list_conversation_ids():
+    """Returns the IDs of all stored conversations (both formats)."""
+    ids = set()
+    if not os.path.isdir(CONTEXT_DIR_PATH):
+        return []
+    for name in os.listdir(CONTEXT_DIR_PATH):
+        if name.endswith(COMPRESSED_SUFFIX):
+            ids.add(name[:-len(COMPRESSED_SUFFIX)])
+        elif name.endswith(HEADER_SUFFIX):
+            ids.add(name[:-len(HEADER_SUFFIX)])
+        elif name.endswith(MESSAGES_SUFFIX):
+            ids.add(name[:-len(MESSAGES_SUFFIX)])
+        elif name.endswith(LEGACY_SUFFIX):
+            ids.add(name[:-len(LEGACY_SUFFIX)])
+    return sorted(ids)
+
+def compact_conversation(conversation_id):
+    """Rewrites one conversation's log from its replay (dropping torn records, converting legacy files
+    and inline screenshots).
+
+    Returns (bytes_before, bytes_after).
+    """
+    bytes_before = conversation_bytes(conversation_id)
+    was_compressed = os.path.exists(compressed_path(conversation_id))
+    conversation = load_conversation(conversation_id)
+    if conversation is None:
+        return bytes_before, bytes_before
+    # Move inline base64 screenshots out to the blob store (gpt_tools/blobs/)
+    from blob_store import externalize_images
+    conversation["messages"] = externalize_images(conversation["messages"])
+    _rewrite_messages(conversation_id, conversation["messages"])
+    header = {k: v for k, v in conversation.items() if k != "messages"}
+    header["message_count"] = len(conversation["messages"])
+    _write_json_atomic(header_path(conversation_id), header)
+    for path in (legacy_path(conversation_id), compressed_path(conversation_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    if was_compressed:
+        compress_conversation(conversation_id)
+    return bytes_before, conversation_bytes(conversation_id)
+
+def compress_conversation(conversation_id):
+    """Gzips a conversation's message log (the header stays plain JSON). Returns (bytes_before, bytes_after)."""
+    bytes_before = conversation_bytes(conversation_id)
+    path = messages_path(conversation_id)
+    if not os.path.exists(path):
+        return bytes_before, bytes_before # Already compressed, or a legacy file (compact converts it first)
+    target = compressed_path(conversation_id)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with open(path, "rb") as source, gzip.open(tmp_path, "wb") as f:
+        f.write(source.read())
+    os.replace(tmp_path, target)
+    os.remove(path) # Readers fall back to the .gz once the plain log is gone
+    return bytes_before, conversation_bytes(conversation_id)
+
+def decompress_conversation(conversation_id):
+    """Turns a compressed message log back into the plain, appendable one."""
+    source = compressed_path(conversation_id)
+    path = messages_path(conversation_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(source, "rb") as f, open(tmp_path, "wb") as target:
+        target.write(f.read())
+    os.replace(tmp_path, path)
+    os.remove(source)
+
+def delete_conversation(conversation_id):
+    """Removes every file of a conversation and returns the bytes freed."""
+    freed = 0
+    for path in conversation_paths(conversation_id):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except OSError:
+            pass
+    return freed
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "compact":
+        conversation_ids = sys.argv[2:] or list_conversation_ids()
+        total_before = total_after = 0
+        for conversation_id in conversation_ids:
+            before, after = compact_conversation(conversation_id)
+            total_before += before
+            total_after += after
+            print(f"{conversation_id}: {before} -> {after} bytes")
+        print(f"Compacted {len(conversation_ids)} conversation(s): {total_before} -> {total_after} bytes")
+
+    elif command == "show" and len(sys.argv) > 2:
+        conversation = load_conversation(sys.argv[2])
+        print(json.dumps(conversation, indent=2, ensure_ascii=False) if conversation else "Conversation not found.")
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  conversation_store.py compact [conversation_id ...]", file=sys.stderr)
+        print("  conversation_store.py show <conversation_id>", file=sys.stderr)
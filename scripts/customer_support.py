@@ -1,120 +1,68 @@
 #!/usr/bin/env python3
+import metrics # First, so its clock starts as close to process start as possible
 import os, sys
 import io
-import tempfile
-import tkinter as tk
-import threading
+
+if __name__ == "__main__":
+    # Hand the run to the warm daemon when it is up (see gpt_daemon.py); otherwise run in-process below.
+    from daemon_client import delegate_to_daemon
+    if delegate_to_daemon("customer_support", sys.argv[1:]):
+        sys.exit(0)
+
 import time
 
 # Enable debug mode for troubleshooting
 DEBUG_MODE = True
 
-try:
-    import pyautogui
-except ImportError:
-    print("pyautogui not found. Please install it with 'pip install pyautogui'.")
-    sys.exit(1)
-from dotenv import load_dotenv
-import base64, mimetypes
-from openai import OpenAI
-from PIL import Image, UnidentifiedImageError
-
-# --- Loading Popup Configuration (Copied from text_processor.py) ---
-loading_popup_obj = {'root': None, 'label': None, 'running': False, 'char_index': 0}
-spinner_chars = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"] # Unicode Braille spinner
-
-def _spinner_update():
-    if not loading_popup_obj.get('running') or not loading_popup_obj.get('label'):
-        return
-    char = spinner_chars[loading_popup_obj['char_index']]
-    try:
-        if loading_popup_obj['label']: # Check if label still exists
-             loading_popup_obj['label'].config(text=f"Processing {char}")
-    except tk.TclError: # Handle cases where the widget might be destroyed prematurely
-        loading_popup_obj['running'] = False 
-        return
-
-    loading_popup_obj['char_index'] = (loading_popup_obj['char_index'] + 1) % len(spinner_chars)
-    
-    if loading_popup_obj.get('root') and loading_popup_obj.get('running'):
-        try:
-            loading_popup_obj['root'].after(120, _spinner_update) # Schedule next update
-        except tk.TclError: # Handle cases where the root window might be destroyed
-             loading_popup_obj['running'] = False
-
-def show_loading_popup_in_thread():
-    try:
-        root = tk.Tk()
-        loading_popup_obj['root'] = root
-        root.title("Processing")
-        root.geometry("220x70")
-        root.resizable(False, False)
-        root.attributes('-topmost', True)
-        root.overrideredirect(True) # No window decorations
-
-        screen_width = root.winfo_screenwidth()
-        screen_height = root.winfo_screenheight()
-        x = (screen_width // 2) - (220 // 2)
-        y = (screen_height // 2) - (70 // 2)
-        root.geometry(f"+{x}+{y}")
-
-        frame = tk.Frame(root, background='#f0f0f0', padx=10, pady=10)
-        frame.pack(expand=True, fill=tk.BOTH)
-
-        label = tk.Label(frame, text="Processing...", font=("Arial", 11), background='#f0f0f0')
-        label.pack(pady=10, expand=True)
-        loading_popup_obj['label'] = label
-        loading_popup_obj['running'] = True
-        loading_popup_obj['char_index'] = 0
+from openai_client import API_KEY, prewarm_client, complete_with_continuation
+from context_window import output_token_budget
+from faq_index import faq_context
+from screen_capture import start_capture, wait_for_capture, to_data_url
+from loading_popup import start_loading_popup, stop_loading_popup
 
-        _spinner_update()
-        root.mainloop()
-    except Exception as e:
-        print(f"Error in loading popup thread: {e}", file=sys.stderr)
-    finally:
-        loading_popup_obj['root'] = None
-        loading_popup_obj['label'] = None
-        loading_popup_obj['running'] = False
-# --- End Loading Popup Configuration ---
-
-# Ensure stdout is UTF-8 encoded
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf8')
-
-# charge la clé API depuis .env placé dans CE dossier
-load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
-API_KEY = os.getenv("OPENAI_API_KEY")
 if not API_KEY:
     sys.exit("OPENAI_API_KEY manquante dans .env")
 
-# Initialize OpenAI client
-client = OpenAI(api_key=API_KEY)
-
-if __name__ == "__main__":
-    # Start loading popup
-    loading_thread = threading.Thread(target=show_loading_popup_in_thread, daemon=True)
-    loading_thread.start()
-    time.sleep(0.3) # Brief pause for popup to appear
+# Replies are sized from the customer's message and the answer sketch (see
+# context_window.output_token_budget); a reply that hits the budget is continued.
+REPLY_TOKEN_POLICY = {
+    "max_tokens": int(os.environ.get("ESPANSO_GPT_SUPPORT_MAX_TOKENS", 4000)),
+    "max_tokens_policy": {"ratio": 2.0, "floor": 384},
+}
+
+def run(args):
+    """Drafts one customer support reply for the form arguments and returns the text for Espanso."""
+    run_metrics = metrics.start_run("support", "customer_support")
+    prewarm_client() # Import openai in the background while the prompt is built
+    # Grab the screen right away (before the popup shows), in the background, while the
+    # FAQ and prompt are prepared; it is only waited for when the request is assembled.
+    screenshot_future = None
+    if len(args) == 7 and args[4].lower() == 'true':
+        screenshot_future = start_capture()
+
+    # Only becomes visible if the request is still running after ESPANSO_GPT_SPINNER_DELAY (see loading_popup.py)
+    popup = start_loading_popup()
 
     if DEBUG_MODE:
         print("DEBUG: customer_support.py script started", file=sys.stderr)
-        print(f"DEBUG: Command line args: {sys.argv}", file=sys.stderr)
+        print(f"DEBUG: Command line args: {args}", file=sys.stderr)
 
     final_output = "" # Variable to hold the final text to be printed by Espanso
     try:
         # Args: sentiment, relation, selected_faq_filename, target_language, include_screenshot, user_message_text, desired_answer_sketch
-        if len(sys.argv) != 8:
+        if len(args) != 7:
             error_message = "Usage: python customer_support.py <sentiment> <relation> <faq_file> <target_language> <include_screenshot> \"<user_message>\" [\"<desired_answer_sketch>\"]"
             print(error_message, file=sys.stderr)
             final_output = f"Error: {error_message}"
             # sys.exit(1) # Don't exit yet, let finally close popup
         else:
-            sentiment = sys.argv[1]
-            relation = sys.argv[2]
-            selected_faq_filename = sys.argv[3]
-            target_language = sys.argv[4]
-            include_screenshot_str = sys.argv[5]
-            user_message_from_arg = sys.argv[6]
-            desired_answer_sketch_from_arg = sys.argv[7]
+            sentiment = args[0]
+            relation = args[1]
+            selected_faq_filename = args[2]
+            target_language = args[3]
+            include_screenshot_str = args[4]
+            user_message_from_arg = args[5]
+            desired_answer_sketch_from_arg = args[6]
 
             if DEBUG_MODE:
                 print(f"DEBUG: Parsed arguments:", file=sys.stderr)
@@ -126,8 +74,6 @@ if __name__ == "__main__":
                 print(f"DEBUG:   user_message_from_arg (first 50 chars): {user_message_from_arg[:50]}...", file=sys.stderr)
                 print(f"DEBUG:   desired_answer_sketch_from_arg (first 50 chars): {desired_answer_sketch_from_arg[:50]}...", file=sys.stderr)
 
-            include_screenshot = include_screenshot_str.lower() == 'true'
-
             if not user_message_from_arg.strip():
                 print("Input text from form is empty.", file=sys.stderr)
                 final_output = "" # Empty output for Espanso if no input
@@ -137,91 +83,9 @@ if __name__ == "__main__":
                 # building prompts, and calling OpenAI client goes.
                 # For brevity, it's represented here, but it should be the full logic.
                 
-                screenshot_path = None # Initialize for the note logic
-                image_message = None # Initialize for payload construction
-
-                if include_screenshot:
-                    if DEBUG_MODE:
-                        print("DEBUG: Taking screenshot...", file=sys.stderr)
-                    try:
-                        # ... (Full screenshot taking, resizing, optimizing, JPEG conversion logic) ...
-                        # This part creates screenshot_path and image_message if successful
-                        # For this example, let's assume it populates image_message and screenshot_path correctly.
-                        # Make sure your actual screenshot code is here.
-                        # Example placeholder for where your screenshot code that sets image_message would be:
-                        # if screenshot_is_successfully_processed:
-                        #    image_message = { ... details ... }
-                        #    screenshot_path = "path/to/temp_screenshot.png_or_jpg"
-                        # else:
-                        #    print("Screenshot failed.", file=sys.stderr)
-                        #    screenshot_path = None
-                        #    image_message = None
-                        
-                        # --- Paste actual screenshot logic here from your script ---
-                        # For the purpose of this edit, I'll assume it results in image_message and screenshot_path being set.
-                        # This is a simplified representation of your complex screenshot logic.
-                        # The actual, full screenshot logic from your script should be here.
-                        # Initialize to simulate no screenshot if not implemented here for brevity
-                        temp_screenshot_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-                        screenshot_path = temp_screenshot_file.name
-                        temp_screenshot_file.close()
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Created temp file for screenshot: {screenshot_path}", file=sys.stderr)
-                        
-                        pyautogui.screenshot(screenshot_path)
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Screenshot taken and saved to temp file", file=sys.stderr)
-                        
-                        img = Image.open(screenshot_path)
-                        original_format = img.format
-                        current_mime_type = f"image/{original_format.lower() if original_format else 'png'}"
-                        width, height = img.size
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Original screenshot dimensions: {width}x{height}", file=sys.stderr)
-                        
-                        new_width = int(width * 0.5); new_height = int(height * 0.5)
-                        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Resized screenshot to: {new_width}x{new_height}", file=sys.stderr)
-                        
-                        img.save(screenshot_path, format="PNG", optimize=True)
-                        current_mime_type = "image/png"
-                        file_size_bytes = os.path.getsize(screenshot_path)
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Saved optimized PNG, size: {file_size_bytes} bytes", file=sys.stderr)
-                        
-                        max_size_bytes = 19 * 1024 * 1024
-                        if file_size_bytes > max_size_bytes:
-                            if DEBUG_MODE:
-                                print(f"DEBUG: Resized PNG > 19MB. Converting to JPEG.", file=sys.stderr)
-                            if img.mode == 'RGBA' or img.mode == 'P': img = img.convert('RGB')
-                            img.save(screenshot_path, format="JPEG", quality=85, optimize=True)
-                            current_mime_type = "image/jpeg"
-                            if DEBUG_MODE:
-                                print(f"DEBUG: Saved as JPEG, new size: {os.path.getsize(screenshot_path)} bytes", file=sys.stderr)
-                        
-                        with open(screenshot_path, "rb") as img_file_data:
-                            image_data = img_file_data.read()
-                        base64_image = base64.b64encode(image_data).decode("utf-8")
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Converted image to base64, length: {len(base64_image)}", file=sys.stderr)
-                        
-                        image_message = {"type": "image_url", "image_url": {"url": f"data:{current_mime_type};base64,{base64_image}"}}
-                        if DEBUG_MODE:
-                            print(f"DEBUG: Created image message for API with MIME type: {current_mime_type}", file=sys.stderr)
-                        # --- End of pasted screenshot logic placeholder ---
-
-                    except Exception as e_screenshot:
-                        print(f"Failed to take/process screenshot: {e_screenshot}", file=sys.stderr)
-                        screenshot_path = None
-                        image_message = None
-                
-                # Base system prompt - Modified to incorporate target_language
-                base_system_prompt_intro = f"You are a concise, friendly customer support agent. Your response must be in {target_language}."
-                if target_language.lower() == "french":
-                    base_system_prompt_intro += " Use Canadian French unless specified otherwise."
-                
-                system_prompt_content = f"""{base_system_prompt_intro}
+                # The system prompt is laid out for the provider's prompt cache (exact prefix match):
+                # the fixed guidelines and a whole (small) FAQ first, the language instruction and retrieved FAQ sections last.
+                system_prompt_content = """You are a concise, friendly customer support agent.
 Be clear, concise, and well-written, using a 7th-grade level vocabulary and sentence structure.
 The input may come from speech recognition, so if you encounter unusual phrasing, infer the intended meaning.
 Always respect the original language of the input unless a specific output language is requested.
@@ -232,28 +96,42 @@ Use natural punctuation (e.g., !, ?, ..., —), ensuring there are no spaces bef
 NEVER ask for more context; Just use your judgment.
 """
                 
+                faq_note = """\n---
+            If the question of the user is in the FAQ, DO NOT DEVIATE from the FAQ.
+            If the question is not in the FAQ, answer the question based on your knowledge and the context provided.
+            DO NOT make any assumptions about company policy or troubleshooting procedures."""
+                retrieved_faq = ""
                 if selected_faq_filename != "None" and selected_faq_filename.strip() != "":
-                    faq_file_path = os.path.join(os.path.dirname(__file__), "..", "markdown", selected_faq_filename)
                     if DEBUG_MODE:
-                        print(f"DEBUG: Looking for FAQ file at: {faq_file_path}", file=sys.stderr)
+                        print(f"DEBUG: Looking up FAQ: {selected_faq_filename}", file=sys.stderr)
                     try:
-                        with open(faq_file_path, 'r', encoding='utf-8') as f_faq:
-                            faq_content = f_faq.read()
+                        # Same gpt_tools/faq/ files that list_faq_files.py offers in the form. Small files come
+                        # back whole; large ones (and "All FAQs") only as the sections matching the message.
+                        with run_metrics.span("faq_read"):
+                            faq_content, faq_is_full = faq_context(selected_faq_filename,
+                                                                   f"{user_message_from_arg}\n{desired_answer_sketch_from_arg}")
                         if DEBUG_MODE:
-                            print(f"DEBUG: Successfully loaded FAQ: {selected_faq_filename} ({len(faq_content)} chars)", file=sys.stderr)
-                        system_prompt_content += "\n\nFor your reference, here is some relevant FAQ information:\n---\n" + faq_content + """\n--- 
-            If the question of the user is in the FAQ, DO NOT DEVIATE from the FAQ.
-            If the question is not in the FAQ, answer the question based on your knowledge and the context provided.
-            DO NOT make any assumptions about company policy or troubleshooting procedures."""
+                            print(f"DEBUG: FAQ {selected_faq_filename}: {'full file' if faq_is_full else 'retrieved sections'} ({len(faq_content)} chars)", file=sys.stderr)
+                        if faq_is_full:
+                            system_prompt_content += "\n\nFor your reference, here is some relevant FAQ information:\n---\n" + faq_content + faq_note
+                        elif faq_content:
+                            retrieved_faq = "\n\nFor your reference, here are the FAQ sections most relevant to this message:\n---\n" + faq_content + faq_note
                     except FileNotFoundError:
                         if DEBUG_MODE:
-                            print(f"DEBUG: FAQ file not found: {faq_file_path}", file=sys.stderr)
+                            print(f"DEBUG: FAQ file not found: {selected_faq_filename}", file=sys.stderr)
                         system_prompt_content += "\n\n(Note: The selected FAQ file '" + selected_faq_filename + "' was not found.)"
                     except Exception as e_faq:
                         if DEBUG_MODE:
                             print(f"DEBUG: Error reading FAQ file: {e_faq}", file=sys.stderr)
                         system_prompt_content += "\n\n(Note: Error reading FAQ file '" + selected_faq_filename + "': " + str(e_faq) + ")"
 
+                # Per-call parts last, so everything above is an identical prefix for a given FAQ
+                system_prompt_content += f"\n\nYour response must be in {target_language}."
+                if target_language.lower() == "french":
+                    system_prompt_content += " Use Canadian French unless specified otherwise."
+                system_prompt_content += retrieved_faq
+
+                prompt_started_at = time.time()
                 main_user_prompt_text = (
                     f"Réponds de façon {sentiment} à un·e {relation} en {target_language}.\\n\\n"
                     f"Message reçu :\\n« {user_message_from_arg} »\\n\\n"
@@ -271,6 +149,21 @@ NEVER ask for more context; Just use your judgment.
                         f"Desired Answer Sketch:\\n« {desired_answer_sketch_from_arg.strip()} »"
                     )
 
+                image_message = None # Initialize for payload construction
+                if screenshot_future is not None:
+                    if DEBUG_MODE:
+                        print("DEBUG: Waiting for background screenshot...", file=sys.stderr)
+                    # A slow or failed capture downgrades to a text-only request
+                    with run_metrics.span("screenshot_wait"):
+                        screenshot = wait_for_capture(screenshot_future)
+                    if screenshot:
+                        for stage, seconds in screenshot["timings"].items():
+                            run_metrics.add_span(f"screenshot_{stage}", seconds)
+                        image_message = {"type": "image_url", "image_url": {"url": to_data_url(screenshot)}}
+                        if DEBUG_MODE:
+                            timings = ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in screenshot["timings"].items())
+                            print(f"DEBUG: Screenshot {screenshot['width']}x{screenshot['height']} {screenshot['mime_type']}, {screenshot['bytes']} bytes ({timings})", file=sys.stderr)
+
                 user_message_list_content = []
                 user_message_list_content.append({"type": "text", "text": main_user_prompt_text})
 
@@ -278,15 +171,6 @@ NEVER ask for more context; Just use your judgment.
                     if DEBUG_MODE:
                         print("DEBUG: Including image message in API request", file=sys.stderr)
                     user_message_list_content.append(image_message)
-                elif screenshot_path:
-                    if DEBUG_MODE:
-                        print("DEBUG: Screenshot path exists but no image message, adding note to text", file=sys.stderr)
-                    text_part_found = False
-                    for part in user_message_list_content:
-                        if part["type"] == "text":
-                            part["text"] += f"\n\n(Note: A screenshot of the full screen was taken and saved at: {screenshot_path})"
-                            text_part_found = True; break
-                    if not text_part_found: user_message_list_content.append({"type": "text", "text": f"\n\n(Note: Screenshot at {screenshot_path})"})
                 
                 api_payload = {
                     "model": "gpt-4o-mini",
@@ -294,9 +178,11 @@ NEVER ask for more context; Just use your judgment.
                         {"role": "system", "content": system_prompt_content.strip()},
                         {"role": "user", "content": user_message_list_content if image_message else main_user_prompt_text}
                     ],
-                    "max_tokens": 4000,
+                    "max_tokens": output_token_budget(REPLY_TOKEN_POLICY, f"{user_message_from_arg}\n{desired_answer_sketch_from_arg}"),
                     "temperature": 0.6
                 }
+                run_metrics.add_span("prompt_render", time.time() - prompt_started_at - run_metrics.record["spans"].get("screenshot_wait", 0) / 1000)
+                run_metrics.set(model=api_payload["model"], max_tokens=api_payload["max_tokens"])
 
                 if DEBUG_MODE:
                     print(f"DEBUG: API payload prepared:", file=sys.stderr)
@@ -314,17 +200,21 @@ NEVER ask for more context; Just use your judgment.
                 if DEBUG_MODE:
                     print("DEBUG: Making API call to OpenAI...", file=sys.stderr)
                 
-                completion = client.chat.completions.create(
-                    model=api_payload["model"],
-                    messages=api_payload["messages"],
-                    max_tokens=api_payload["max_tokens"],
-                    temperature=api_payload["temperature"]
-                )
+                # Deadline, retries and optional hedging (see openai_client.py)
+                with run_metrics.span("api"):
+                    content, usage = complete_with_continuation(
+                        api_payload["model"],
+                        api_payload["messages"],
+                        max_tokens=api_payload["max_tokens"],
+                        continue_max_tokens=REPLY_TOKEN_POLICY["max_tokens"],
+                        temperature=api_payload["temperature"]
+                    )
+                run_metrics.add_usage(usage)
                 
                 if DEBUG_MODE:
                     print("DEBUG: API call completed successfully", file=sys.stderr)
                 
-                content = completion.choices[0].message.content.strip()
+                content = content.strip()
                 if len(content) >= 2 and content.startswith('"') and content.endswith('"'):
                     content = content[1:-1]
                 
@@ -336,19 +226,22 @@ NEVER ask for more context; Just use your judgment.
 
     except Exception as e_main:
         final_output = f"Script Error: {e_main}"
+        run_metrics.set(ok=False, error=type(e_main).__name__)
         print(f"Error in main script execution: {e_main}", file=sys.stderr)
     
     finally:
-        if loading_popup_obj.get('root'):
-            loading_popup_obj['running'] = False
-            try:
-                loading_popup_obj['root'].after(0, loading_popup_obj['root'].destroy)
-            except tk.TclError:
-                pass # Window might already be destroyed
-        if loading_thread.is_alive():
-            loading_thread.join(timeout=0.5)
+        # Closes the spinner (or cancels it before it ever shows) without waiting for it
+        with run_metrics.span("output"):
+            run_metrics.set(spinner_shown=stop_loading_popup(popup))
+        run_metrics.finish()
 
     if DEBUG_MODE:
         print("DEBUG: Script execution completed, printing final output", file=sys.stderr)
 
-    print(final_output)
+    return final_output
+
+if __name__ == "__main__":
+    # Ensure stdout is UTF-8 encoded
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf8')
+    metrics.mark_imports_done()
+    print(run(sys.argv[1:]))
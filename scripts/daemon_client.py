@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import os
+import sys
+import io
+import json
+import socket
+
+# Kept free of heavy imports on purpose: this module runs before the scripts load
+# openai/tkinter/PIL, so that a warm daemon can answer without paying that cost.
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
+DAEMON_INFO_PATH = os.path.join(CONFIG_DIR, "gpt_tools", "daemon.json")
+CONNECT_TIMEOUT_SECONDS = 0.2
+
+def read_daemon_info():
+    """Returns the {port, token, pid} record written by a running daemon, or None."""
+    try:
+        with open(DAEMON_INFO_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def send_request(request, info=None):
+    """Sends one request to the daemon and returns its decoded reply, or None if the daemon is unreachable."""
+    info = info or read_daemon_info()
+    if not info:
+        return None
+    try:
+        sock = socket.create_connection(("127.0.0.1", info["port"]), timeout=CONNECT_TIMEOUT_SECONDS)
+    except (OSError, KeyError):
+        return None
+    try:
+        # Requests can legitimately take as long as the API call (or a dialog), so only the connect
+        # is bounded; the daemon never queues a request behind another (it replies "busy" instead).
+        sock.settimeout(None)
+        payload = dict(request, token=info.get("token"))
+        sock.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b"".join(chunks).decode("utf-8"))
+    except (OSError, ValueError) as e:
+        print(f"daemon_client: request to daemon failed: {e}", file=sys.stderr)
+        return None
+    finally:
+        sock.close()
+
+def delegate_to_daemon(script_name, args, state=None):
+    """Runs a script inside the warm daemon and prints its output.
+
+    Returns True when the daemon handled the run, False when the caller should
+    fall back to in-process execution.
+    """
+    if os.environ.get("ESPANSO_GPT_NO_DAEMON"):
+        return False
+    reply = send_request({"script": script_name, "args": list(args), "state": state})
+    if not reply or not reply.get("ok"):
+        if reply and reply.get("busy"):
+            print(f"daemon_client: {reply.get('error')}, running in-process", file=sys.stderr)
+        elif reply:
+            print(f"daemon_client: daemon error, running in-process: {reply.get('error')}", file=sys.stderr)
+        return False
+    if sys.stdout.encoding != 'utf-8':
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    print(reply.get("output", ""))
+    return True
+
+def spawn_detached(args):
+    """Starts a Python script in the background, detached from this process and its output pipes.
+
+    Espanso waits for a script var's stdout to close, so a child holding it would keep the form from opening.
+    """
+    import subprocess # Only needed on this path
+    options = {"stdin": subprocess.DEVNULL, "stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    if os.name == "nt":
+        options["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        options["start_new_session"] = True
+    subprocess.Popen([sys.executable] + list(args), **options)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import zlib
+import functools
+import threading
+import importlib
+
+import numpy as np # Optional dependency: faq_index.py falls back to BM25 when it is missing
+
+from faq_index import CONFIG_DIR, TOP_K, load_index, tokenize
+
+# Semantic FAQ search (ESPANSO_GPT_FAQ_SEARCH=semantic), for customer messages that paraphrase
+# the FAQ instead of sharing its words. It uses the same sections as faq_index.py; each one is
+# embedded once and stored as a row of a float32 matrix in gpt_tools/cache/faq_embeddings/,
+# memory-mapped for queries, which are scored with one matrix-vector product (rows are unit
+# length, so that is the cosine similarity).
+#
+# The store is append-only: when an FAQ file changes, only its sections are embedded and
+# appended, and the sidecar meta.json (file -> row range) is swapped to point at them. Rows of
+# changed or deleted files are left behind until they outnumber the live ones; then the live
+# rows are copied to a new vectors.<generation>.f32 file. Meta is always written last, so an
+# interrupted update just leaves unused rows.
+#
+# The embedding function is pluggable: ESPANSO_GPT_FAQ_EMBEDDER is "hashing" (the default, a
+# local baseline that needs no network or model: hashed words and character trigrams, with the
+# query weighted by each dimension's IDF over the stored sections) or "module:function" for any
+# callable that takes a list of texts and returns an (n, dim) array.
+# Changing the embedder (or its dimension) re-embeds everything.
+STORE_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "faq_embeddings")
+META_PATH = os.path.join(STORE_DIR, "meta.json")
+STORE_VERSION = 1
+EMBEDDER = os.environ.get("ESPANSO_GPT_FAQ_EMBEDDER", "hashing")
+HASH_DIM = int(os.environ.get("ESPANSO_GPT_FAQ_HASH_DIM", 1024))
+MIN_SIMILARITY = 0.05 # Sections below this share nothing meaningful with the message
+EMBED_BATCH = 256
+
+_store_memo = {"meta_mtime_ns": None, "store": None}
+_embedder_memo = {}
+
+@functools.lru_cache(maxsize=65536)
+def _term_features(term):
+    """The hashed features of one word: the word itself and its character trigrams, as (crc32, weight)."""
+    padded = f"<{term}>"
+    trigrams = [padded[index:index + 3] for index in range(len(padded) - 2)]
+    weight = 1.0 / math.sqrt(len(trigrams)) # A word's trigrams weigh as much as the word itself
+    # Inflections and typos still share most trigrams
+    return ((zlib.crc32(term.encode("utf-8")), 1.0),) + tuple((zlib.crc32(f"#{trigram}".encode("utf-8")), weight) for trigram in trigrams)
+
+def hashing_embedder(texts, dim=HASH_DIM):
+    """Offline baseline: signed feature hashing of words and their character trigrams, with sublinear counts."""
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        features = {}
+        for term in tokenize(text):
+            for hashed, weight in _term_features(term):
+                features[hashed] = features.get(hashed, 0) + weight
+        hashes = np.fromiter(features.keys(), dtype=np.uint32, count=len(features))
+        values = np.log1p(np.fromiter(features.values(), dtype=np.float32, count=len(features)))
+        np.add.at(matrix[row], hashes % dim, np.where(hashes & 0x80000000, values, -values))
+    return matrix
+
+def get_embedder(spec=EMBEDDER):
+    """Returns the embedding function named by spec ("hashing" or "module:function")."""
+    if spec == "hashing":
+        return hashing_embedder
+    if spec not in _embedder_memo:
+        module_name, _, function_name = spec.partition(":")
+        _embedder_memo[spec] = getattr(importlib.import_module(module_name), function_name or "embed")
+    return _embedder_memo[spec]
+
+def embed(texts, spec=EMBEDDER):
+    """Embeds texts in batches; returns a float32 matrix with unit-length rows."""
+    embedder = get_embedder(spec)
+    batches = [np.asarray(embedder(texts[start:start + EMBED_BATCH]), dtype=np.float32)
+               for start in range(0, len(texts), EMBED_BATCH)]
+    matrix = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True) if matrix.size else None
+    if norms is not None:
+        matrix /= np.where(norms == 0, 1, norms)
+    return matrix
+
+def _section_texts(file_index):
+    return [f"{section['heading']}\n{section['text']}" for section in file_index["sections"]]
+
+def _read_meta():
+    try:
+        mtime_ns = os.stat(META_PATH).st_mtime_ns
+        with open(META_PATH, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    if meta.get("version") != STORE_VERSION:
+        return None, None
+    return mtime_ns, meta
+
+def _write_meta(meta):
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp_path = f"{META_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, META_PATH)
+
+def _vectors_path(meta):
+    return os.path.join(STORE_DIR, f"vectors.{meta['generation']}.f32")
+
+def _append_rows(meta, matrix):
+    """Appends rows after the last row meta knows about (dropping any rows of an interrupted update)."""
+    with open(_vectors_path(meta), "ab") as f:
+        f.truncate(meta["rows"] * meta["dim"] * 4)
+        f.write(matrix.astype(np.float32, copy=False).tobytes())
+    start = meta["rows"]
+    meta["rows"] += len(matrix)
+    return start
+
+def _open_matrix(meta):
+    if not meta["rows"]:
+        return np.zeros((0, meta["dim"] or 1), dtype=np.float32)
+    return np.memmap(_vectors_path(meta), dtype=np.float32, mode="r", shape=(meta["rows"], meta["dim"]))
+
+def _compact(meta):
+    """Copies the live rows to a new generation file, file by file, and returns the new meta."""
+    matrix = _open_matrix(meta)
+    compacted = dict(meta, generation=meta["generation"] + 1, rows=0, files={})
+    open(_vectors_path(compacted), "wb").close()
+    for file_name, entry in meta["files"].items():
+        start = _append_rows(compacted, np.array(matrix[entry["start"]:entry["start"] + entry["count"]]))
+        compacted["files"][file_name] = dict(entry, start=start)
+    return compacted
+
+def _embedder_key(spec):
+    return f"hashing:{HASH_DIM}" if spec == "hashing" else spec
+
+def _new_meta(spec, generation):
+    return {"version": STORE_VERSION, "embedder": _embedder_key(spec), "dim": 0, "generation": generation, "rows": 0, "files": {}}
+
+def _embed_files(meta, files, names, spec):
+    for name in names:
+        matrix = embed(_section_texts(files[name]), spec)
+        if len(matrix) and meta["dim"] and matrix.shape[1] != meta["dim"]:
+            raise ValueError(f"embedding size changed from {meta['dim']} to {matrix.shape[1]}")
+        if len(matrix):
+            meta["dim"] = matrix.shape[1]
+            start = _append_rows(meta, matrix)
+        else:
+            start = meta["rows"]
+        meta["files"][name] = {"mtime_ns": files[name]["mtime_ns"], "size": files[name]["size"], "start": start, "count": len(matrix)}
+
+def _remove_old_generations(meta):
+    current = os.path.basename(_vectors_path(meta))
+    for name in os.listdir(STORE_DIR):
+        if name.startswith("vectors.") and name.endswith(".f32") and name != current:
+            try:
+                os.remove(os.path.join(STORE_DIR, name))
+            except OSError: # Still mapped by another process on Windows; removed next time
+                pass
+
+def update_store(spec=EMBEDDER):
+    """Brings the store up to date with the FAQ files and returns its meta, embedding only changed files."""
+    files = load_index()
+    _, meta = _read_meta()
+    if meta is None or meta.get("embedder") != _embedder_key(spec):
+        meta = _new_meta(spec, (meta or {}).get("generation", -1) + 1)
+    stale = [name for name, entry in meta["files"].items()
+             if name not in files or (entry["mtime_ns"], entry["size"]) != (files[name]["mtime_ns"], files[name]["size"])]
+    for name in stale:
+        del meta["files"][name]
+    missing = [name for name in files if name not in meta["files"]]
+    if not stale and not missing and os.path.exists(META_PATH):
+        return meta
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    try:
+        _embed_files(meta, files, missing, spec)
+    except ValueError as e: # The embedder now returns another size: re-embed everything
+        print(f"faq_embeddings: {e}, rebuilding the store", file=sys.stderr)
+        meta = _new_meta(spec, meta["generation"] + 1)
+        _embed_files(meta, files, list(files), spec)
+    live_rows = sum(entry["count"] for entry in meta["files"].values())
+    if meta["rows"] - live_rows > max(live_rows, EMBED_BATCH):
+        meta = _compact(meta)
+    _write_meta(meta)
+    _remove_old_generations(meta)
+    return meta
+
+def load_store(spec=EMBEDDER):
+    """Returns (matrix, row_files, row_sections, file_names, idf) for search.
+
+    matrix is the memory-mapped vectors; row_files holds each row's index in file_names
+    (-1 for rows of changed or deleted files) and row_sections its section index in that file.
+    idf weighs the query's dimensions for the hashing embedder (None for other embedders).
+    """
+    meta = update_store(spec)
+    meta_mtime_ns = os.stat(META_PATH).st_mtime_ns
+    if _store_memo["meta_mtime_ns"] == meta_mtime_ns:
+        return _store_memo["store"]
+    file_names = sorted(meta["files"])
+    row_files = np.full(meta["rows"], -1, dtype=np.int32)
+    row_sections = np.zeros(meta["rows"], dtype=np.int32)
+    for file_id, file_name in enumerate(file_names):
+        entry = meta["files"][file_name]
+        row_files[entry["start"]:entry["start"] + entry["count"]] = file_id
+        row_sections[entry["start"]:entry["start"] + entry["count"]] = np.arange(entry["count"])
+    matrix = _open_matrix(meta)
+    idf = None
+    if spec == "hashing" and meta["rows"]:
+        live_rows = int((row_files >= 0).sum())
+        document_frequency = (matrix != 0)[row_files >= 0].sum(axis=0)
+        idf = (np.log((live_rows + 1) / (document_frequency + 1)) + 1).astype(np.float32)
+    store = (matrix, row_files, row_sections, file_names, idf)
+    _store_memo.update(meta_mtime_ns=meta_mtime_ns, store=store)
+    return store
+
+def search(query, k=TOP_K, files=None, spec=EMBEDDER):
+    """Returns the k sections most similar to query ({"file", "heading", "text", "score"}), optionally only from files."""
+    matrix, row_files, row_sections, file_names, idf = load_store(spec)
+    if not len(row_files) or k <= 0:
+        return []
+    query_vector = embed([query], spec)[0]
+    if idf is not None:
+        query_vector = query_vector * idf
+        query_vector /= np.linalg.norm(query_vector) or 1
+    scores = np.asarray(matrix @ query_vector) # One pass over every section
+    if files:
+        live = np.isin(row_files, [file_id for file_id, file_name in enumerate(file_names) if file_name in files])
+    else:
+        live = row_files >= 0
+    scores = np.where(live & (scores >= MIN_SIMILARITY), scores, -np.inf)
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = sorted((index for index in best if np.isfinite(scores[index])), key=lambda index: -scores[index])
+    sections = load_index()
+    results = []
+    for index in best:
+        file_name = file_names[row_files[index]]
+        section = sections[file_name]["sections"][row_sections[index]]
+        results.append({"file": file_name, "heading": section["heading"], "text": section["text"],
+                        "score": round(float(scores[index]), 3)})
+    return results
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "build":
+        meta = update_store()
+        live_rows = sum(entry["count"] for entry in meta["files"].values())
+        print(f"Embedded {live_rows} section(s) of {len(meta['files'])} FAQ file(s) with {meta['embedder']} "
+              f"({meta['dim']} dims, {meta['rows']} rows stored) in {STORE_DIR}")
+
+    elif command == "search" and len(sys.argv) > 2:
+        # search "<query>" [k] [faq_file ...]
+        k = int(sys.argv[3]) if len(sys.argv) > 3 else TOP_K
+        for result in search(sys.argv[2], k, sys.argv[4:] or None):
+            print(f"{result['score']:>6.3f}  {result['file']}: {result['heading']}")
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  faq_embeddings.py build", file=sys.stderr)
+        print("  faq_embeddings.py search \"<query>\" [k] [faq_file ...]", file=sys.stderr)
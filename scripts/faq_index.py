@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import math
+import threading
+import unicodedata
+
+from action_reader import load_registry, CONFIG_DIR
+
+# Lexical (BM25) retrieval over the FAQ files in gpt_tools/faq/, so large knowledge bases
+# don't have to be pasted into the prompt whole. Each markdown file is split into sections
+# at its headings (long sections are cut at paragraph breaks), and the sections of every file
+# are indexed in gpt_tools/cache/faq_index/<file>.json. Like the config registry, only files
+# whose mtime or size changed are re-split (and only their index file rewritten) on the next lookup.
+#
+# faq_context() decides what goes into a prompt: a selected FAQ that is small enough
+# (ESPANSO_GPT_FAQ_FULL_MAX_TOKENS, default 1500) is still included whole, which keeps the
+# system prompt identical across calls for the provider's prompt cache; anything larger, or
+# "All FAQs", is searched with the customer's message and only the top sections are sent.
+# ESPANSO_GPT_FAQ_SEARCH=semantic ranks the same sections by embedding similarity instead.
+INDEX_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "faq_index")
+INDEX_VERSION = 1
+ALL_FAQS = "All FAQs" # The form choice that searches every FAQ file
+TOP_K = int(os.environ.get("ESPANSO_GPT_FAQ_TOP_K", 4))
+SEARCH_MODE = os.environ.get("ESPANSO_GPT_FAQ_SEARCH", "bm25") # Or "semantic" (faq_embeddings.py, needs numpy)
+FULL_TEXT_MAX_TOKENS = int(os.environ.get("ESPANSO_GPT_FAQ_FULL_MAX_TOKENS", 1500))
+CONTEXT_MAX_TOKENS = int(os.environ.get("ESPANSO_GPT_FAQ_MAX_TOKENS", 1500)) # Budget for the retrieved sections
+MAX_SECTION_CHARS = 2000 # Longer sections are split at paragraph breaks
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do for from has have how i if in is it its my of on or our so that the their then
+there this to was we what when where which who why will with you your
+au aux avec ce ces dans de des du elle en est et il je la le les leur mais me mes mon ne nous on ou par pas pour
+qu que qui sa se ses son sur ta te tes ton tu un une vos votre vous
+""".split())
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_index_memo = {"files": None, "search": None}
+
+def tokenize(text):
+    """Lowercased, accent-folded words without stopwords, with a trailing plural "s" dropped."""
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    terms = []
+    for word in _WORD_RE.findall(text):
+        if len(word) < 2 or word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+def _chunk_paragraphs(text):
+    if len(text) <= MAX_SECTION_CHARS:
+        return [text]
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        if current and len(current) + len(paragraph) > MAX_SECTION_CHARS:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_sections(markdown, file_name):
+    """Splits a markdown file into [{"heading", "text"}] at its headings (headings inside code fences are ignored)."""
+    sections, path, lines = [], [], []
+    heading = os.path.splitext(file_name)[0]
+    in_fence = False
+
+    def flush():
+        body = "\n".join(lines).strip()
+        if body:
+            for chunk in _chunk_paragraphs(body):
+                sections.append({"heading": heading, "text": chunk})
+        del lines[:]
+
+    for line in markdown.splitlines():
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        match = None if in_fence else _HEADING_RE.match(line)
+        if match:
+            flush()
+            level = len(match.group(1))
+            path = (path + [""] * level)[:level - 1] + [match.group(2)] # One slot per heading level
+            heading = " > ".join(part for part in path if part)
+        else:
+            lines.append(line)
+    flush()
+    return sections
+
+def _index_file(file_name, content):
+    sections = split_sections(content, file_name)
+    for section in sections:
+        terms = tokenize(f"{section['heading']}\n{section['text']}")
+        section["length"] = len(terms)
+        tf = {}
+        for term in terms:
+            tf[term] = tf.get(term, 0) + 1
+        section["tf"] = tf
+    return sections
+
+def _index_file_path(file_name):
+    return os.path.join(INDEX_DIR, f"{os.path.splitext(file_name)[0]}.json")
+
+def _read_file_index(file_name, mtime_ns, size):
+    """Returns the stored index of one FAQ file if it is current, else None."""
+    try:
+        with open(_index_file_path(file_name), "r", encoding="utf-8") as f:
+            file_index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (file_index.get("version"), file_index.get("mtime_ns"), file_index.get("size")) != (INDEX_VERSION, mtime_ns, size):
+        return None
+    return file_index
+
+def _write_file_index(file_name, file_index):
+    path = _index_file_path(file_name)
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(file_index, ensure_ascii=False, separators=(",", ":"))) # C encoder; json.dump streams through the Python one
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing FAQ index {path}: {e}", file=sys.stderr)
+
+def load_index():
+    """Returns {file: {"version", "mtime_ns", "size", "sections"}} for every FAQ file, re-splitting only changed files."""
+    previous_files = _index_memo["files"] or {}
+    files = {}
+    for name, entry in load_registry().get("faqs", {}).items():
+        file_name = entry.get("file", f"{name}.md")
+        mtime_ns, size = entry.get("mtime_ns"), entry.get("size")
+        file_index = previous_files.get(file_name)
+        if not file_index or (file_index["mtime_ns"], file_index["size"]) != (mtime_ns, size):
+            file_index = _read_file_index(file_name, mtime_ns, size)
+        if file_index is None:
+            file_index = {"version": INDEX_VERSION, "mtime_ns": mtime_ns, "size": size,
+                          "sections": _index_file(file_name, entry.get("data") or "")}
+            _write_file_index(file_name, file_index)
+        files[file_name] = file_index
+    if set(files) != set(previous_files): # Drop the index files of deleted FAQ files
+        current = {os.path.basename(_index_file_path(file_name)) for file_name in files}
+        try:
+            stale = [name for name in os.listdir(INDEX_DIR) if name.endswith(".json") and name not in current]
+        except OSError:
+            stale = []
+        for name in stale:
+            try:
+                os.remove(os.path.join(INDEX_DIR, name))
+            except OSError:
+                pass
+    _index_memo["files"] = files
+    return files
+
+def _file_structures(files):
+    """Returns {file: {"sections", "postings", "total_length"}}, rebuilding postings only for changed files (kept warm in the daemon)."""
+    previous = _index_memo["search"] or {}
+    structures = {}
+    for file_name, file_entry in files.items():
+        cached = previous.get(file_name)
+        if cached and (cached["mtime_ns"], cached["size"]) == (file_entry.get("mtime_ns"), file_entry.get("size")):
+            structures[file_name] = cached
+            continue
+        postings = {}
+        for section_id, section in enumerate(file_entry["sections"]):
+            for term, count in section["tf"].items():
+                postings.setdefault(term, []).append((section_id, count))
+        structures[file_name] = {"mtime_ns": file_entry.get("mtime_ns"), "size": file_entry.get("size"),
+                                 "sections": file_entry["sections"], "postings": postings,
+                                 "total_length": sum(section["length"] for section in file_entry["sections"])}
+    _index_memo["search"] = structures
+    return structures
+
+def search(query, k=TOP_K, files=None, mode=None):
+    """Returns the k best-matching sections ({"file", "heading", "text", "score"}) for query, optionally only from files.
+
+    mode is "bm25" or "semantic" (faq_embeddings.py), ESPANSO_GPT_FAQ_SEARCH by default.
+    """
+    if (mode or SEARCH_MODE) == "semantic":
+        try:
+            import faq_embeddings # Imports numpy, so only when asked for
+            return faq_embeddings.search(query, k, files)
+        except ImportError as e:
+            print(f"faq_index: semantic search is unavailable ({e}); using BM25", file=sys.stderr)
+    return bm25_search(query, k, files)
+
+def bm25_search(query, k=TOP_K, files=None):
+    """Ranks sections against query with BM25."""
+    structures = _file_structures(load_index())
+    section_count = sum(len(structure["sections"]) for structure in structures.values())
+    if not section_count:
+        return []
+    avg_length = (sum(structure["total_length"] for structure in structures.values()) / section_count) or 1
+    scores = {}
+    for term in set(tokenize(query)):
+        hits = [(file_name, structure["postings"][term]) for file_name, structure in structures.items()
+                if term in structure["postings"]]
+        document_frequency = sum(len(term_postings) for _, term_postings in hits)
+        if not document_frequency:
+            continue
+        idf = math.log(1 + (section_count - document_frequency + 0.5) / (document_frequency + 0.5))
+        for file_name, term_postings in hits:
+            if files and file_name not in files:
+                continue
+            sections = structures[file_name]["sections"]
+            for section_id, count in term_postings:
+                length_norm = BM25_K1 * (1 - BM25_B + BM25_B * sections[section_id]["length"] / avg_length)
+                key = (file_name, section_id)
+                scores[key] = scores.get(key, 0.0) + idf * count * (BM25_K1 + 1) / (count + length_norm)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [dict(file=file_name, heading=structures[file_name]["sections"][section_id]["heading"],
+                 text=structures[file_name]["sections"][section_id]["text"], score=round(score, 3))
+            for (file_name, section_id), score in best]
+
+def format_sections(sections, max_tokens=CONTEXT_MAX_TOKENS):
+    """Formats retrieved sections for the prompt, best first, within max_tokens."""
+    parts, used = [], 0
+    for section in sections:
+        part = f"### {section['heading']} ({section['file']})\n{section['text']}"
+        if parts and used + estimate_tokens(part) > max_tokens:
+            break
+        parts.append(part)
+        used += estimate_tokens(part)
+    return "\n\n".join(parts)
+
+def faq_context(selected_faq, query, k=TOP_K):
+    """Returns (text, full) with the FAQ content for a prompt.
+
+    full is True when text is a whole FAQ file (identical on every call, so it belongs in the
+    stable part of the prompt); otherwise text holds the sections retrieved for query and
+    varies per call. Returns ("", False) when no FAQ is selected or nothing matched.
+    Raises FileNotFoundError for an unknown FAQ file.
+    """
+    if not selected_faq or selected_faq.strip().lower() in ("none", ""):
+        return "", False
+    files = None
+    if selected_faq != ALL_FAQS:
+        from action_reader import get_faq
+        content = get_faq(selected_faq)
+        if content is None:
+            raise FileNotFoundError(selected_faq)
+        if estimate_tokens(content) <= FULL_TEXT_MAX_TOKENS:
+            return content, True
+        files = [selected_faq]
+    return format_sections(search(query, k, files)), False
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "build":
+        files = load_index()
+        section_count = sum(len(entry["sections"]) for entry in files.values())
+        print(f"Indexed {len(files)} FAQ file(s), {section_count} section(s) in {INDEX_DIR}")
+
+    elif command == "search" and len(sys.argv) > 2:
+        # search "<query>" [k] [faq_file]
+        k = int(sys.argv[3]) if len(sys.argv) > 3 else TOP_K
+        for result in search(sys.argv[2], k, sys.argv[4:] or None):
+            print(f"{result['score']:>7.2f}  {result['file']}: {result['heading']}")
+
+    elif command == "sections" and len(sys.argv) > 2:
+        for section in load_index().get(sys.argv[2], {}).get("sections", []):
+            print(f"{section['length']:>5} terms  {section['heading']}")
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  faq_index.py build", file=sys.stderr)
+        print("  faq_index.py search \"<query>\" [k] [faq_file ...]", file=sys.stderr)
+        print("  faq_index.py sections <faq_file>", file=sys.stderr)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import metrics # First, so its clock starts as close to process start as possible
+import os
+import sys
+import io
+import time
+
+from state_io import load_state, save_state, delete_state, latest_checkpoint_id
+from daemon_client import send_request
+
+# Runs the :gpt: form steps as one session instead of hopping through
+# `espanso match exec` and a fresh Python process for every step:
+#   step 1 (handle_form_step1.py) -> [step 2 form, only for tasks that need it] -> final step
+# The form state is passed along in memory, and the final step (multi-form.py) runs in the
+# warm daemon when it is up, otherwise in this process. The session's state file
+# (gpt_tools/sessions/<session_id>.json, see state_io.py) is only a checkpoint: it is written before the final step and deleted when it finishes, so a
+# session whose process died can be resumed with :gpt_final_processing.
+#
+# Set ESPANSO_GPT_TIMING=1 to print the time from form submission to each stage on stderr.
+FINAL_SCRIPT = "multi-form"
+SECOND_FORM_TRIGGER = ":gpt_form_step2"
+
+def mark_submitted(state):
+    """Stamps the state with the form submission time (the start of the latency measurement)."""
+    state["submitted_at"] = time.time()
+    return state
+
+def log_timing(state, stage):
+    """Prints the milliseconds since the form was submitted when ESPANSO_GPT_TIMING is set."""
+    submitted_at = (state or {}).get("submitted_at")
+    if submitted_at and os.environ.get("ESPANSO_GPT_TIMING"):
+        print(f"TIMING form_session: {stage} at +{(time.time() - submitted_at) * 1000:.0f} ms", file=sys.stderr)
+
+def needs_second_form(state):
+    """True when the selected task asks for the step 2 form (Customer Support)."""
+    from action_reader import get_task
+    task_objective = state.get("task_objective")
+    return bool(get_task(task_objective).get("requires_second_form")) or task_objective == "Customer Support Task"
+
+def run_final_step(state):
+    """Runs the final processing step for an in-memory form state and returns its output text."""
+    save_state(state) # Crash-recovery checkpoint only (assigns state["session_id"]); nothing reads it on the normal path
+    log_timing(state, "final step started")
+    try:
+        if not os.environ.get("ESPANSO_GPT_NO_DAEMON"):
+            reply = send_request({"script": FINAL_SCRIPT, "state": state})
+            if reply and reply.get("ok"):
+                return reply.get("output", "")
+            if reply:
+                print(f"form_session: daemon error, running in-process: {reply.get('error')}", file=sys.stderr)
+        # Same loader the daemon uses (multi-form.py is not importable by name)
+        from gpt_daemon import load_script
+        final_script = load_script(FINAL_SCRIPT)
+        metrics.mark_imports_done() # The run's "imports" span then covers this process's startup
+        return final_script.run(state)
+    finally:
+        delete_state(state["session_id"])
+
+def print_output(text):
+    """Prints the final text for Espanso to insert."""
+    if sys.stdout.encoding != 'utf-8':
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    print(text)
+
+if __name__ == "__main__":
+    # Resume a session from its checkpoint: the given session ID, or the most recent one
+    checkpoint = load_state(sys.argv[1] if len(sys.argv) > 1 else latest_checkpoint_id())
+    if not checkpoint:
+        print("No form session checkpoint to resume.", file=sys.stderr)
+        sys.exit(1)
+    print_output(run_final_step(checkpoint))
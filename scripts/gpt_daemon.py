@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import os
+import sys
+import io
+import json
+import secrets
+import queue
+import signal
+import threading
+import importlib.util
+import contextlib
+import socketserver
+import traceback
+
+from daemon_client import DAEMON_INFO_PATH, read_daemon_info, send_request
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scripts the daemon can run, mapped to their file names (multi-form.py is not importable by name).
+SCRIPT_FILES = {
+    "text_processor": "text_processor.py",
+    "customer_support": "customer_support.py",
+    "multi-form": "multi-form.py",
+    "prefetch": "prefetch.py",
+}
+# Scripts that open Tk dialogs and keep a Tk root between runs (multi-form.py's app_root):
+# they run one at a time on the main thread. The others run concurrently, one thread per request,
+# except text_processor's variants mode, whose chooser is a window too (see is_gui_request).
+GUI_SCRIPTS = {"multi-form"}
+
+_loaded_scripts = {}
+_load_lock = threading.Lock()
+_gui_jobs = queue.Queue()
+_gui_busy = threading.Lock() # Held from the moment a GUI request is accepted until its reply is ready
+_token = None
+
+def load_script(script_name):
+    """Imports a script once and keeps it (and its imports) warm for later runs."""
+    with _load_lock:
+        if script_name not in _loaded_scripts:
+            path = os.path.join(SCRIPTS_DIR, SCRIPT_FILES[script_name])
+            module_name = script_name.replace("-", "_")
+            module = sys.modules.get(module_name) # Already imported by another script (text_processor imports prefetch)
+            if module is None:
+                spec = importlib.util.spec_from_file_location(module_name, path)
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[module_name] = module
+                try:
+                    spec.loader.exec_module(module)
+                except BaseException:
+                    del sys.modules[module_name] # A half-initialized module must not be reused by the next attempt
+                    raise
+            _loaded_scripts[script_name] = module
+        return _loaded_scripts[script_name]
+
+def is_gui_request(request):
+    """True for requests that open a Tk window: GUI scripts, and text_processor.py with a variants spec (6th argument)."""
+    script_name = request.get("script")
+    if script_name in GUI_SCRIPTS:
+        return True
+    args = request.get("args") or []
+    return script_name == "text_processor" and len(args) == 6 and bool(str(args[5]).strip())
+
+def run_request(request):
+    """Executes one client request and returns the reply dict.
+
+    A script that exits while loading (sys.exit on a missing API key) is an error reply,
+    like any exception, so it never takes the daemon down.
+    """
+    script_name = request.get("script")
+    if script_name == "ping":
+        return {"ok": True, "output": "pong"}
+    if script_name not in SCRIPT_FILES:
+        return {"ok": False, "error": f"Unknown script: {script_name}"}
+    try:
+        module = load_script(script_name)
+        args = request["state"] if request.get("state") is not None else request.get("args", [])
+        if not is_gui_request(request):
+            # These return their output; redirecting sys.stdout is process-wide, so not done off the main thread
+            result = module.run(args)
+            return {"ok": True, "output": result if result is not None else ""}
+        captured = io.StringIO()
+        # Anything a script prints directly (multi-form.py does) becomes part of the output.
+        with contextlib.redirect_stdout(captured):
+            result = module.run(args)
+        output = result if result is not None else captured.getvalue().rstrip("\n")
+        return {"ok": True, "output": output}
+    except (Exception, SystemExit) as e:
+        traceback.print_exc(file=sys.stderr)
+        return {"ok": False, "error": f"{script_name} failed: {e!r}"}
+
+def run_gui_request(request):
+    """Hands a GUI script's request to the main thread, or replies busy if one is already running.
+
+    A busy reply makes the client run the script in its own process instead of waiting
+    (possibly for a dialog the user has not answered yet).
+    """
+    if not _gui_busy.acquire(blocking=False):
+        return {"ok": False, "busy": True, "error": "Daemon busy with another run's dialog"}
+    try:
+        job = {"request": request, "done": threading.Event(), "reply": None}
+        _gui_jobs.put(job)
+        job["done"].wait()
+        return job["reply"]
+    finally:
+        _gui_busy.release()
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            if request.get("token") != _token:
+                reply = {"ok": False, "error": "Invalid daemon token"}
+            elif is_gui_request(request):
+                reply = run_gui_request(request)
+            else:
+                reply = run_request(request)
+        except (Exception, SystemExit) as e:
+            traceback.print_exc(file=sys.stderr)
+            reply = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(reply).encode("utf-8"))
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True # A run still in progress does not keep the daemon from exiting
+
+def write_daemon_info(port):
+    os.makedirs(os.path.dirname(DAEMON_INFO_PATH), exist_ok=True)
+    with open(DAEMON_INFO_PATH, "w", encoding="utf-8") as f:
+        json.dump({"port": port, "token": _token, "pid": os.getpid()}, f)
+
+def remove_daemon_info():
+    info = read_daemon_info()
+    if info and info.get("pid") == os.getpid():
+        try:
+            os.remove(DAEMON_INFO_PATH)
+        except OSError:
+            pass
+
+def serve_gui_jobs():
+    """Runs the GUI requests, one at a time, on the calling (main) thread until interrupted."""
+    while True:
+        job = _gui_jobs.get()
+        try:
+            job["reply"] = run_request(job["request"])
+        finally:
+            job["done"].set()
+
+def serve():
+    """Starts the daemon on a free localhost port.
+
+    Each connection is handled on its own thread, so a long stream or a slow request never
+    holds up another trigger. GUI requests (is_gui_request) are the exception: the Tk/customtkinter
+    dialogs must stay on a single thread, so they run on the main thread, one at a time,
+    and a second one meanwhile is told the daemon is busy.
+    """
+    global _token
+    _token = secrets.token_hex(16)
+    # Warm up the heavy imports and the shared OpenAI client before accepting requests.
+    for script_name in SCRIPT_FILES:
+        try:
+            load_script(script_name)
+        except (Exception, SystemExit) as e:
+            print(f"gpt_daemon: could not preload {script_name}: {e}", file=sys.stderr)
+    from openai_client import get_client
+    get_client()
+
+    # Turn SIGTERM into a normal exit so the daemon.json record gets cleaned up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with DaemonServer(("127.0.0.1", 0), DaemonRequestHandler) as server:
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        write_daemon_info(port)
+        print(f"gpt_daemon: listening on 127.0.0.1:{port} (pid {os.getpid()})", file=sys.stderr)
+        try:
+            serve_gui_jobs()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            remove_daemon_info()
+            server.shutdown()
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+
+    if command == "serve":
+        serve()
+
+    elif command == "status":
+        info = read_daemon_info()
+        reply = send_request({"script": "ping"}, info) if info else None
+        if reply and reply.get("ok"):
+            print(f"Daemon running on port {info['port']} (pid {info['pid']})")
+        else:
+            print("Daemon not running")
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  gpt_daemon.py [serve]", file=sys.stderr)
+        print("  gpt_daemon.py status", file=sys.stderr)
@@ -1,10 +1,11 @@
+import metrics # First, so its clock starts as close to process start as possible
 import os
 import subprocess
 import sys
-import pyperclip
 import time # For generating unique IDs
 # import uuid # Alternative for unique IDs: uuid.uuid4()
-from state_io import save_state, delete_state, STATE_FILE_PATH, load_state, CONFIG_DIR # Import CONFIG_DIR
+from state_io import save_state, hand_off, gc_stale_sessions, CONFIG_DIR # Import CONFIG_DIR
+from form_session import mark_submitted, needs_second_form, run_final_step, print_output, log_timing, SECOND_FORM_TRIGGER
 
 DEBUG_MODE = True
 
@@ -28,15 +29,26 @@ def main():
         # Fallback if we can't even write the env log
         print(f"CRITICAL DEBUG ERROR: Could not write env_log to {debug_file_target}: {e_env_log}", file=sys.stderr)
 
-    # Clear previous state and log it
+    # Clean up state left behind by crashed sessions. Sessions still in progress (another
+    # :gpt: run may be waiting on the API right now) are left alone.
     try:
-        delete_state()
+        removed_count = gc_stale_sessions()
         with open(debug_file_target, "a", encoding="utf-8") as f_debug: # 'a' to append now
-            f_debug.write(f"handle_form_step1.py: Called delete_state() for {STATE_FILE_PATH}. File exists after delete: {os.path.exists(STATE_FILE_PATH)}\n")
+            f_debug.write(f"handle_form_step1.py: Called gc_stale_sessions(), removed {removed_count} stale file(s)\n")
     except Exception as e:
         with open(debug_file_target, "a", encoding="utf-8") as f_debug:
-            f_debug.write(f"handle_form_step1.py: Error deleting state: {e}\n")
-        # print(f"Error deleting previous state in handle_form_step1: {e}", file=sys.stderr)
+            f_debug.write(f"handle_form_step1.py: Error cleaning up stale sessions: {e}\n")
+
+    # Conversation retention and compression (context_retention.py) runs in a detached
+    # process, at most once every ESPANSO_GPT_RETENTION_INTERVAL_HOURS.
+    try:
+        from context_retention import maybe_run_in_background
+        if maybe_run_in_background():
+            with open(debug_file_target, "a", encoding="utf-8") as f_debug:
+                f_debug.write("handle_form_step1.py: Started context retention in the background\n")
+    except Exception as e:
+        with open(debug_file_target, "a", encoding="utf-8") as f_debug:
+            f_debug.write(f"handle_form_step1.py: Error starting context retention: {e}\n")
 
     # Espanso passes form field values as environment variables:
     # ESPANSO_<FORM_VAR_NAME>_<FIELD_NAME>
@@ -65,7 +77,20 @@ def main():
         sys.exit(1) # Indicate an error
 
     active_conversation_id = ""
-    if conversation_mode == "Continue Last":
+    if conversation_mode not in ("Start New", "Continue Last"):
+        # A conversation picked from the list, or "Search history..." (see conversation_index.py)
+        from conversation_index import SEARCH_HISTORY, parse_choice
+        if conversation_mode == SEARCH_HISTORY:
+            from conversation_picker import pick_conversation
+            active_conversation_id = pick_conversation() or ""
+        else:
+            active_conversation_id = parse_choice(conversation_mode) or ""
+        # multi-form.py continues whichever conversation active_conversation_id names
+        conversation_mode = "Continue Last" if active_conversation_id else "Start New"
+        if DEBUG_MODE:
+            with open(debug_file_target, "a", encoding="utf-8") as f_debug:
+                f_debug.write(f"DEBUG handle_form_step1: Picked conversation: '{active_conversation_id}'\n")
+    elif conversation_mode == "Continue Last":
         try:
             with open(LAST_CONV_ID_FILEPATH, "r", encoding="utf-8") as f_last_id:
                 active_conversation_id = f_last_id.read().strip()
@@ -94,6 +119,7 @@ def main():
     final_initial_prompt = initial_prompt_from_form
     if not initial_prompt_from_form:
         try:
+            import pyperclip # Only needed when the prompt comes from the clipboard
             final_initial_prompt = pyperclip.paste()
             if not final_initial_prompt: # If clipboard is also empty
                 final_initial_prompt = "" # Ensure it's an empty string, not None
@@ -104,7 +130,7 @@ def main():
             with open(debug_file_target, "a", encoding="utf-8") as f_debug:
                  f_debug.write(f"DEBUG handle_form_step1: Pyperclip error: {e_clip}. Using empty prompt for initial_prompt.\n")
 
-    step1_data = {
+    step1_data = mark_submitted({
         "conversation_mode": conversation_mode,
         "active_conversation_id": active_conversation_id,
         "task_objective": task_objective,
@@ -113,10 +139,25 @@ def main():
         "desired_answer_sketch": desired_sketch,
         "include_screenshot": include_screenshot_str, # Save to state
         # Add any other fields from Step 1 form here
-    }
+    })
+
+    # Add a small delay if screenshot is true, to allow screen to settle after form submission
+    if include_screenshot_str.lower() == "true":
+        time.sleep(0.5) # 0.5 second delay, adjust if needed
 
+    if not needs_second_form(step1_data):
+        # No second form: run the final step right here with the state in memory (see form_session.py).
+        # Its output becomes this script's output, which the :gpt: trigger inserts.
+        with open(debug_file_target, "a", encoding="utf-8") as f_debug:
+            f_debug.write("handle_form_step1.py: Running final processing in-process\n")
+        print_output(run_final_step(step1_data))
+        sys.exit(0)
+
+    # The step 2 form can only be shown by Espanso, so hand the state over through the session's
+    # state file; the form claims the session ID as it opens (see state_io.py)
     try:
         save_state(step1_data)
+        hand_off(step1_data["session_id"])
         with open(debug_file_target, "a", encoding="utf-8") as f_debug:
             f_debug.write(f"handle_form_step1.py: Saved step1_data to state file: {step1_data}\n")
     except Exception as e:
@@ -125,19 +166,11 @@ def main():
         # print(f"ERROR handle_form_step1: Could not save state. {e}", file=sys.stderr)
         sys.exit(1)
 
-    # Conditional triggering of next step
-    next_trigger = ""
-    if task_objective == "Customer Support Task":
-        next_trigger = ":gpt_form_step2"
-    else:
-        next_trigger = ":gpt_final_processing"
-    
+    next_trigger = SECOND_FORM_TRIGGER
     try:
         with open(debug_file_target, "a", encoding="utf-8") as f_debug:
             f_debug.write(f"handle_form_step1.py: Triggering next step: {next_trigger}\n")
-        # Add a small delay if screenshot is true, to allow screen to settle after form submission
-        if include_screenshot_str.lower() == "true":
-            time.sleep(0.5) # 0.5 second delay, adjust if needed
+        log_timing(step1_data, "step 2 form triggered")
         subprocess.run([ESPANSO_CMD_PATH, "match", "exec", "-t", next_trigger], check=True)
     except Exception as e_subproc:
         with open(debug_file_target, "a", encoding="utf-8") as f_debug:
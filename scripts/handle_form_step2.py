@@ -1,9 +1,8 @@
+import metrics # First, so its clock starts as close to process start as possible
 import os
-import subprocess
 import sys
-from state_io import load_state, save_state, STATE_FILE_PATH
-
-ESPANSO_CMD_PATH = r"C:\Users\Olivier Lambert\AppData\Local\Programs\Espanso\espanso.cmd"
+from state_io import load_state
+from form_session import mark_submitted, run_final_step, print_output
 
 def main():
     debug_file_target = os.path.join(os.path.expanduser("~"), "espanso_debug_paths.txt")
@@ -18,10 +17,12 @@ def main():
     except Exception as e_env_log:
         print(f"CRITICAL DEBUG ERROR in handle_form_step2: Could not write env_log: {e_env_log}", file=sys.stderr)
 
-    current_state = load_state()
+    # The session this form was opened for, claimed by its claim_session.py script var
+    session_id = sys.argv[5] if len(sys.argv) > 5 else ""
+    current_state = load_state(session_id)
     if not current_state:
         with open(debug_file_target, "a") as f_debug:
-            f_debug.write("ERROR handle_form_step2: Failed to load state from Step 1 or state is empty.\n")
+            f_debug.write(f"ERROR handle_form_step2: Failed to load state of session '{session_id}' from Step 1 or state is empty.\n")
         sys.exit(1)
     else:
         with open(debug_file_target, "a") as f_debug:
@@ -38,32 +39,19 @@ def main():
         f_debug.write(f"handle_form_step2.py: Retrieved from Env - FAQ Selection: {faq_selection}\n")
         f_debug.write(f"handle_form_step2.py: Retrieved from Env - Desired Sketch: {desired_sketch}\n")
 
-    updated_state = {
+    updated_state = mark_submitted({
         **current_state,
         "sentiment": sentiment,
         "relation": relation,
         "selected_faq": faq_selection,
         "desired_answer_sketch": desired_sketch,
-    }
-
-    try:
-        save_state(updated_state)
-        with open(debug_file_target, "a") as f_debug:
-            f_debug.write(f"handle_form_step2.py: Saved updated_state: {updated_state}\n")
-    except Exception as e:
-        with open(debug_file_target, "a") as f_debug:
-            f_debug.write(f"ERROR handle_form_step2: Could not save updated state: {e}\n")
-        sys.exit(1)
+    })
 
-    next_trigger = ":gpt_final_processing"
-    try:
-        with open(debug_file_target, "a") as f_debug:
-            f_debug.write(f"handle_form_step2.py: Triggering next step: {next_trigger}\n")
-        subprocess.run([ESPANSO_CMD_PATH, "match", "exec", "-t", next_trigger], check=True)
-    except Exception as e_subproc:
-        with open(debug_file_target, "a") as f_debug:
-            f_debug.write(f"ERROR handle_form_step2: Failed to trigger '{next_trigger}'. Error: {e_subproc}\n")
-        sys.exit(1)
+    # Run the final step right here with the merged state in memory (see form_session.py);
+    # its output becomes this script's output, which the :gpt_form_step2 trigger inserts.
+    with open(debug_file_target, "a") as f_debug:
+        f_debug.write(f"handle_form_step2.py: Running final processing in-process with state: {updated_state}\n")
+    print_output(run_final_step(updated_state))
 
     sys.exit(0)
 
@@ -71,9 +59,10 @@ if __name__ == "__main__":
     # 0. Call this script with the arguments for this form step.
     #    Example: python scripts/handle_form_step2.py "positive" "formal" "Here is an idea for the answer..."
     #
-    # 1. Ensure handle_form_step1.py has run and created a gpt_tools/gpt_form_state.json with appropriate test data.
-    #    (Or, manually create gpt_tools/gpt_form_state.json in the expected CONFIG_DIR for testing state_io.py)
-    #    Example content for gpt_tools/gpt_form_state.json for this test:
+    # 1. Ensure handle_form_step1.py has run and saved a session in gpt_tools/sessions/ with appropriate test data.
+    #    (Or, save one with state_io.save_state() in the expected CONFIG_DIR for testing)
+    #    Its session ID is the 5th argument (the form gets it from claim_session.py).
+    #    Example content for the session state for this test:
     #    {
     #        "task_objective": "Generate a summary",
     #        "input_text": "This is the long text to summarize.",
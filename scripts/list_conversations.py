@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+import io
+import sys
+from conversation_index import START_NEW, CONTINUE_LAST, SEARCH_HISTORY, recent_conversations, format_choice
+
+def main():
+    """List the :gpt: form's conversation modes: start new, continue last, the recent conversations, search."""
+    if sys.stdout.encoding != 'utf-8': # Titles can hold any character
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    print(START_NEW)
+    print(CONTINUE_LAST)
+    try:
+        # Straight from the SQLite index (conversation_index.py), newest first
+        for conversation in recent_conversations():
+            print(format_choice(conversation))
+    except Exception as e:
+        # The two fixed modes above keep the form usable
+        print(f"Error listing conversations: {e}", file=sys.stderr)
+    print(SEARCH_HISTORY)
+
+if __name__ == "__main__":
+    main()
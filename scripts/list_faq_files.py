@@ -1,16 +1,14 @@
 #!/usr/bin/env python3
-import os
-import glob
-
-# The script is in <config_root>/scripts/, so markdown folder is ../gpt_tools/faq/
-markdown_dir = os.path.join(os.path.dirname(__file__), "..", "gpt_tools", "faq")
+from action_reader import get_faq_list
+from faq_index import ALL_FAQS
 
 # Print "None" as the first option for the dropdown
 print("None")
 
-# Find all .md files in the markdown directory
-faq_files = glob.glob(os.path.join(markdown_dir, "*.md"))
+# Searches every FAQ file and sends only the best-matching sections (see faq_index.py)
+print(ALL_FAQS)
 
-for f_path in sorted(faq_files):
+# FAQ files (gpt_tools/faq/*.md) come from the config registry
+for faq_filename in get_faq_list():
     # Print just the filename for the dropdown
-    print(os.path.basename(f_path)) 
\ No newline at end of file
+    print(faq_filename)
@@ -1,29 +1,17 @@
 #!/usr/bin/env python3
-import os
-import glob
-
-# Script is in <config_root>/scripts/
-# Tone files are in <config_root>/gpt_tools/tone/
-TONE_FILES_DIR = os.path.join(os.path.dirname(__file__), "..", "gpt_tools", "tone")
+from action_reader import get_tones_list
 
 def list_tone_files():
     try:
-        # Find all .txt files in the tone directory
-        tone_files_paths = glob.glob(os.path.join(TONE_FILES_DIR, "*.txt"))
+        # Tone names come from the config registry (gpt_tools/tone/*.txt)
+        tone_names = get_tones_list()
         
-        if not tone_files_paths:
+        if not tone_names:
             # Output a default or placeholder if no files are found, 
             # so the Espanso form doesn't break.
             print("NoTonesFound") 
             return
 
-        tone_names = []
-        for f_path in sorted(tone_files_paths):
-            # Get filename without extension
-            base_name = os.path.basename(f_path)
-            tone_name, _ = os.path.splitext(base_name)
-            tone_names.append(tone_name)
-        
         for name in tone_names:
             print(name)
             
@@ -32,4 +20,4 @@ def list_tone_files():
         print(f"ErrorListingTones: {e}")
 
 if __name__ == "__main__":
-    list_tone_files() 
\ No newline at end of file
+    list_tone_files()
\ No newline at end of file
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import os
+import sys
+import threading
+
+# The "Processing" spinner shared by text_processor.py, customer_support.py and multi-form.py.
+# It never sits on the request path: start_loading_popup() returns immediately, and the
+# window only appears if the request is still running after ESPANSO_GPT_SPINNER_DELAY
+# seconds (default 0.4), so cache hits and fast replies get no UI at all.
+# stop_loading_popup() only raises a flag and never joins: the window closes itself on its
+# next tick. All Tk objects live on the popup thread (Tk must not be touched from another one).
+SHOW_AFTER_SECONDS = float(os.environ.get("ESPANSO_GPT_SPINNER_DELAY", 0.4))
+TICK_MS = 120
+SPINNER_CHARS = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"] # Unicode Braille spinner
+POPUP_WIDTH, POPUP_HEIGHT = 220, 70
+PREVIEW_WIDTH, PREVIEW_HEIGHT = 520, 300
+
+def start_loading_popup(delay=None):
+    """Starts the deferred spinner and returns its handle (for update_preview and stop_loading_popup)."""
+    popup = {"stop": threading.Event(), "shown": False, "preview_text": None}
+    delay = SHOW_AFTER_SECONDS if delay is None else delay
+    threading.Thread(target=_run_popup, args=(popup, delay), daemon=True).start()
+    return popup
+
+def update_preview(popup, text):
+    """Publishes the text streamed so far; the popup draws it on its next tick."""
+    popup["preview_text"] = text
+
+def stop_loading_popup(popup):
+    """Closes the spinner (or keeps it from ever showing) without waiting; returns whether it was shown."""
+    popup["stop"].set()
+    return popup["shown"]
+
+def _center(root, width, height):
+    x = (root.winfo_screenwidth() // 2) - (width // 2)
+    y = (root.winfo_screenheight() // 2) - (height // 2)
+    root.geometry(f"{width}x{height}+{x}+{y}")
+
+def _run_popup(popup, delay):
+    if popup["stop"].wait(delay):
+        return # Done before the threshold: nothing to show
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+        root.title("Processing")
+        root.resizable(False, False)
+        root.attributes('-topmost', True)
+        root.overrideredirect(True) # No window decorations
+        _center(root, POPUP_WIDTH, POPUP_HEIGHT)
+
+        frame = tk.Frame(root, background='#f0f0f0', padx=10, pady=10) # Light grey background
+        frame.pack(expand=True, fill=tk.BOTH)
+        label = tk.Label(frame, text="Processing...", font=("Arial", 11), background='#f0f0f0')
+        label.pack(pady=10, expand=True)
+        widgets = {"root": root, "frame": frame, "label": label, "preview": None, "preview_shown": None}
+        popup["shown"] = True
+        _tick(popup, widgets, 0)
+        root.mainloop()
+    except Exception as e:
+        print(f"Error in loading popup thread: {e}", file=sys.stderr)
+
+def _render_preview(widgets, preview_text):
+    """Turns the spinner into a live preview of the streamed text."""
+    import tkinter as tk
+    text_widget = widgets["preview"]
+    if text_widget is None:
+        _center(widgets["root"], PREVIEW_WIDTH, PREVIEW_HEIGHT)
+        text_widget = tk.Text(widgets["frame"], wrap=tk.WORD, font=("Arial", 10), background='#ffffff', relief=tk.FLAT)
+        text_widget.pack(expand=True, fill=tk.BOTH)
+        widgets["preview"] = text_widget
+    text_widget.config(state=tk.NORMAL)
+    text_widget.delete("1.0", tk.END)
+    text_widget.insert(tk.END, preview_text.lstrip('"'))
+    text_widget.see(tk.END)
+    text_widget.config(state=tk.DISABLED)
+
+def _tick(popup, widgets, index):
+    import tkinter as tk
+    try:
+        if popup["stop"].is_set():
+            widgets["root"].destroy() # Ends mainloop, and with it the popup thread
+            return
+        widgets["label"].config(text=f"Processing {SPINNER_CHARS[index % len(SPINNER_CHARS)]}")
+        preview_text = popup["preview_text"]
+        if preview_text is not None and preview_text != widgets["preview_shown"]:
+            _render_preview(widgets, preview_text)
+            widgets["preview_shown"] = preview_text
+        widgets["root"].after(TICK_MS, _tick, popup, widgets, index + 1)
+    except tk.TclError: # The window was closed some other way
+        pass
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import time
+import threading
+import contextlib
+
+# Imported first by the trigger scripts (stdlib only), so this is as close to process start as we get.
+PROCESS_STARTED_AT = time.time()
+
+# One JSON record per trigger run, with timing spans in milliseconds:
+#   {"ts": ..., "kind": "action", "name": "Translate", "model": "gpt-4o-mini", "ok": true,
+#    "spans": {"imports": 412.0, "config_load": 1.2, "prompt_render": 0.1, "ttft": 630.4, "api": 1210.9, "total": 1650.2},
+#    "usage": {"prompt_tokens": 1520, "completion_tokens": 80, "total_tokens": 1600, "cached_tokens": 1280}}
+# The file is rotated at MAX_BYTES, keeping BACKUP_COUNT older files (metrics.jsonl.1, .2, ...).
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
+METRICS_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "metrics")
+METRICS_PATH = os.path.join(METRICS_DIR, "metrics.jsonl")
+MAX_BYTES = int(os.environ.get("ESPANSO_GPT_METRICS_MAX_BYTES", 5 * 1024 * 1024))
+BACKUP_COUNT = 3
+ENABLED = os.environ.get("ESPANSO_GPT_METRICS", "1") != "0"
+
+_write_lock = threading.Lock()
+_local = threading.local()
+_imports_done_at = None
+
+def mark_imports_done():
+    """Called by a script's __main__ once its imports are loaded; the next run then includes startup time."""
+    global _imports_done_at
+    _imports_done_at = time.time()
+
+class Run:
+    """Timing spans, usage and outcome of one trigger run."""
+
+    def __init__(self, kind, name):
+        global _imports_done_at
+        self.started_at = time.time()
+        self.record = {"ts": self.started_at, "kind": kind, "name": name, "model": None, "ok": True, "spans": {}, "usage": None}
+        if _imports_done_at is not None:
+            # Fresh process (not the daemon): count interpreter and import time too
+            self.started_at = PROCESS_STARTED_AT
+            self.add_span("imports", _imports_done_at - PROCESS_STARTED_AT)
+            _imports_done_at = None
+
+    def add_span(self, name, seconds):
+        """Adds seconds to a span (repeated spans, e.g. several API calls in one conversation, add up)."""
+        spans = self.record["spans"]
+        spans[name] = round(spans.get(name, 0.0) + seconds * 1000, 1)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.time() - started_at)
+
+    def set(self, **fields):
+        self.record.update(fields)
+
+    def add_usage(self, usage):
+        """Accumulates a usage dict ({"prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens"})."""
+        if not usage:
+            return
+        totals = self.record["usage"] or {}
+        for key, value in usage.items():
+            totals[key] = totals.get(key, 0) + (value or 0)
+        self.record["usage"] = totals
+
+    def finish(self, ok=None):
+        """Closes the run and appends it to the metrics log."""
+        if ok is not None:
+            self.record["ok"] = ok
+        self.add_span("total", time.time() - self.started_at)
+        if getattr(_local, "run", None) is self:
+            _local.run = None
+        write_record(self.record)
+
+class _NullRun(Run):
+    """Stands in when no run is active (e.g. a helper called outside a trigger run)."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.record = {"spans": {}, "usage": None}
+
+    def finish(self, ok=None):
+        pass
+
+def start_run(kind, name):
+    """Starts a run and makes it current for this thread."""
+    _local.run = Run(kind, name)
+    return _local.run
+
+def current_run():
+    """Returns this thread's active run, or a no-op run."""
+    return getattr(_local, "run", None) or _NullRun()
+
+def _rotate():
+    for index in range(BACKUP_COUNT - 1, 0, -1):
+        source = f"{METRICS_PATH}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{METRICS_PATH}.{index + 1}")
+    os.replace(METRICS_PATH, f"{METRICS_PATH}.1")
+
+def write_record(record):
+    if not ENABLED:
+        return
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _write_lock:
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            if os.path.exists(METRICS_PATH) and os.path.getsize(METRICS_PATH) + len(line) > MAX_BYTES:
+                _rotate()
+            with open(METRICS_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"ERROR metrics: Failed to write metrics record: {e}", file=sys.stderr)
+
+def read_records():
+    """Yields every record, oldest file first."""
+    paths = [f"{METRICS_PATH}.{index}" for index in range(BACKUP_COUNT, 0, -1)] + [METRICS_PATH]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def build_report(records, span_names=("total", "api", "ttft")):
+    """Groups records by (kind, name, model) and returns rows with count, error count, tokens, prompt cache
+    hit rate (share of prompt tokens served from the provider's cache) and p50/p95/p99 per span."""
+    groups = {}
+    for record in records:
+        key = (record.get("kind"), record.get("name"), record.get("model"))
+        groups.setdefault(key, []).append(record)
+    rows = []
+    for (kind, name, model), group in sorted(groups.items(), key=lambda item: tuple(str(part) for part in item[0])):
+        row = {"kind": kind, "name": name, "model": model, "count": len(group),
+               "errors": sum(1 for record in group if not record.get("ok", True)),
+               "tokens": sum((record.get("usage") or {}).get("total_tokens", 0) for record in group)}
+        prompt_tokens = sum((record.get("usage") or {}).get("prompt_tokens", 0) for record in group)
+        cached_tokens = sum((record.get("usage") or {}).get("cached_tokens", 0) for record in group)
+        row["cache_hit_rate"] = cached_tokens / prompt_tokens if prompt_tokens else None
+        for span_name in span_names:
+            values = sorted(record["spans"][span_name] for record in group if span_name in record.get("spans", {}))
+            row[span_name] = {"p50": percentile(values, 0.50), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99)}
+        rows.append(row)
+    return rows
+
+def print_report(rows, span_names=("total", "api", "ttft")):
+    def fmt(value):
+        return "-" if value is None else f"{value:.0f}"
+    header = f"{'kind':<8} {'name':<28} {'model':<16} {'runs':>5} {'err':>4} {'tokens':>8} {'cached':>6}"
+    for span_name in span_names:
+        header += f" {span_name + ' p50/p95/p99 ms':>24}"
+    print(header)
+    for row in rows:
+        cached = "-" if row["cache_hit_rate"] is None else f"{row['cache_hit_rate'] * 100:.0f}%"
+        line = f"{str(row['kind']):<8} {str(row['name'])[:28]:<28} {str(row['model'])[:16]:<16} {row['count']:>5} {row['errors']:>4} {row['tokens']:>8} {cached:>6}"
+        for span_name in span_names:
+            stats = row[span_name]
+            line += f" {fmt(stats['p50']) + '/' + fmt(stats['p95']) + '/' + fmt(stats['p99']):>24}"
+        print(line)
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+
+    if command == "report":
+        # Optional: only runs from the last N days, and extra spans to show (e.g. imports screenshot_capture)
+        since_days = float(sys.argv[2]) if len(sys.argv) > 2 else None
+        extra_spans = tuple(sys.argv[3:])
+        records = read_records()
+        if since_days is not None:
+            cutoff = time.time() - since_days * 86400
+            records = (record for record in records if record.get("ts", 0) >= cutoff)
+        span_names = ("total", "api", "ttft") + extra_spans
+        print_report(build_report(records, span_names), span_names)
+
+    elif command == "path":
+        print(METRICS_PATH)
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  metrics.py report [since_days] [extra_span ...]", file=sys.stderr)
+        print("  metrics.py path", file=sys.stderr)
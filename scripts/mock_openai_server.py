@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI chat completions endpoint, used by benchmark.py so
+# performance changes can be measured without the real (noisy, paid) API.
+# It speaks just enough of the protocol for the openai SDK: POST /v1/chat/completions,
+# plain (n choices when asked) or streamed (server-sent events, with the usage chunk when
+# stream_options asks for it).
+# Point any script at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+# Like the real API it reports prompt_tokens_details.cached_tokens: prompts of at least
+# 1024 tokens are "cached" by exact prefix in 128-token steps (tokens estimated as 4 characters).
+# Replies honour max_tokens (finish_reason "length" when cut off), and a request that sends
+# a cut-off reply back as an assistant message (a continuation) gets the rest of it.
+#
+# Behaviour is set per server (start_server(**config)) or from the environment for `serve`:
+#   ESPANSO_GPT_MOCK_LATENCY       seconds before the first byte (default 0.2)
+#   ESPANSO_GPT_MOCK_TOKEN_RATE    streamed tokens per second, 0 = all at once (default 200)
+#   ESPANSO_GPT_MOCK_TOKENS        completion length in tokens (default 60)
+#   ESPANSO_GPT_MOCK_ERROR_RATE    share of requests answered with an error (default 0)
+#   ESPANSO_GPT_MOCK_ERROR_STATUS  status code of injected errors (default 429)
+DEFAULT_CONFIG = {
+    "latency": float(os.environ.get("ESPANSO_GPT_MOCK_LATENCY", 0.2)),
+    "token_rate": float(os.environ.get("ESPANSO_GPT_MOCK_TOKEN_RATE", 200)),
+    "tokens": int(os.environ.get("ESPANSO_GPT_MOCK_TOKENS", 60)),
+    "error_rate": float(os.environ.get("ESPANSO_GPT_MOCK_ERROR_RATE", 0)),
+    "error_status": int(os.environ.get("ESPANSO_GPT_MOCK_ERROR_STATUS", 429)),
+}
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+CHARS_PER_TOKEN = 4
+REPLY_WORDS = ("Thanks", "for", "your", "message", "here", "is", "the", "updated", "text", "with", "a", "clear", "tone")
+
+def reply_tokens(count, offset=0):
+    """The canned reply, one word per token (never starts with NEED: or holds OPTIONS:, so multi-form ends in one turn).
+
+    offset rotates the words, so the n choices of one request differ.
+    """
+    return [("" if index == 0 else " ") + REPLY_WORDS[(index + offset) % len(REPLY_WORDS)] for index in range(count)]
+
+def remaining_reply(config, messages, offset=0):
+    """The reply tokens still to send: all of them, or after the partial reply a continuation request sends back."""
+    tokens = reply_tokens(config["tokens"], offset)
+    if len(messages) >= 2 and messages[-2].get("role") == "assistant":
+        tokens = tokens[len(str(messages[-2].get("content") or "").split()):]
+    return tokens
+
+def limit_reply(tokens, max_tokens):
+    """Cuts tokens to max_tokens; returns (tokens, finish_reason)."""
+    if max_tokens and len(tokens) > max_tokens:
+        return tokens[:max_tokens], "length"
+    return tokens, "stop"
+
+def estimate_prompt_tokens(messages):
+    return max(1, len(json.dumps(messages, ensure_ascii=False)) // CHARS_PER_TOKEN)
+
+def cached_prefix_tokens(server, messages):
+    """Returns how many leading prompt tokens were already seen in an earlier request, and remembers this prompt's prefixes."""
+    text = json.dumps(messages, ensure_ascii=False).encode("utf-8")
+    block_bytes = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+    digest = hashlib.sha1(text[:CACHE_MIN_TOKENS * CHARS_PER_TOKEN])
+    boundary, cached, prefixes = CACHE_MIN_TOKENS * CHARS_PER_TOKEN, 0, []
+    while boundary <= len(text):
+        prefixes.append(digest.hexdigest())
+        with server.lock:
+            if prefixes[-1] in server.prompt_prefixes:
+                cached = boundary // CHARS_PER_TOKEN
+        digest.update(text[boundary:boundary + block_bytes])
+        boundary += block_bytes
+    with server.lock:
+        server.prompt_prefixes.update(prefixes)
+    return cached
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API, so connection reuse is measured too
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, payload):
+        data = f"data: {payload}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        config = self.server.config
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server.lock:
+            self.server.request_count += 1
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        time.sleep(config["latency"])
+        if random.random() < config["error_rate"]:
+            self._send_json(config["error_status"], {"error": {"message": "Injected error", "type": "mock_error"}},
+                            {"Retry-After": "0"})
+            return
+
+        model = request.get("model", "mock")
+        messages = request.get("messages", [])
+        max_tokens = request.get("max_tokens") or request.get("max_completion_tokens")
+        tokens, finish_reason = limit_reply(remaining_reply(config, messages), max_tokens)
+        usage = {"prompt_tokens": estimate_prompt_tokens(messages),
+                 "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        usage["prompt_tokens_details"] = {"cached_tokens": cached_prefix_tokens(self.server, messages)}
+        base = {"id": f"chatcmpl-mock{self.server.request_count}", "created": int(time.time()), "model": model}
+
+        if not request.get("stream"):
+            choice_count = max(1, int(request.get("n") or 1))
+            usage["completion_tokens"] *= choice_count
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            choices = [limit_reply(remaining_reply(config, messages, index), max_tokens) for index in range(choice_count)]
+            self._send_json(200, dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": index, "message": {"role": "assistant", "content": "".join(choice_tokens)},
+                 "finish_reason": choice_finish_reason} for index, (choice_tokens, choice_finish_reason) in enumerate(choices)]))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        delay = 1.0 / config["token_rate"] if config["token_rate"] > 0 else 0
+        for index, token in enumerate(tokens):
+            delta = {"role": "assistant", "content": token} if index == 0 else {"content": token}
+            self._write_chunk(json.dumps(dict(base, object="chat.completion.chunk", choices=[
+                {"index": 0, "delta": delta, "finish_reason": None}])))
+            if delay:
+                time.sleep(delay)
+        self._write_chunk(json.dumps(dict(base, object="chat.completion.chunk", choices=[
+            {"index": 0, "delta": {}, "finish_reason": finish_reason}])))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._write_chunk(json.dumps(dict(base, object="chat.completion.chunk", choices=[], usage=usage)))
+        self._write_chunk("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+def start_server(port=0, **config):
+    """Starts the mock server on 127.0.0.1 in a daemon thread and returns it.
+
+    Its base URL (for OPENAI_BASE_URL) is server.base_url; server.config can be changed between runs.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.config = dict(DEFAULT_CONFIG, **config)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.prompt_prefixes = set()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+
+    if command == "serve":
+        server = start_server(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+        print(f"Mock OpenAI server on {server.base_url} ({server.config})", file=sys.stderr)
+        print(f"Use it with: OPENAI_BASE_URL={server.base_url}", file=sys.stderr)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  mock_openai_server.py [serve] [port]", file=sys.stderr)
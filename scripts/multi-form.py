@@ -1,22 +1,34 @@
 # gpt_chat.py
+import metrics # First, so its clock starts as close to process start as possible
 import sys, os, io, json
-import tkinter
-import threading
+import contextlib
+
+if __name__ == "__main__":
+    # Hand the run to the warm daemon when it is up (see gpt_daemon.py); otherwise run in-process below.
+    from daemon_client import delegate_to_daemon
+    from state_io import load_state as _load_state_for_daemon, delete_state as _delete_state_for_daemon, latest_checkpoint_id
+    # Resuming by hand (:gpt_final_processing): the given session ID, or the most recent checkpoint
+    _resume_session_id = sys.argv[1] if len(sys.argv) > 1 else latest_checkpoint_id()
+    _daemon_state = _load_state_for_daemon(_resume_session_id)
+    if _daemon_state and delegate_to_daemon("multi-form", [], state=_daemon_state):
+        _delete_state_for_daemon(_daemon_state.get("session_id"))
+        sys.exit(0)
+
 import time
-from openai import OpenAI
-import customtkinter
-from dotenv import load_dotenv
+from openai_client import API_KEY, prewarm_client, create_completion, complete_with_continuation, request_options, usage_to_dict
 from action_reader import get_task  # Import our new action reader
+from faq_index import faq_context
 
-# New imports for screenshot functionality
-import tempfile
-import pyautogui
-import base64
-import mimetypes
-from PIL import Image, UnidentifiedImageError
+# Screenshot capture (in memory, see screen_capture.py)
+from screen_capture import capture_screenshot
 
 # Assuming state_io.py is in the same directory or Python's path is configured.
-from state_io import load_state, delete_state, STATE_FILE_PATH, CONFIG_DIR
+from state_io import load_state, delete_state, latest_checkpoint_id, CONFIG_DIR
+from conversation_store import CONTEXT_DIR_PATH, save_conversation, load_conversation
+from blob_store import make_image_ref, materialize_messages
+from context_window import window_history, message_as_text
+from form_session import log_timing
+from loading_popup import start_loading_popup, stop_loading_popup
 
 DEBUG_MODE = False # Disable debug mode to prevent Espanso rendering errors
 
@@ -24,93 +36,35 @@ DEBUG_MODE = False # Disable debug mode to prevent Espanso rendering errors
 if sys.stdout.encoding != 'utf-8':
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
-# Load API key from .env file in the script's directory
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
-load_dotenv(dotenv_path)
-API_KEY = os.getenv("OPENAI_API_KEY")
 
 if not API_KEY:
     if DEBUG_MODE: sys.stderr.write("ERROR: OPENAI_API_KEY not found. Checked .env at: " + dotenv_path + "\n")
     print("ERROR: OPENAI_API_KEY not found. Please ensure it is set in scripts/.env")
     sys.exit(1)
 
-client = OpenAI(api_key=API_KEY)
-
 if DEBUG_MODE:
     sys.stderr.write("DEBUG: gpt_chat.py script started.\n")
 
 # Global GUI and state variables
 user_choice = None
 app_root = None 
-loading_popup_obj = {'root': None, 'label': None, 'running': False, 'char_index': 0}
-spinner_chars = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
-loading_thread = None
 
 # --- Constants for Conversation History ---
-CONTEXT_DIR_NAME = "gpt_tools/context"
-CONTEXT_DIR_PATH = os.path.join(CONFIG_DIR, CONTEXT_DIR_NAME)
+# CONTEXT_DIR_PATH (gpt_tools/context) comes from conversation_store
 LAST_CONV_ID_FILENAME = "last_conversation_id.txt"
 LAST_CONV_ID_FILEPATH = os.path.join(CONFIG_DIR, "gpt_tools", LAST_CONV_ID_FILENAME)
 
-# --- GUI Helper Functions (show_tk_loading_popup_in_thread, setup_root_window, destroy_root_window, etc.) ---
-# These functions (_tk_spinner_update, show_tk_loading_popup_in_thread, setup_root_window, destroy_root_window, 
-# show_custom_need_dialog, show_options_dialog) are assumed to be defined here as they were in the original script.
-# For brevity in this diff, their full code is not repeated but should be present.
-
-def _tk_spinner_update():
-    if not loading_popup_obj.get('running') or not loading_popup_obj.get('label'):
-        return
-    char = spinner_chars[loading_popup_obj['char_index']]
-    try:
-        if loading_popup_obj['label']:
-             loading_popup_obj['label'].config(text=f"Processing {char}")
-    except tkinter.TclError:
-        loading_popup_obj['running'] = False 
-        return
-    loading_popup_obj['char_index'] = (loading_popup_obj['char_index'] + 1) % len(spinner_chars)
-    if loading_popup_obj.get('root') and loading_popup_obj.get('running'):
-        try:
-            loading_popup_obj['root'].after(120, _tk_spinner_update)
-        except tkinter.TclError:
-             loading_popup_obj['running'] = False
-
-def show_tk_loading_popup_in_thread():
-    if DEBUG_MODE: sys.stderr.write("DEBUG: show_tk_loading_popup_in_thread started\n")
-    try:
-        root = tkinter.Tk()
-        loading_popup_obj['root'] = root
-        root.title("Processing")
-        root.geometry("220x70")
-        root.resizable(False, False)
-        root.attributes('-topmost', True)
-        root.overrideredirect(True)
-        screen_width = root.winfo_screenwidth()
-        screen_height = root.winfo_screenheight()
-        x = (screen_width // 2) - (220 // 2)
-        y = (screen_height // 2) - (70 // 2)
-        root.geometry(f"+{x}+{y}")
-        frame = tkinter.Frame(root, background='#f0f0f0', padx=10, pady=10)
-        frame.pack(expand=True, fill=tkinter.BOTH)
-        label = tkinter.Label(frame, text="Processing...", font=("Arial", 11), background='#f0f0f0')
-        label.pack(pady=10, expand=True)
-        loading_popup_obj['label'] = label
-        loading_popup_obj['running'] = True
-        loading_popup_obj['char_index'] = 0
-        _tk_spinner_update()
-        root.mainloop()
-    except Exception as e:
-        if DEBUG_MODE: sys.stderr.write(f"DEBUG ERROR in loading popup thread: {e}\n")
-    finally:
-        if DEBUG_MODE: sys.stderr.write("DEBUG: show_tk_loading_popup_in_thread finished\n")
-        loading_popup_obj['root'] = None
-        loading_popup_obj['label'] = None
-        loading_popup_obj['running'] = False
+# --- GUI Helper Functions (setup_root_window, destroy_root_window, show_custom_need_dialog, show_options_dialog) ---
+# The "Processing" spinner is the shared deferred one from loading_popup.py.
+# customtkinter is imported inside these functions, so a run that never shows a dialog never loads it.
 
 def setup_root_window():
     global app_root
     if DEBUG_MODE and app_root is None: sys.stderr.write("DEBUG: setup_root_window: app_root is None, creating new CTk root.\n")
     if DEBUG_MODE and app_root is not None and not app_root.winfo_exists(): sys.stderr.write("DEBUG: setup_root_window: app_root exists but window doesn't (destroyed), creating new CTk root.\n")
     if app_root is None or not app_root.winfo_exists():
+        import customtkinter
         app_root = customtkinter.CTk()
         app_root.withdraw()
         if DEBUG_MODE: sys.stderr.write("DEBUG: New CTk root created and withdrawn.\n")
@@ -127,6 +81,7 @@ def destroy_root_window():
 
 def show_custom_need_dialog(question_text, parent_window):
     if DEBUG_MODE: sys.stderr.write(f"DEBUG: show_custom_need_dialog: Question='{question_text[:100]}...'\n")
+    import customtkinter
     dialog_value = None
     dialog = customtkinter.CTkToplevel(parent_window)
     dialog.title("GPT Needs Info")
@@ -171,6 +126,7 @@ def show_custom_need_dialog(question_text, parent_window):
 def show_options_dialog(intro_text, options, parent_window):
     if DEBUG_MODE: sys.stderr.write(f"DEBUG: show_options_dialog: Intro='{intro_text[:100]}...', Options={options}\n")
     global user_choice
+    import customtkinter
     user_choice = None
     dialog = customtkinter.CTkToplevel(parent_window)
     dialog.title("GPT Suggests Options")
@@ -200,8 +156,7 @@ def show_options_dialog(intro_text, options, parent_window):
     parent_window.wait_window(dialog)
     return user_choice
 
-def ask_gpt(history):
-    global loading_thread
+def ask_gpt(history, recent_images=1, older_images="downscale", options=None):
     if DEBUG_MODE: sys.stderr.write(f"DEBUG ask_gpt: Called with history (last msg type: {history[-1]['role'] if history else 'N/A'}, content: '{str(history[-1]['content'])[:50]}...' if history else 'N/A')\n")
     
     # <<< ADDING HISTORY LOGGING TO FILE >>>
@@ -216,32 +171,47 @@ def ask_gpt(history):
             sys.stderr.write(f"ERROR ask_gpt: Could not write history to debug file: {e_hist_log}\n")
     # <<< END HISTORY LOGGING >>>
 
-    if loading_thread is None or not loading_thread.is_alive():
-        loading_thread = threading.Thread(target=show_tk_loading_popup_in_thread, daemon=True)
-        loading_thread.start()
-        time.sleep(0.3)
+    run_metrics = metrics.current_run()
+    # Only becomes visible if the request is still running after ESPANSO_GPT_SPINNER_DELAY (see loading_popup.py)
+    popup = start_loading_popup()
     try:
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=history,
-            temperature=0.3,
-        )
-        ai_response_content = r.choices[0].message.content
+        # Stored history references screenshots by hash; encode them only now, for this request
+        with run_metrics.span("prompt_render"):
+            request_messages = materialize_messages(history, recent_images=recent_images, older_images=older_images)
+        # Deadline, retries, optional hedging and the task's fallback_model (see openai_client.py);
+        # a reply cut off at the model's output limit is continued rather than returned truncated
+        with run_metrics.span("api"):
+            ai_response_content, usage = complete_with_continuation(
+                "gpt-4o-mini",
+                request_messages,
+                temperature=0.3,
+                **(options or {})
+            )
+        run_metrics.add_usage(usage)
         if DEBUG_MODE: sys.stderr.write(f"DEBUG ask_gpt: OpenAI API call successful. Response: '{ai_response_content[:100]}...'\n")
         return ai_response_content
     finally:
         if DEBUG_MODE: sys.stderr.write("DEBUG ask_gpt: In finally block, stopping loading indicator.\n")
-        if loading_popup_obj.get('root'):
-            loading_popup_obj['running'] = False
-            try:
-                loading_popup_obj['root'].after(0, loading_popup_obj['root'].destroy)
-            except tkinter.TclError:
-                pass 
-            except Exception as e:
-                pass
-        if loading_thread is not None and loading_thread.is_alive():
-            loading_thread.join(timeout=0.5)
-        loading_thread = None
+        if stop_loading_popup(popup): # Never waits for the popup thread
+            run_metrics.set(spinner_shown=True)
+
+def summarize_turns(previous_summary, messages):
+    """Folds older conversation turns into the rolling summary kept in the conversation file."""
+    transcript = "\n".join(message_as_text(m) for m in messages)
+    prompt = (
+        "Update the summary of a support conversation with the new turns below. Keep every fact, decision, "
+        "name, number and open question needed to continue the conversation. Reply with the summary only.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"
+    )
+    with metrics.current_run().span("history_summary"):
+        r = create_completion(
+            "gpt-4o-mini",
+            [{"role": "user", "content": prompt}],
+            temperature=0.2,
+            max_tokens=600,
+        )
+    metrics.current_run().add_usage(usage_to_dict(r.usage))
+    return r.choices[0].message.content.strip()
 
 # --- Persona Definitions (SPEECH_TO_TEXT_EDITOR_INSTRUCTIONS, base_system_prompt_core) ---
 # These are assumed to be defined here as they were in the original script.
@@ -287,6 +257,42 @@ base_system_prompt_core = (
     "provide a direct answer without any prefix. This should be your default mode of response."
 )
 
+PER_CALL_PLACEHOLDERS = ("sentiment_instruction", "relation_instruction", "language_instruction")
+SYSTEM_PROMPT_SEPARATOR = "\n\n---\n"
+
+def build_system_prompt(task_config, language_instruction, sentiment_instruction="", relation_instruction="", faq_content="",
+                        retrieved_faq=""):
+    """Assembles a task's system prompt with the content that is identical on every call first.
+
+    The provider caches prompts by exact prefix, so the order is: the NEED/OPTIONS protocol
+    (shared by all tasks), the task's own instructions, the FAQ body, and only then the
+    per-call language, sentiment and relation instructions, followed by the FAQ sections
+    retrieved for this message (retrieved_faq, see faq_index.py). A template that still places
+    one of those placeholders inline is formatted in place as before; the cacheable prefix
+    then ends there.
+    """
+    template = task_config.get("system_message_template", "")
+    values = {"language_instruction": language_instruction, "sentiment_instruction": sentiment_instruction,
+              "relation_instruction": relation_instruction, "faq_content": faq_content}
+    inline = {name for name in values if "{" + name + "}" in template}
+    try:
+        task_instructions = template.format(**{name: values[name] if name in inline else "" for name in values})
+    except (KeyError, IndexError, ValueError) as e:
+        if DEBUG_MODE: sys.stderr.write(f"DEBUG: Error formatting system message template: {e}. Using template as-is.\n")
+        task_instructions = template
+
+    sections = [base_system_prompt_core]
+    if task_instructions.strip() and base_system_prompt_core not in task_instructions:
+        sections.append(task_instructions.strip())
+    if "faq_content" not in inline and faq_content.strip():
+        sections.append(faq_content.strip())
+    per_call = [values[name].strip() for name in PER_CALL_PLACEHOLDERS if name not in inline and values[name].strip()]
+    if per_call:
+        sections.append("\n".join(per_call))
+    if retrieved_faq.strip():
+        sections.append(retrieved_faq.strip())
+    return SYSTEM_PROMPT_SEPARATOR.join(sections)
+
 # Helper to ensure context directory exists
 def ensure_context_dir():
     if not os.path.exists(CONTEXT_DIR_PATH):
@@ -304,26 +310,22 @@ def save_conversation_to_file(conversation_object):
     if not conv_id:
         if DEBUG_MODE: sys.stderr.write("ERROR: Attempted to save conversation without an ID.\n")
         return
-    file_path = os.path.join(CONTEXT_DIR_PATH, f"{conv_id}.json")
     try:
         conversation_object["last_updated_at"] = time.time()
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(conversation_object, f, indent=4)
-        if DEBUG_MODE: sys.stderr.write(f"DEBUG: Saved conversation to {file_path}\n")
+        # Appends only the new messages to <id>.messages.jsonl (see conversation_store.py)
+        save_conversation(conversation_object)
+        if DEBUG_MODE: sys.stderr.write(f"DEBUG: Saved conversation {conv_id} to {CONTEXT_DIR_PATH}\n")
     except Exception as e:
-        if DEBUG_MODE: sys.stderr.write(f"ERROR: Could not save conversation to {file_path}: {e}\n")
+        if DEBUG_MODE: sys.stderr.write(f"ERROR: Could not save conversation {conv_id}: {e}\n")
 
 # Helper to load a conversation from file
 def load_conversation_from_file(conversation_id):
-    file_path = os.path.join(CONTEXT_DIR_PATH, f"{conversation_id}.json")
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if DEBUG_MODE: sys.stderr.write(f"DEBUG: Loaded conversation {conversation_id} from {file_path}\n")
-                return data
-        except Exception as e:
-            if DEBUG_MODE: sys.stderr.write(f"ERROR: Could not load conversation {conversation_id} from {file_path}: {e}\n")
+    try:
+        data = load_conversation(conversation_id)
+        if data is not None and DEBUG_MODE: sys.stderr.write(f"DEBUG: Loaded conversation {conversation_id} from {CONTEXT_DIR_PATH}\n")
+        return data
+    except Exception as e:
+        if DEBUG_MODE: sys.stderr.write(f"ERROR: Could not load conversation {conversation_id}: {e}\n")
     return None
 
 # Helper to update last conversation ID tracker
@@ -335,8 +337,10 @@ def update_last_conversation_id(conversation_id):
     except Exception as e:
         if DEBUG_MODE: sys.stderr.write(f"ERROR: Could not update last_conversation_id.txt: {e}\n")
 
-def main_logic():
-    loaded_form_state = load_state() # This is from gpt_tools/gpt_form_state.json (temporary)
+def main_logic(loaded_form_state=None):
+    prewarm_client() # Import openai in the background while the conversation and prompt are prepared
+    if loaded_form_state is None:
+        loaded_form_state = load_state(latest_checkpoint_id()) # Direct runs only; form_session.py passes the state
     if DEBUG_MODE:
         sys.stderr.write(f"DEBUG gpt_chat.py: Loaded state: {loaded_form_state}\n")
 
@@ -389,18 +393,23 @@ def main_logic():
         desired_answer_sketch = loaded_form_state.get("desired_answer_sketch", "")
 
         # Get task configuration from JSON
-        task_config = get_task(selected_task_objective)
+        with metrics.current_run().span("config_load"):
+            task_config = get_task(selected_task_objective)
         if DEBUG_MODE:
             sys.stderr.write(f"DEBUG: Loaded task config for '{selected_task_objective}': {task_config}\n")
 
         # --- Construct final_system_message_for_api based on task configuration ---
-        faq_content_for_prompt = ""
+        faq_content_for_prompt, retrieved_faq_for_prompt = "", ""
         if selected_faq_filename and selected_faq_filename.strip().lower() not in ["none", ""]:
-            faq_file_path = os.path.join(CONFIG_DIR, "gpt_tools", "faq", selected_faq_filename) # Updated path
-            try: 
-                with open(faq_file_path, 'r', encoding='utf-8') as f_faq: 
-                    faq_data = f_faq.read()
-                    faq_content_for_prompt = f"\n\nFAQ: {faq_data}"
+            try:
+                # Small FAQ files come back whole; large ones (and "All FAQs") as the sections matching the message
+                faq_query = f"{loaded_form_state.get('initial_prompt', '')}\n{desired_answer_sketch}"
+                with metrics.current_run().span("faq_read"):
+                    faq_data, faq_is_full = faq_context(selected_faq_filename, faq_query)
+                if faq_is_full:
+                    faq_content_for_prompt = f"FAQ: {faq_data}"
+                elif faq_data:
+                    retrieved_faq_for_prompt = f"FAQ (sections relevant to this message):\n{faq_data}"
             except Exception as e:
                 if DEBUG_MODE:
                     sys.stderr.write(f"DEBUG: Error loading FAQ file: {e}\n")
@@ -421,29 +430,9 @@ def main_logic():
         if task_config.get("relation_instructions") and selected_relation in task_config["relation_instructions"]:
             relation_instruction = task_config["relation_instructions"][selected_relation]
 
-        # Get system message template from task config
-        system_message_template = task_config.get("system_message_template", base_system_prompt_core)
-        
-        # Format the system message with our extracted values
-        try:
-            final_system_message_for_api = system_message_template.format(
-                language_instruction=language_instruction,
-                sentiment_instruction=sentiment_instruction,
-                relation_instruction=relation_instruction,
-                faq_content=faq_content_for_prompt
-            )
-        except KeyError as e:
-            if DEBUG_MODE:
-                sys.stderr.write(f"DEBUG: Error formatting system message template: {e}. Using template as-is.\n")
-            final_system_message_for_api = system_message_template
-        except Exception as e:
-            if DEBUG_MODE:
-                sys.stderr.write(f"DEBUG: Unexpected error formatting system message: {e}. Using base prompt.\n")
-            final_system_message_for_api = f"{base_system_prompt_core}"
-
-        # Ensure base system prompt core is included if it's not already part of the template
-        if base_system_prompt_core not in final_system_message_for_api:
-            final_system_message_for_api = f"{final_system_message_for_api}\n\n---\n{base_system_prompt_core}"
+        # Stable content first, per-call instructions last (prompt-cache friendly)
+        final_system_message_for_api = build_system_prompt(task_config, language_instruction, sentiment_instruction,
+                                                           relation_instruction, faq_content_for_prompt, retrieved_faq_for_prompt)
         # --- End system prompt construction ---
 
         conv_messages = [{"role": "system", "content": final_system_message_for_api}]
@@ -467,86 +456,24 @@ def main_logic():
 
     user_message_content_parts = [{"type": "text", "text": current_initial_user_text}]
     image_message_for_api = None # Will be set by screenshot logic if successful
-    processed_screenshot_path = None 
-    temp_file_to_delete = None # For managing the lifecycle of the temp screenshot file
 
     if include_screenshot:
         if DEBUG_MODE: sys.stderr.write("DEBUG: Attempting to take REAL screenshot.\n")
         try:
-            # Create a named temporary file that won't be deleted immediately
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-                processed_screenshot_path = tmp_file.name
-                temp_file_to_delete = processed_screenshot_path # Mark this for deletion
-            
-            pyautogui.screenshot(processed_screenshot_path)
-            if DEBUG_MODE: sys.stderr.write(f"DEBUG: pyautogui.screenshot success. Temp path: {processed_screenshot_path}\n")
-            
-            if not os.path.exists(processed_screenshot_path) or os.path.getsize(processed_screenshot_path) == 0:
-                if DEBUG_MODE: sys.stderr.write(f"ERROR: Screenshot file empty or not created at {processed_screenshot_path}\n")
-                raise ValueError("Screenshot file empty or not created after pyautogui.screenshot")
-
-            img = Image.open(processed_screenshot_path)
-            if DEBUG_MODE: sys.stderr.write(f"DEBUG: Image.open success. Original format: {img.format}, mode: {img.mode}, size: {img.size}\n")
-            
-            original_format = img.format # Store original format for potential later use, though we mostly control output format
-            width, height = img.size
-            new_width, new_height = int(width * 0.5), int(height * 0.5)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            if DEBUG_MODE: sys.stderr.write(f"DEBUG: Image.resize success. New size: {img.size}\n")
-            
-            current_save_path = processed_screenshot_path # Start with the temp PNG path for saving
-            img.save(current_save_path, format="PNG", optimize=True)
-            current_mime_type = "image/png"
-            if DEBUG_MODE: sys.stderr.write(f"DEBUG: Image saved as PNG. Path: {current_save_path}, Size: {os.path.getsize(current_save_path) if os.path.exists(current_save_path) else 'File not found'}\n")
-            
-            file_size_bytes = os.path.getsize(current_save_path)
-            max_size_bytes = 19 * 1024 * 1024 # Approx 19MB limit
-
-            if file_size_bytes > max_size_bytes:
-                if DEBUG_MODE: sys.stderr.write(f"DEBUG: PNG ({file_size_bytes} bytes) > {max_size_bytes} bytes. Converting to JPEG.\n")
-                jpeg_output_path = os.path.splitext(current_save_path)[0] + ".jpg"
-                if img.mode == 'RGBA' or img.mode == 'P': # Convert to RGB if it has alpha or is palette-based for JPEG
-                    img = img.convert('RGB')
-                img.save(jpeg_output_path, format="JPEG", quality=85, optimize=True)
-                if DEBUG_MODE: sys.stderr.write(f"DEBUG: Image saved as JPEG. Path: {jpeg_output_path}, Size: {os.path.getsize(jpeg_output_path) if os.path.exists(jpeg_output_path) else 'File not found'}\n")
-                
-                # If the original temp file was PNG and we created a separate JPG, delete the PNG now
-                if temp_file_to_delete and temp_file_to_delete.endswith('.png') and temp_file_to_delete != jpeg_output_path and os.path.exists(temp_file_to_delete):
-                    try: 
-                        os.remove(temp_file_to_delete)
-                        if DEBUG_MODE: sys.stderr.write(f"DEBUG: Deleted intermediate PNG file: {temp_file_to_delete}\n")
-                    except Exception as e_del_png: 
-                        if DEBUG_MODE: sys.stderr.write(f"DEBUG: Could not delete intermediate PNG {temp_file_to_delete}: {e_del_png}\n")
-                
-                current_save_path = jpeg_output_path # The JPEG is now the file to read and delete
-                temp_file_to_delete = current_save_path # Update file to be deleted to the new JPEG path
-                current_mime_type = "image/jpeg"
-            
-            with open(current_save_path, "rb") as img_file_data:
-                image_data = img_file_data.read()
-            base64_image = base64.b64encode(image_data).decode("utf-8")
-            if DEBUG_MODE: 
-                sys.stderr.write(f"DEBUG: Base64 encoding success. Length: {len(base64_image)}. Preview (first 50, last 50): '{base64_image[:50]}...' '{base64_image[-50:]}...'\n")
-            
-            image_message_for_api = {"type": "image_url", "image_url": {"url": f"data:{current_mime_type};base64,{base64_image}"}}
-            if DEBUG_MODE: sys.stderr.write(f"DEBUG: Screenshot fully processed for API. MIME: {current_mime_type}\n")
-
+            # Captured in memory, scaled and encoded once (see screen_capture.py)
+            screenshot = capture_screenshot()
+            for stage, seconds in screenshot["timings"].items():
+                metrics.current_run().add_span(f"screenshot_{stage}", seconds)
+            # Stored once in gpt_tools/blobs/ and referenced by hash from the conversation history
+            image_message_for_api = make_image_ref(screenshot["data"], screenshot["mime_type"])
+            if DEBUG_MODE: sys.stderr.write(f"DEBUG: Screenshot stored as blob {image_message_for_api['image_ref']['sha256']}. {screenshot['width']}x{screenshot['height']} {screenshot['mime_type']}, {screenshot['bytes']} bytes, timings: {screenshot['timings']}\n")
         except Exception as e_screenshot:
             if DEBUG_MODE: sys.stderr.write(f"ERROR gpt_chat.py: Failed during REAL screenshot processing: {e_screenshot}\n")
-            # processed_screenshot_path may still be set if pyautogui.screenshot worked but PIL failed, useful for the note
-        finally:
-            # Ensure the FINAL version of the temp file (PNG or JPG) is deleted
-            if temp_file_to_delete and os.path.exists(temp_file_to_delete):
-                try:
-                    os.remove(temp_file_to_delete)
-                    if DEBUG_MODE: sys.stderr.write(f"DEBUG: Deleted final temp screenshot file: {temp_file_to_delete}\n")
-                except Exception as e_del_final:
-                    if DEBUG_MODE: sys.stderr.write(f"ERROR: Could not delete final temp screenshot file {temp_file_to_delete}: {e_del_final}\n")
-    
+
     if image_message_for_api:
         user_message_content_parts.append(image_message_for_api)
-    elif include_screenshot and processed_screenshot_path:
-        note_text = f"\n\n(Note: A screenshot was attempted from: {processed_screenshot_path} but may not have been sent to AI if image_message_for_api is None)"
+    elif include_screenshot:
+        note_text = "\n\n(Note: A screenshot was requested but could not be captured.)"
         if user_message_content_parts[0]["text"]:
             user_message_content_parts[0]["text"] += note_text
         else:
@@ -557,13 +484,28 @@ def main_logic():
     save_conversation_to_file(current_conversation) # Save state after adding initial user message
     if DEBUG_MODE: sys.stderr.write(f"DEBUG: Initial user message added. Total messages: {len(conv_messages)}\n")
 
+    # Image replay settings come from the task that started the conversation
+    with metrics.current_run().span("config_load"):
+        history_task_config = get_task((current_conversation.get("original_form_inputs") or {}).get("task_objective"))
+    recent_images = history_task_config.get("recent_images", 1)
+    older_images = history_task_config.get("older_images", "downscale")
+    history_token_budget = history_task_config.get("history_token_budget", 6000)
+    history_request_options = request_options(history_task_config)
+
     # --- Main Interaction Loop --- 
     max_loop_iterations = 15; loop_counter = 0
     while True:
         loop_counter += 1
         if loop_counter > max_loop_iterations: sys.stderr.write("ERROR: Loop limit.\n"); break
 
-        reply = ask_gpt(conv_messages) # Pass the messages list directly
+        # Send the system prompt, the rolling summary and the recent turns that fit the budget
+        with metrics.current_run().span("history_window"):
+            request_messages = window_history(current_conversation, history_token_budget, summarize_turns)
+        if loop_counter == 1:
+            log_timing(loaded_form_state, "first API call")
+            if loaded_form_state.get("submitted_at"):
+                metrics.current_run().add_span("form_to_first_call", time.time() - loaded_form_state["submitted_at"])
+        reply = ask_gpt(request_messages, recent_images=recent_images, older_images=older_images, options=history_request_options)
 
         if reply.startswith("NEED:"):
             q_raw = reply[5:].strip()
@@ -572,7 +514,8 @@ def main_logic():
             try:
                 current_root = setup_root_window()
                 if DEBUG_MODE: sys.stderr.write("DEBUG MainLoop: About to show custom NEED dialog\n")
-                a = show_custom_need_dialog(q_raw, current_root)
+                with metrics.current_run().span("user_wait"): # Time spent answering, not latency
+                    a = show_custom_need_dialog(q_raw, current_root)
                 if DEBUG_MODE: sys.stderr.write(f"DEBUG MainLoop: Input from custom NEED dialog: {a}\n")
             except Exception as e_dialog:
                 if DEBUG_MODE: sys.stderr.write(f"DEBUG ERROR in NEED dialog: {e_dialog}\n")
@@ -600,7 +543,8 @@ def main_logic():
                     raise ValueError("Parsed JSON from OPTIONS is not a list of strings")
                 current_root = setup_root_window()
                 if DEBUG_MODE: sys.stderr.write("DEBUG MainLoop: About to show options dialog\n")
-                selected_option = show_options_dialog(intro_question, options_list, current_root)
+                with metrics.current_run().span("user_wait"): # Time spent choosing, not latency
+                    selected_option = show_options_dialog(intro_question, options_list, current_root)
                 if DEBUG_MODE: sys.stderr.write(f"DEBUG MainLoop: Selected option: {selected_option}\n")
                 if selected_option is None:
                     if DEBUG_MODE: sys.stderr.write("DEBUG MainLoop: OPTIONS dialog cancelled. Exiting script.\n")
@@ -623,24 +567,45 @@ def main_logic():
             update_last_conversation_id(active_conversation_id) # Mark this as last successfully completed
             loop_counter = 0; break
 
+def run(form_state):
+    """Runs one conversation turn for the given form state (used by gpt_daemon.py) and returns the printed output."""
+    captured_output = io.StringIO()
+    run_metrics = metrics.start_run("task", (form_state or {}).get("task_objective"))
+    try:
+        with contextlib.redirect_stdout(captured_output):
+            ensure_context_dir()
+            main_logic(form_state)
+    except Exception as e:
+        if DEBUG_MODE: sys.stderr.write(f"CRITICAL ERROR in gpt_chat.py run: {e}\n")
+        run_metrics.set(ok=False, error=type(e).__name__)
+        captured_output.write(f"An unexpected error occurred in gpt_chat.py: {e}\n")
+    finally:
+        run_metrics.finish()
+    return captured_output.getvalue().rstrip("\n")
+
 if __name__ == "__main__":
     # This main guard is now the entry point when script is run by Espanso
     # (via :gpt_final_processing trigger)
     # or for direct testing if state file is pre-populated.
     if DEBUG_MODE: sys.stderr.write("DEBUG: gpt_chat.py __main__ execution started.\n")
+    form_state = load_state(sys.argv[1] if len(sys.argv) > 1 else latest_checkpoint_id()) # The session to resume (gpt_tools/sessions/)
+    metrics.mark_imports_done()
+    run_metrics = metrics.start_run("task", form_state.get("task_objective"))
     try:
         ensure_context_dir() # Ensure dir exists when script starts (e.g. for direct testing)
-        main_logic()
+        main_logic(form_state)
     except Exception as e:
         if DEBUG_MODE: sys.stderr.write(f"CRITICAL ERROR in gpt_chat.py main_logic: {e}\n")
+        run_metrics.set(ok=False, error=type(e).__name__)
         # Try to print error to stdout for Espanso visibility if possible
         print(f"An unexpected error occurred in gpt_chat.py: {e}")
     finally:
         if DEBUG_MODE: sys.stderr.write("DEBUG: gpt_chat.py __main__ in finally block. Cleaning up GUI and state.\n")
-        delete_state() # Attempt to delete the state file
-        try:
-            delete_state() # Attempt to delete the state file
-            if DEBUG_MODE: sys.stderr.write("DEBUG: State file deleted successfully.\n")
-        except Exception as e_del_state:
-            if DEBUG_MODE: sys.stderr.write(f"ERROR deleting state file during cleanup: {e_del_state}\n")
+        run_metrics.finish()
+        if form_state:
+            try:
+                delete_state(form_state.get("session_id")) # Only this run's session; concurrent runs keep theirs
+                if DEBUG_MODE: sys.stderr.write("DEBUG: State file deleted successfully.\n")
+            except Exception as e_del_state:
+                if DEBUG_MODE: sys.stderr.write(f"ERROR deleting state file during cleanup: {e_del_state}\n")
     if DEBUG_MODE: sys.stderr.write("DEBUG: gpt_chat.py __main__ execution finished.\n")
\ No newline at end of file
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+from metrics import current_run
+
+# Load API key from .env file in the same directory as the script
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+API_KEY = os.getenv("OPENAI_API_KEY")
+
+# One client per process; the daemon (gpt_daemon.py) keeps it warm across runs.
+# The openai package is the slowest import by far (most of a cold start), so it is only
+# imported here, on first use, and the trigger scripts start that in the background with
+# prewarm_client() while their popup opens and the prompt is built.
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock: # A prewarm thread may be creating it right now
+            if _client is None:
+                from openai import OpenAI
+                _client = OpenAI(api_key=API_KEY)
+    return _client
+
+def prewarm_client():
+    """Imports openai and creates the client in a daemon thread, so a later get_client() finds it ready."""
+    if _client is None:
+        threading.Thread(target=get_client, daemon=True).start()
+
+def usage_to_dict(usage):
+    """Extracts token counts from a completion's usage object (None if the API sent none).
+
+    cached_tokens is the part of prompt_tokens served from the provider's prompt cache
+    (prompts are cached by exact prefix, see build_system_prompt in multi-form.py).
+    """
+    if usage is None:
+        return None
+    prompt_details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "total_tokens": getattr(usage, "total_tokens", 0) or 0,
+        "cached_tokens": getattr(prompt_details, "cached_tokens", 0) or 0,
+    }
+
+# --- Request layer: deadlines, retries with backoff, hedging and a fallback model ---
+# Every completion goes through create_completion() so a latency spike or a 429/5xx
+# never leaves an expansion hanging. Defaults can be tuned without code changes, and
+# actions/tasks can override them with "timeout_seconds", "hedge" and "fallback_model".
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("ESPANSO_GPT_REQUEST_TIMEOUT", 60))
+MAX_RETRIES = int(os.getenv("ESPANSO_GPT_MAX_RETRIES", 2))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+HEDGE_ENABLED = os.getenv("ESPANSO_GPT_HEDGE") == "1"
+HEDGE_AFTER_SECONDS = float(os.getenv("ESPANSO_GPT_HEDGE_AFTER", 4.0)) # Used until enough latencies are known for a p95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+_latencies = {} # model -> deque of recent successful request durations (kept warm in the daemon)
+_latencies_lock = threading.Lock()
+
+class RequestDeadlineExceeded(Exception):
+    """Raised when no attempt finished before the call's deadline."""
+
+def _record_latency(model, seconds):
+    with _latencies_lock:
+        _latencies.setdefault(model, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+def hedge_delay(model):
+    """Seconds to wait before hedging: the observed p95 latency for model, or HEDGE_AFTER_SECONDS."""
+    with _latencies_lock:
+        samples = sorted(_latencies.get(model, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_AFTER_SECONDS
+    return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+def is_retryable(error):
+    """True for rate limits, server errors, timeouts and connection failures."""
+    import openai
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code == 429 or (status_code is not None and status_code >= 500)
+
+def _is_model_unavailable(error):
+    return getattr(error, "status_code", None) == 404
+
+def _backoff_seconds(attempt, error):
+    """Jittered exponential backoff, honouring the server's Retry-After when it sends one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after:
+            return min(float(retry_after), BACKOFF_MAX_SECONDS)
+    except ValueError:
+        pass
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def start_in_thread(fn):
+    """Runs fn in a daemon thread (a losing hedge or an unpicked variant must not keep the process alive) and returns a Future."""
+    future = Future()
+    def worker():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+    threading.Thread(target=worker, daemon=True).start()
+    return future
+
+def _hedged(fn, delay, deadline):
+    """Calls fn, and again if the first call hasn't finished after delay; returns the first success."""
+    futures = [start_in_thread(fn)]
+    wait(futures, timeout=max(0.0, min(delay, deadline - time.monotonic())))
+    if not futures[0].done() and time.monotonic() < deadline:
+        futures.append(start_in_thread(fn))
+    error = None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error or RequestDeadlineExceeded("No response before the deadline")
+
+def request_options(config):
+    """Picks the request layer settings ("fallback_model", "timeout_seconds", "hedge") from an action or task config."""
+    return {
+        "fallback_model": config.get("fallback_model"),
+        "timeout_seconds": config.get("timeout_seconds"),
+        "hedge": config.get("hedge"),
+    }
+
+def create_completion(model, messages, fallback_model=None, timeout_seconds=None, hedge=None, **kwargs):
+    """Calls chat.completions.create with a deadline, retries and an optional fallback model.
+
+    Retryable errors (429, 5xx, timeouts, connection errors) are retried with jittered
+    exponential backoff until MAX_RETRIES or the deadline. After that, or when the model
+    is unavailable, fallback_model is tried with the time left. With hedge, a non-streamed
+    request is sent a second time if the first hasn't answered after the model's p95
+    latency, and the first answer wins. Returns the completion (or the stream).
+    """
+    timeout_seconds = timeout_seconds or REQUEST_TIMEOUT_SECONDS
+    hedge = HEDGE_ENABLED if hedge is None else hedge
+    deadline = time.monotonic() + timeout_seconds
+    models = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+    last_error = None
+    run = current_run()
+
+    for current_model in models:
+        for attempt in range(MAX_RETRIES + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise last_error or RequestDeadlineExceeded(f"No response within {timeout_seconds:.0f}s")
+            # The SDK's own retries are disabled so this loop alone decides what is retried
+            attempt_client = get_client().with_options(timeout=remaining, max_retries=0)
+            def call():
+                return attempt_client.chat.completions.create(model=current_model, messages=messages, **kwargs)
+            started_at = time.monotonic()
+            run.record["attempts"] = run.record.get("attempts", 0) + 1
+            try:
+                if hedge and not kwargs.get("stream"):
+                    result = _hedged(call, hedge_delay(current_model), deadline)
+                else:
+                    result = call()
+                _record_latency(current_model, time.monotonic() - started_at)
+                run.set(model=current_model) # The model that actually answered (may be the fallback)
+                return result
+            except Exception as e:
+                last_error = e
+                if _is_model_unavailable(e):
+                    break # Straight to the fallback model
+                if not (is_retryable(e) or isinstance(e, RequestDeadlineExceeded)):
+                    raise
+                if attempt < MAX_RETRIES and time.monotonic() < deadline:
+                    delay = _backoff_seconds(attempt, e)
+                    print(f"WARN openai_client: {current_model} attempt {attempt + 1} failed ({e}); retrying in {delay:.1f}s", file=sys.stderr)
+                    time.sleep(max(0.0, min(delay, deadline - time.monotonic())))
+        if current_model != models[-1]:
+            print(f"WARN openai_client: {current_model} failed ({last_error}); falling back to {models[-1]}", file=sys.stderr)
+    raise last_error
+
+# --- Truncated replies ---
+# A reply that stops because it hit max_tokens (finish_reason "length") is continued: the
+# partial answer goes back as an assistant message followed by CONTINUE_PROMPT, and the
+# continuation is appended, up to MAX_CONTINUATIONS times. This is what makes sizing
+# max_tokens from the input (context_window.output_token_budget) safe.
+MAX_CONTINUATIONS = int(os.getenv("ESPANSO_GPT_MAX_CONTINUATIONS", 2))
+CONTINUE_PROMPT = ("Your previous answer was cut off. Continue it exactly where it stopped, "
+                   "without repeating anything and without any comment.")
+
+def merge_usage(usage, more):
+    """Adds two usage dicts (either may be None)."""
+    if not usage or not more:
+        return usage or more
+    return {key: usage.get(key, 0) + more.get(key, 0) for key in set(usage) | set(more)}
+
+def continuation_messages(messages, partial):
+    """The request that asks for the rest of partial, a reply to messages cut off by max_tokens."""
+    return messages + [{"role": "assistant", "content": partial}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+def complete_with_continuation(model, messages, max_tokens=None, continue_max_tokens=None,
+                               max_continuations=MAX_CONTINUATIONS, **kwargs):
+    """Non-streamed create_completion() that continues a reply truncated by max_tokens.
+
+    Continuations are requested with continue_max_tokens (max_tokens if not given).
+    Returns (text, usage) and records "continuations" (and "truncated" if the reply
+    is still cut off) in the current run's metrics.
+    """
+    continue_max_tokens = continue_max_tokens or max_tokens
+    completion = create_completion(model, messages, **({"max_tokens": max_tokens} if max_tokens else {}), **kwargs)
+    text = completion.choices[0].message.content or ""
+    usage = usage_to_dict(completion.usage)
+    finish_reason = completion.choices[0].finish_reason
+    continuations = 0
+    while finish_reason == "length" and continuations < max_continuations:
+        continuations += 1
+        completion = create_completion(model, continuation_messages(messages, text),
+                                       **({"max_tokens": continue_max_tokens} if continue_max_tokens else {}), **kwargs)
+        text += completion.choices[0].message.content or ""
+        usage = merge_usage(usage, usage_to_dict(completion.usage))
+        finish_reason = completion.choices[0].finish_reason
+    current_run().set(continuations=continuations, **({"truncated": True} if finish_reason == "length" else {}))
+    return text, usage
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import signal
+import threading
+
+# Speculative prefetch for the :rephrase: form. The match reads the clipboard before the
+# form opens, so the request the form is most often submitted with (the default action,
+# tone and language on the untouched clipboard text) can start while the user is still
+# looking at the form. A script var runs `prefetch.py start "<clipboard>"`, which hands that
+# request to the daemon, or to a detached background process when the daemon is not
+# running, and returns at once with no output.
+#
+# Prefetched results live in gpt_tools/cache/prefetch/<key>.json, where key is the
+# response cache key of the fully rendered request (see response_cache.make_cache_key).
+# An entry is {"status": "running" | "done", "pid", "owner", "deadline", "result"}. When the
+# form is submitted, text_processor.process_text() computes the same key: a finished entry
+# is used as is, a running one is waited for (it started seconds earlier than a new request
+# would), and every other entry is cancelled (its file removed and, for a background
+# process, the process terminated). A prefetch thread in the daemon cannot be stopped; its
+# result is simply dropped. "pid" is the process that may be terminated (None for a thread),
+# "owner" the process the prefetch runs in: the wait ends as soon as the owner is gone
+# (a crashed worker, a stopped daemon) and after MAX_WAIT_SECONDS at the most, when the
+# form's request is sent as usual.
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
+PREFETCH_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "prefetch")
+ENABLED = os.environ.get("ESPANSO_GPT_PREFETCH", "1") != "0"
+# What the form is submitted with when only the text is kept (the form's defaults in match/text_actions.yml)
+DEFAULT_ACTION = os.environ.get("ESPANSO_GPT_PREFETCH_ACTION", "Rephrase")
+DEFAULT_TONE = os.environ.get("ESPANSO_GPT_PREFETCH_TONE", "Friendly")
+DEFAULT_LANGUAGE = os.environ.get("ESPANSO_GPT_PREFETCH_LANGUAGE", "French")
+MAX_CHARS = int(os.environ.get("ESPANSO_GPT_PREFETCH_MAX_CHARS", 6000)) # Longer clipboards are not worth a speculative request
+MAX_WAIT_SECONDS = float(os.environ.get("ESPANSO_GPT_PREFETCH_MAX_WAIT", 15)) # Longest claim() waits for a running prefetch
+POLL_SECONDS = 0.02
+DEADLINE_GRACE_SECONDS = 5
+
+def _entry_path(key):
+    return os.path.join(PREFETCH_DIR, f"{key}.json")
+
+def _read_entry(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_entry(path, entry):
+    os.makedirs(PREFETCH_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _alive(pid):
+    """False once process pid has exited (zombies included, since nothing may reap a detached worker)."""
+    if os.name == "nt":
+        return True # os.kill(pid, 0) would terminate the process on Windows; the deadline still applies
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True # Exists but belongs to someone else
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+def _cancel(path):
+    """Drops a prefetch entry and terminates its background process if it is still running."""
+    entry = _read_entry(path)
+    _remove(path)
+    if entry and entry.get("status") == "running" and entry.get("pid") and time.time() < entry.get("deadline", 0):
+        try:
+            os.kill(entry["pid"], signal.SIGTERM)
+        except OSError:
+            pass
+
+def cancel_all(keep=None):
+    """Cancels every prefetch except the one for key keep."""
+    try:
+        names = os.listdir(PREFETCH_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith(".json") and name != f"{keep}.json":
+            _cancel(os.path.join(PREFETCH_DIR, name))
+
+def begin(key, timeout_seconds):
+    """Marks a prefetch for key as running; returns False if one is already running or done."""
+    path = _entry_path(key)
+    if os.path.exists(path):
+        return False
+    # A background process runs the prefetch on its main thread and may be terminated on
+    # cancel; a thread of the daemon (or of any other process) must not take its process with it
+    owns_process = threading.current_thread() is threading.main_thread()
+    try:
+        _write_entry(path, {"status": "running", "pid": os.getpid() if owns_process else None, "owner": os.getpid(),
+                            "deadline": time.time() + timeout_seconds + DEADLINE_GRACE_SECONDS})
+    except OSError as e:
+        print(f"ERROR prefetch: Failed to write {path}: {e}", file=sys.stderr)
+        return False
+    return True
+
+def publish(key, result):
+    """Stores a prefetched process_text() result, unless the prefetch was cancelled meanwhile."""
+    path = _entry_path(key)
+    if not os.path.exists(path):
+        return
+    try:
+        _write_entry(path, {"status": "done", "pid": None, "deadline": 0, "result": result})
+    except OSError as e:
+        print(f"ERROR prefetch: Failed to write {path}: {e}", file=sys.stderr)
+
+def claim(key):
+    """Returns the prefetched result for key, waiting while it is still running, or None.
+
+    Every other prefetch is cancelled: the form was submitted with other values.
+    """
+    cancel_all(keep=key)
+    path = _entry_path(key)
+    entry = _read_entry(path)
+    wait_until = time.time() + MAX_WAIT_SECONDS
+    while entry and entry.get("status") == "running" and time.time() < min(entry.get("deadline", 0), wait_until):
+        if entry.get("owner") and not _alive(entry["owner"]):
+            break # It will never publish
+        time.sleep(POLL_SECONDS)
+        entry = _read_entry(path)
+    _cancel(path)
+    if not entry or entry.get("status") != "done" or entry["result"].get("error"):
+        return None
+    return entry["result"]
+
+def prefetch_default_action(input_text):
+    """Runs the default :rephrase: request for input_text and publishes it (the worker side)."""
+    import metrics
+    import text_processor
+    run_metrics = metrics.start_run("prefetch", DEFAULT_ACTION)
+    text_processor.prewarm_client()
+    try:
+        result = text_processor.process_text(DEFAULT_ACTION, DEFAULT_TONE, input_text, DEFAULT_LANGUAGE, "",
+                                             stream=False, prefetching=True)
+        run_metrics.set(ok=not result["error"])
+    finally:
+        run_metrics.finish()
+
+def run(args):
+    """Daemon entry (gpt_daemon.py): starts the prefetch in a thread and returns at once."""
+    threading.Thread(target=prefetch_default_action, args=(args[0],), daemon=True).start()
+    return ""
+
+def start(input_text):
+    """Starts the prefetch for the form about to open, in the daemon or a detached process."""
+    cancel_all() # Left over from an earlier form that was closed without submitting
+    if not ENABLED or not input_text.strip() or len(input_text) > MAX_CHARS:
+        return
+    from daemon_client import delegate_to_daemon, spawn_detached
+    if delegate_to_daemon("prefetch", [input_text]):
+        return
+    spawn_detached([os.path.abspath(__file__), "run", input_text])
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "run" and len(sys.argv) == 3:
+        prefetch_default_action(sys.argv[2])
+
+    elif command == "clear":
+        cancel_all()
+
+    elif command == "start" and len(sys.argv) == 3:
+        # The form's script var: its output is not used
+        start(sys.argv[2])
+
+    else:
+        print("Usage:", file=sys.stderr)
+        print("  prefetch.py start \"<clipboard text>\"   # Start the prefetch (from the :rephrase: match)", file=sys.stderr)
+        print("  prefetch.py run \"<text>\"                # Run it in this process (what the detached worker does)", file=sys.stderr)
+        print("  prefetch.py clear                       # Cancel every pending prefetch", file=sys.stderr)
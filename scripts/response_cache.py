@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+# Same config directory resolution as state_io.py
+CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
+CACHE_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "cache", "responses")
+STATS_PATH = os.path.join(CACHE_DIR, "stats.json")
+
+# Limits can be tuned without code changes
+MAX_CACHE_BYTES = int(os.environ.get("ESPANSO_GPT_CACHE_MAX_BYTES", 20 * 1024 * 1024))
+DEFAULT_TTL_SECONDS = int(os.environ.get("ESPANSO_GPT_CACHE_TTL", 7 * 24 * 3600))
+
+# Batch runs (batch_processor.py) use the cache from several threads at once
+_stats_lock = threading.Lock()
+
+def make_cache_key(messages, model, temperature, max_tokens):
+    """Hashes the fully rendered request so identical requests share one entry."""
+    payload = json.dumps(
+        {"messages": messages, "model": model, "temperature": temperature, "max_tokens": max_tokens},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def _tmp_path(path):
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def _update_stats(field):
+    with _stats_lock:
+        stats = load_stats()
+        stats[field] = stats.get(field, 0) + 1
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = _tmp_path(STATS_PATH)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, STATS_PATH)
+        except OSError as e:
+            print(f"ERROR response_cache: Failed to update stats: {e}", file=sys.stderr)
+
+def load_stats():
+    """Returns the persisted hit/miss counters."""
+    try:
+        with open(STATS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"hits": 0, "misses": 0}
+
+def get_cached_response(key, ttl_seconds=None):
+    """Returns the cached text for key, or None on a miss or an expired entry."""
+    ttl_seconds = DEFAULT_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    path = _entry_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        _update_stats("misses")
+        return None
+
+    if time.time() - entry.get("created_at", 0) > ttl_seconds:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        _update_stats("misses")
+        return None
+
+    # Touch the entry so eviction treats it as recently used
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    _update_stats("hits")
+    return entry.get("content")
+
+def store_response(key, content, model=None):
+    """Stores content under key and evicts least recently used entries past MAX_CACHE_BYTES."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = _tmp_path(_entry_path(key))
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "model": model, "content": content}, f, ensure_ascii=False)
+        os.replace(tmp_path, _entry_path(key))
+        evict(MAX_CACHE_BYTES)
+    except OSError as e:
+        print(f"ERROR response_cache: Failed to store entry {key}: {e}", file=sys.stderr)
+
+def _list_entries():
+    """Returns (path, size, mtime) for every cache entry."""
+    entries = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".json") or name == os.path.basename(STATS_PATH):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((path, st.st_size, st.st_mtime))
+    return entries
+
+def evict(max_bytes):
+    """Deletes least recently used entries until the cache fits in max_bytes."""
+    entries = _list_entries()
+    total_bytes = sum(size for _, size, _ in entries)
+    for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+        except OSError:
+            pass
+
+def get_stats():
+    """Returns hits, misses, entry count and bytes on disk."""
+    entries = _list_entries()
+    stats = load_stats()
+    return {
+        "hits": stats.get("hits", 0),
+        "misses": stats.get("misses", 0),
+        "entries": len(entries),
+        "bytes": sum(size for _, size, _ in entries),
+        "max_bytes": MAX_CACHE_BYTES,
+    }
+
+def clear_cache():
+    """Deletes every entry and resets the counters."""
+    for path, _, _ in _list_entries():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    if os.path.exists(STATS_PATH):
+        os.remove(STATS_PATH)
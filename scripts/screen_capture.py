@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import os
+import sys
+import io
+import time
+import base64
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# Shared screenshot pipeline for customer_support.py and multi-form.py.
+# The screen is grabbed straight into memory, scaled once to what the vision model
+# actually uses, and encoded once into a buffer; no temp files are written.
+# The budget can be tuned without code changes:
+#   ESPANSO_GPT_SCREENSHOT_MAX_SIDE   long side in px (default 2048, the vision model's own limit)
+#   ESPANSO_GPT_SCREENSHOT_SHORT_SIDE short side in px (default 768; larger images are scaled down server-side anyway)
+#   ESPANSO_GPT_SCREENSHOT_MAX_BYTES  encoded size budget (default 1 MB)
+#   ESPANSO_GPT_SCREENSHOT_FORMAT     "auto" (PNG, JPEG if over budget), "png" or "jpeg"
+#   ESPANSO_GPT_SCREENSHOT_TIMEOUT    seconds to wait for a background capture (default 3)
+MAX_SIDE = int(os.environ.get("ESPANSO_GPT_SCREENSHOT_MAX_SIDE", 2048))
+SHORT_SIDE = int(os.environ.get("ESPANSO_GPT_SCREENSHOT_SHORT_SIDE", 768))
+MAX_BYTES = int(os.environ.get("ESPANSO_GPT_SCREENSHOT_MAX_BYTES", 1024 * 1024))
+IMAGE_FORMAT = os.environ.get("ESPANSO_GPT_SCREENSHOT_FORMAT", "auto").lower()
+CAPTURE_TIMEOUT_SECONDS = float(os.environ.get("ESPANSO_GPT_SCREENSHOT_TIMEOUT", 3.0))
+
+JPEG_QUALITIES = (85, 70, 55) # Tried in order until the image fits MAX_BYTES
+SHRINK_FACTOR = 0.75 # Applied to the resolution when even the lowest quality is over budget
+
+DEBUG_MODE = False
+
+def target_size(width, height, max_side=MAX_SIDE, short_side=SHORT_SIDE):
+    """Returns the (width, height) that fits both side limits, never upscaling."""
+    scale = min(1.0, max_side / max(width, height), short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _encode(img, image_format, quality=None):
+    buffer = io.BytesIO()
+    if image_format == "png":
+        img.save(buffer, format="PNG", compress_level=6)
+    else:
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def encode_image(img, max_bytes=MAX_BYTES, image_format=IMAGE_FORMAT):
+    """Encodes a PIL image within max_bytes and returns (bytes, mime_type).
+
+    PNG is kept when it fits (sharpest for text); otherwise JPEG quality and then
+    resolution are lowered step by step.
+    """
+    if image_format in ("auto", "png"):
+        data = _encode(img, "png")
+        if len(data) <= max_bytes or image_format == "png":
+            return data, "image/png"
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    while True:
+        for quality in JPEG_QUALITIES:
+            data = _encode(img, "jpeg", quality)
+            if len(data) <= max_bytes:
+                return data, "image/jpeg"
+        if min(img.size) <= 64:
+            return data, "image/jpeg"
+        from PIL import Image
+        img = img.resize((max(1, int(img.width * SHRINK_FACTOR)), max(1, int(img.height * SHRINK_FACTOR))), Image.Resampling.LANCZOS)
+
+def capture_screenshot(max_bytes=MAX_BYTES, image_format=IMAGE_FORMAT, grab=None):
+    """Grabs the screen and returns a dict with "data", "mime_type", "width", "height", "bytes" and per-stage "timings".
+
+    grab() returns the raw PIL image (pyautogui.screenshot by default; benchmark.py passes a synthetic one).
+    """
+    from PIL import Image
+    if grab is None:
+        import pyautogui
+        grab = pyautogui.screenshot
+    timings = {}
+
+    started_at = time.perf_counter()
+    img = grab()
+    timings["capture"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    original_size = img.size
+    new_size = target_size(*img.size)
+    if new_size != img.size:
+        # reducing_gap does a fast integer reduce first, then LANCZOS on the smaller image
+        img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    timings["resize"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    data, mime_type = encode_image(img, max_bytes, image_format)
+    timings["encode"] = time.perf_counter() - started_at
+
+    if DEBUG_MODE:
+        print(f"DEBUG screen_capture: {original_size[0]}x{original_size[1]} -> {new_size[0]}x{new_size[1]}, "
+              f"{mime_type}, {len(data)} bytes, " + ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in timings.items()), file=sys.stderr)
+    return {"data": data, "mime_type": mime_type, "width": new_size[0], "height": new_size[1], "bytes": len(data), "timings": timings}
+
+def start_capture(max_bytes=MAX_BYTES, image_format=IMAGE_FORMAT):
+    """Starts capture_screenshot() in a background thread and returns a Future for its result.
+
+    The thread is a daemon thread, so a capture that hangs never keeps the process alive.
+    """
+    future = Future()
+    future.started_at = time.monotonic()
+
+    def worker():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(capture_screenshot(max_bytes, image_format))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=worker, daemon=True).start()
+    return future
+
+def wait_for_capture(future, timeout=CAPTURE_TIMEOUT_SECONDS):
+    """Returns the screenshot from start_capture(), or None if it failed or took longer than
+    timeout seconds since it started (the request then goes out text-only)."""
+    remaining = max(0.0, future.started_at + timeout - time.monotonic())
+    try:
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        print(f"WARN screen_capture: Screenshot not ready after {timeout:.1f}s, continuing without it", file=sys.stderr)
+    except Exception as e:
+        print(f"WARN screen_capture: Screenshot failed: {e}", file=sys.stderr)
+    return None
+
+def to_data_url(screenshot):
+    """Returns the data: URL for a captured screenshot (the only base64 step)."""
+    return f"data:{screenshot['mime_type']};base64,{base64.b64encode(screenshot['data']).decode('utf-8')}"
+
+if __name__ == "__main__":
+    # Capture once and report the size and time of each stage (optionally saving the result)
+    shot = capture_screenshot()
+    print(f"{shot['width']}x{shot['height']} {shot['mime_type']} {shot['bytes']} bytes")
+    for stage, seconds in shot["timings"].items():
+        print(f"  {stage}: {seconds * 1000:.1f} ms")
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "wb") as f:
+            f.write(shot["data"])
+        print(f"Saved to {sys.argv[1]}")
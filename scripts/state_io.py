@@ -1,79 +1,211 @@
 import json
 import os
 import sys
+import time
+import secrets
+import threading
+import contextlib
 
 # Determine the Espanso config directory.
 # ESPANSO_CONFIG_DIR is an environment variable set by Espanso when running scripts.
 # Fallback to a common relative path if the env var isn't set (e.g., for direct testing, though less reliable).
 CONFIG_DIR = os.environ.get("ESPANSO_CONFIG_DIR", os.path.join(os.path.dirname(__file__), ".."))
-STATE_FILE_NAME = "gpt_tools/gpt_form_state.json"
+STATE_FILE_NAME = "gpt_tools/gpt_form_state.json" # Single global file used before per-session state; only garbage collected now
 STATE_FILE_PATH = os.path.join(CONFIG_DIR, STATE_FILE_NAME)
 
+# Each :gpt: run gets its own state file, gpt_tools/sessions/<session_id>.json, so two runs
+# fired close together never overwrite or delete each other's state. Writes go to a temp
+# file that is renamed into place (readers never see a half-written file), and every
+# read/write/delete holds an advisory lock on <session_id>.lock.
+# There is no "current session": every reader names the session it wants. The one place
+# an ID cannot be passed directly is the step 2 form, which step 1 opens through
+# `espanso match exec`. Step 1 leaves a handoff entry, gpt_tools/sessions/handoff/<session_id>,
+# and the :gpt_form_step2 match claims the oldest one with a script var (claim_session.py)
+# the moment the form opens, then passes that ID to handle_form_step2.py. Claiming removes
+# the entry, so each form gets exactly one session, however long it stays open.
+SESSIONS_DIR = os.path.join(CONFIG_DIR, "gpt_tools", "sessions")
+HANDOFF_DIR = os.path.join(SESSIONS_DIR, "handoff")
+STALE_SESSION_SECONDS = 24 * 3600 # Sessions untouched for this long are garbage collected
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+def new_session_id():
+    return f"{int(time.time() * 1000)}-{os.getpid()}-{secrets.token_hex(3)}"
+
+def session_path(session_id):
+    return os.path.join(SESSIONS_DIR, f"{session_id}.json")
+
+@contextlib.contextmanager
+def _session_lock(session_id):
+    """Holds the advisory lock of one session for the duration of the block."""
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    lock_file = open(os.path.join(SESSIONS_DIR, f"{session_id}.lock"), "a+")
+    try:
+        if os.name == "nt":
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError: # LK_LOCK gives up after ~10s; keep waiting
+                    continue
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        try:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def hand_off(session_id):
+    """Leaves a session for the step 2 form about to be opened (see claim_handoff)."""
+    os.makedirs(HANDOFF_DIR, exist_ok=True)
+    _write_atomic(os.path.join(HANDOFF_DIR, session_id), session_id)
+
+def claim_handoff():
+    """Takes the oldest session handed off to a step 2 form, or None. Each entry is claimed only once."""
+    try:
+        names = sorted(os.listdir(HANDOFF_DIR)) # Session IDs start with a millisecond timestamp
+    except OSError:
+        return None
+    for name in names:
+        if name.endswith(".tmp"):
+            continue
+        try:
+            os.remove(os.path.join(HANDOFF_DIR, name)) # Only one claimant can succeed
+        except OSError:
+            continue
+        return name
+    return None
+
+def latest_checkpoint_id():
+    """The most recently saved session, for resuming by hand (:gpt_final_processing) after a crash. None if there is none."""
+    try:
+        entries = [entry for entry in os.scandir(SESSIONS_DIR) if entry.name.endswith(".json")]
+    except OSError:
+        return None
+    if not entries:
+        return None
+    return max(entries, key=lambda entry: entry.stat().st_mtime).name[:-len(".json")]
+
 def save_state(data):
-    """Saves the given data dictionary to the state JSON file."""
+    """Saves the given data dictionary to its session's state file.
+
+    A new session ID is assigned (and stored in data["session_id"]) the first time.
+    """
+    session_id = data.setdefault("session_id", new_session_id())
     try:
-        with open(STATE_FILE_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4)
+        with _session_lock(session_id):
+            _write_atomic(session_path(session_id), json.dumps(data, indent=4))
         # For debugging when running via Espanso, print to stderr
-        # print(f"DEBUG state_io: Saved state to {STATE_FILE_PATH}: {data}", file=sys.stderr)
+        # print(f"DEBUG state_io: Saved state to {session_path(session_id)}: {data}", file=sys.stderr)
     except Exception as e:
-        print(f"ERROR state_io: Failed to save state to {STATE_FILE_PATH}: {e}", file=sys.stderr)
+        print(f"ERROR state_io: Failed to save state for session {session_id}: {e}", file=sys.stderr)
         # Potentially re-raise or handle more gracefully depending on desired script behavior
         raise
 
-def load_state():
-    """Loads data from the state JSON file. Returns an empty dict if not found or error."""
-    if not os.path.exists(STATE_FILE_PATH):
-        # print(f"DEBUG state_io: State file not found at {STATE_FILE_PATH}. Returning empty dict.", file=sys.stderr)
+def load_state(session_id):
+    """Loads a session's state. Returns an empty dict if not found or error."""
+    if not session_id:
+        print("ERROR state_io: load_state() needs a session ID.", file=sys.stderr)
+        return {}
+    path = session_path(session_id)
+    if not os.path.exists(path):
+        # print(f"DEBUG state_io: State file not found at {path}. Returning empty dict.", file=sys.stderr)
         return {}
     try:
-        with open(STATE_FILE_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            # print(f"DEBUG state_io: Loaded state from {STATE_FILE_PATH}: {data}", file=sys.stderr)
-            return data
+        with _session_lock(session_id):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        data.setdefault("session_id", session_id)
+        # print(f"DEBUG state_io: Loaded state from {path}: {data}", file=sys.stderr)
+        return data
     except Exception as e:
-        print(f"ERROR state_io: Failed to load state from {STATE_FILE_PATH}: {e}. Returning empty dict.", file=sys.stderr)
+        print(f"ERROR state_io: Failed to load state from {path}: {e}. Returning empty dict.", file=sys.stderr)
         return {}
 
-def delete_state():
-    """Deletes the state JSON file if it exists."""
+def delete_state(session_id):
+    """Deletes one session's state file; other sessions are left alone."""
+    if not session_id:
+        return
     try:
-        if os.path.exists(STATE_FILE_PATH):
-            os.remove(STATE_FILE_PATH)
-            # print(f"DEBUG state_io: Deleted state file {STATE_FILE_PATH}", file=sys.stderr)
+        with _session_lock(session_id):
+            if os.path.exists(session_path(session_id)):
+                os.remove(session_path(session_id))
+        try:
+            os.remove(os.path.join(SESSIONS_DIR, f"{session_id}.lock"))
+        except OSError:
+            pass # Held by another process (Windows); gc_stale_sessions() removes it later
+        # print(f"DEBUG state_io: Deleted state for session {session_id}", file=sys.stderr)
     except Exception as e:
-        print(f"ERROR state_io: Failed to delete state file {STATE_FILE_PATH}: {e}", file=sys.stderr)
+        print(f"ERROR state_io: Failed to delete state for session {session_id}: {e}", file=sys.stderr)
         # Potentially re-raise or handle
         raise
 
+def gc_stale_sessions(max_age_seconds=STALE_SESSION_SECONDS):
+    """Removes state, lock and temp files of sessions untouched for max_age_seconds. Returns how many files were removed."""
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    paths = []
+    for directory in (SESSIONS_DIR, HANDOFF_DIR): # Handoffs of step 2 forms that never opened
+        if os.path.isdir(directory):
+            paths.extend(os.path.join(directory, name) for name in os.listdir(directory))
+    paths.append(STATE_FILE_PATH)
+    for path in paths:
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass # Already gone, or a lock file still held open on Windows
+    return removed
+
 if __name__ == "__main__":
     # Example usage for direct testing
     print(f"Config directory determined as: {CONFIG_DIR}")
-    print(f"State file path: {STATE_FILE_PATH}")
+    print(f"Session state directory: {SESSIONS_DIR}")
 
     test_data_step1 = {"task_objective": "Test Task", "language": "English", "prompt": "Hello"}
     print(f"Attempting to save step 1: {test_data_step1}")
     save_state(test_data_step1)
+    test_session_id = test_data_step1["session_id"]
+    print(f"Assigned session ID: {test_session_id}")
 
-    loaded_data_step1 = load_state()
+    loaded_data_step1 = load_state(test_session_id)
     print(f"Loaded step 1: {loaded_data_step1}")
 
     test_data_step2 = {"sentiment": "positive"}
     # Simulate appending step 2 data
-    current_state = load_state()
+    current_state = load_state(test_session_id)
     current_state.update(test_data_step2)
     print(f"Attempting to save combined state: {current_state}")
     save_state(current_state)
     
-    loaded_data_combined = load_state()
+    loaded_data_combined = load_state(test_session_id)
     print(f"Loaded combined state: {loaded_data_combined}")
 
     print("Attempting to delete state file...")
-    delete_state()
+    delete_state(test_session_id)
     
-    remaining_state = load_state()
+    remaining_state = load_state(test_session_id)
     print(f"State after deletion (should be empty): {remaining_state}")
-    if not os.path.exists(STATE_FILE_PATH):
+    if not os.path.exists(session_path(test_session_id)):
         print("State file successfully deleted.")
     else:
         print("ERROR: State file still exists after deletion attempt.") 
\ No newline at end of file
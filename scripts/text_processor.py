@@ -1,98 +1,122 @@
 #!/usr/bin/env python3
+import metrics # First, so its clock starts as close to process start as possible
 import os
 import sys
 # import pyperclip # No longer needed for input text
 import io
-from openai import OpenAI
-from dotenv import load_dotenv
-import tkinter as tk
-import threading
+
+if __name__ == "__main__":
+    # Hand the run to the warm daemon when it is up (see gpt_daemon.py); otherwise run in-process below.
+    from daemon_client import delegate_to_daemon
+    if delegate_to_daemon("text_processor", sys.argv[1:]):
+        sys.exit(0)
+
+import re
 import time
-from action_reader import get_action  # Import our new action reader
+from action_reader import get_action, get_tone, get_tones_list  # Import our new action reader
+from response_cache import make_cache_key, get_cached_response, store_response
+from openai_client import (API_KEY, REQUEST_TIMEOUT_SECONDS, MAX_CONTINUATIONS, prewarm_client, create_completion,
+                           complete_with_continuation, continuation_messages, merge_usage, request_options,
+                           usage_to_dict, start_in_thread)
+from loading_popup import start_loading_popup, update_preview, stop_loading_popup
+from variant_chooser import choose_variant, slot_text
+from context_window import output_token_budget
+import prefetch
 
 DEBUG_MODE = False # Global debug flag
+MAX_VARIANTS = int(os.environ.get("ESPANSO_GPT_MAX_VARIANTS", 6)) # Variants mode: most requests in flight at once
+VARIANT_SAMPLE_TEMPERATURE = 0.9
 
-# Ensure stdout is UTF-8 encoded
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf8')
+if not API_KEY:
+    print("Error: OPENAI_API_KEY not found in .env file.", file=sys.stderr)
+    sys.exit(1)
 
-# --- Loading Popup Configuration ---
-loading_popup_obj = {'root': None, 'label': None, 'running': False, 'char_index': 0}
-spinner_chars = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"] # Unicode Braille spinner
+def strip_wrapping_quotes(content: str) -> str:
+    """Removes leading/trailing quotes the model sometimes wraps its answer in."""
+    content = content.strip()
+    if len(content) >= 2 and content.startswith('"') and content.endswith('"'):
+        content = content[1:-1]
+    return content
 
-def _spinner_update():
-    if not loading_popup_obj.get('running') or not loading_popup_obj.get('label'):
-        return
-    char = spinner_chars[loading_popup_obj['char_index']]
-    try:
-        if loading_popup_obj['label']: # Check if label still exists
-             loading_popup_obj['label'].config(text=f"Processing {char}")
-    except tk.TclError: # Handle cases where the widget might be destroyed prematurely
-        loading_popup_obj['running'] = False 
-        return
+def stream_completion(model: str, messages: list, max_tokens: int, temperature: float, on_delta=None, options=None):
+    """Requests a streamed completion and returns (full text, usage, finish_reason), reporting partial text to on_delta as it arrives."""
+    started_at = time.time()
+    run_metrics = metrics.current_run()
+    stream = create_completion(
+        model,
+        messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
+        **(options or {})
+    )
+    parts = []
+    usage = None
+    finish_reason = None
+    for chunk in stream:
+        # With include_usage the last chunk carries the token counts and no choices
+        if getattr(chunk, "usage", None):
+            usage = usage_to_dict(chunk.usage)
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not parts:
+            run_metrics.add_span("ttft", time.time() - started_at)
+            if DEBUG_MODE:
+                print(f"DEBUG text_processor: First streamed token after {time.time() - started_at:.2f}s", file=sys.stderr)
+        parts.append(delta)
+        if on_delta:
+            on_delta("".join(parts))
+    return "".join(parts), usage, finish_reason
 
-    loading_popup_obj['char_index'] = (loading_popup_obj['char_index'] + 1) % len(spinner_chars)
-    
-    if loading_popup_obj.get('root') and loading_popup_obj.get('running'):
-        try:
-            loading_popup_obj['root'].after(120, _spinner_update) # Schedule next update
-        except tk.TclError: # Handle cases where the root window might be destroyed
-             loading_popup_obj['running'] = False
+def stream_with_continuation(model: str, messages: list, max_tokens: int, continue_max_tokens: int, temperature: float,
+                             on_delta=None, options=None):
+    """stream_completion() that continues a reply truncated by max_tokens (see openai_client.complete_with_continuation).
 
-def show_loading_popup_in_thread():
-    try:
-        root = tk.Tk()
-        loading_popup_obj['root'] = root
-        root.title("Processing")
-        root.geometry("220x70") # Adjusted size
-        root.resizable(False, False)
-        root.attributes('-topmost', True)
-        root.overrideredirect(True) # No window decorations
-
-        # Center the window
-        screen_width = root.winfo_screenwidth()
-        screen_height = root.winfo_screenheight()
-        x = (screen_width // 2) - (220 // 2)
-        y = (screen_height // 2) - (70 // 2)
-        root.geometry(f"+{x}+{y}")
-
-        # Use a frame for better padding and background
-        frame = tk.Frame(root, background='#f0f0f0', padx=10, pady=10) # Light grey background
-        frame.pack(expand=True, fill=tk.BOTH)
-
-        label = tk.Label(frame, text="Processing...", font=("Arial", 11), background='#f0f0f0')
-        label.pack(pady=10, expand=True) # Centered with padding
-        loading_popup_obj['label'] = label
-        loading_popup_obj['running'] = True
-        loading_popup_obj['char_index'] = 0 # Reset char index
-
-        _spinner_update() # Start the animation
-        root.mainloop()
-    except Exception as e:
-        print(f"Error in loading popup thread: {e}", file=sys.stderr)
-    finally:
-        # Clean up when mainloop ends (either by destroy or error)
-        loading_popup_obj['root'] = None
-        loading_popup_obj['label'] = None
-        loading_popup_obj['running'] = False
-# --- End Loading Popup Configuration ---
-
-# Load API key from .env file in the same directory as the script
-load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
-API_KEY = os.getenv("OPENAI_API_KEY")
+    on_delta keeps receiving the whole text so far, continuations included.
+    """
+    content, usage, finish_reason = stream_completion(model, messages, max_tokens, temperature, on_delta=on_delta, options=options)
+    continuations = 0
+    while finish_reason == "length" and continuations < MAX_CONTINUATIONS:
+        continuations += 1
+        shown = content
+        more, more_usage, finish_reason = stream_completion(
+            model, continuation_messages(messages, content), continue_max_tokens, temperature,
+            on_delta=on_delta and (lambda text: on_delta(shown + text)), options=options)
+        content += more
+        usage = merge_usage(usage, more_usage)
+    metrics.current_run().set(continuations=continuations, **({"truncated": True} if finish_reason == "length" else {}))
+    return content, usage
 
-if not API_KEY:
-    print("Error: OPENAI_API_KEY not found in .env file.", file=sys.stderr)
-    sys.exit(1)
+def get_modified_text(action_name: str, tone_filename_base: str, input_text: str, target_language: str, custom_instructions: str, on_delta=None,
+                      claim_prefetch=False) -> str:
+    return process_text(action_name, tone_filename_base, input_text, target_language, custom_instructions, on_delta=on_delta,
+                        claim_prefetch=claim_prefetch)["text"]
 
-# Initialize OpenAI client
-client = OpenAI(api_key=API_KEY)
+def process_text(action_name: str, tone_filename_base: str, input_text: str, target_language: str, custom_instructions: str,
+                 on_delta=None, stream=None, n=1, prefetching=False, claim_prefetch=False) -> dict:
+    """Runs one transformation and returns {"text", "error", "usage", "cached"}.
 
-def get_modified_text(action_name: str, tone_filename_base: str, input_text: str, target_language: str, custom_instructions: str) -> str:
+    error is True when text holds an error message instead of a result. stream
+    overrides the action's "stream" setting when not None. With n > 1 the model is
+    asked for n samples in one (non-streamed, uncached) request, returned as "texts".
+    With claim_prefetch (the :rephrase: form's submission, see run()), a result
+    prefetched for the same rendered request is used instead of a new call and every
+    other prefetch is cancelled (see prefetch.py); other callers (batches, variants)
+    leave the pending prefetch alone. prefetching=True is the prefetch itself, which
+    publishes its result.
+    """
     if DEBUG_MODE:
         print(f"DEBUG text_processor: Received action_name: {action_name}, tone_filename_base: {tone_filename_base}, custom_instructions: {custom_instructions}", file=sys.stderr)
     
+    run_metrics = metrics.current_run()
     # Get the action configuration from JSON
-    action_config = get_action(action_name)
+    with run_metrics.span("config_load"):
+        action_config = get_action(action_name)
     if DEBUG_MODE:
         print(f"DEBUG text_processor: Loaded action config: {action_config}", file=sys.stderr)
     
@@ -105,32 +129,28 @@ def get_modified_text(action_name: str, tone_filename_base: str, input_text: str
             target_language=target_language
         )
     
-    # Get tone instruction from file
-    tone_instruction = ""
-    tone_file_path = os.path.join(os.path.dirname(__file__), "..", "gpt_tools", "tone", f"{tone_filename_base}.txt")
-    if DEBUG_MODE:
-        print(f"DEBUG text_processor: Constructed tone_file_path: {tone_file_path}", file=sys.stderr)
-
+    # Get tone instruction from the config registry (gpt_tools/tone/*.txt)
     try:
-        with open(tone_file_path, "r", encoding="utf-8") as f:
-            tone_instruction = f.read().strip()
-        if not tone_instruction:
+        with run_metrics.span("tone_read"):
+            tone_instruction = get_tone(tone_filename_base)
+        if tone_instruction is None:
+            tone_instruction = f"(Tone file '{tone_filename_base}.txt' not found. Using neutral tone.) Please adopt a neutral tone."
+            if DEBUG_MODE:
+                print(f"DEBUG text_processor: Tone '{tone_filename_base}' not found in registry", file=sys.stderr)
+        elif not tone_instruction:
             tone_instruction = "Please adopt a neutral tone." # Fallback if file is empty
             if DEBUG_MODE:
                 print(f"DEBUG text_processor: Tone file was empty, using fallback.", file=sys.stderr)
-    except FileNotFoundError:
-        tone_instruction = f"(Tone file '{tone_filename_base}.txt' not found. Using neutral tone.) Please adopt a neutral tone."
-        if DEBUG_MODE:
-            print(f"DEBUG text_processor: Tone file not found at {tone_file_path}", file=sys.stderr)
     except Exception as e:
         tone_instruction = f"(Error reading tone file '{tone_filename_base}.txt': {e}. Using neutral tone.) Please adopt a neutral tone."
         if DEBUG_MODE:
-            print(f"DEBUG text_processor: Error reading tone file {tone_file_path}: {e}", file=sys.stderr)
+            print(f"DEBUG text_processor: Error reading tone '{tone_filename_base}': {e}", file=sys.stderr)
     
     if DEBUG_MODE:
         print(f"DEBUG text_processor: Final tone_instruction: {tone_instruction}", file=sys.stderr)
 
     # Build the prompt using the template from the action config
+    prompt_started_at = time.time()
     try:
         user_prompt = action_config["prompt_template"].format(
             tone_instruction=tone_instruction,
@@ -140,14 +160,15 @@ def get_modified_text(action_name: str, tone_filename_base: str, input_text: str
         if custom_instructions and custom_instructions.strip():
             user_prompt += f"\\n\\nCustom Instructions:\\n{custom_instructions}"
     except KeyError as e:
-        return f"Error: Missing field in action config: {e}"
+        return {"text": f"Error: Missing field in action config: {e}", "error": True, "usage": None, "cached": False}
     except Exception as e:
-        return f"Error formatting prompt template: {e}"
+        return {"text": f"Error formatting prompt template: {e}", "error": True, "usage": None, "cached": False}
 
     messages = [
         {"role": "system", "content": system_message_content},
         {"role": "user", "content": user_prompt}
     ]
+    run_metrics.add_span("prompt_render", time.time() - prompt_started_at)
 
     if DEBUG_MODE:
         print(f"DEBUG text_processor: Full user_prompt for AI: {user_prompt}", file=sys.stderr)
@@ -155,69 +176,209 @@ def get_modified_text(action_name: str, tone_filename_base: str, input_text: str
 
     # Get model parameters from action config
     model = action_config.get("model", "gpt-4o-mini")
-    max_tokens = action_config.get("max_tokens", 2000)
+    # Sized from the input when the action has a "max_tokens_policy"; "max_tokens" is then the cap
+    max_tokens = output_token_budget(action_config, input_text)
     temperature = action_config.get("temperature", 0.6)
+    if stream is None:
+        stream = action_config.get("stream", False) or os.environ.get("ESPANSO_GPT_STREAM") == "1"
+    if n > 1:
+        stream = False
+        temperature = max(temperature, VARIANT_SAMPLE_TEMPERATURE) # Samples at a low temperature are near-duplicates
+    run_metrics.set(model=model, stream=bool(stream), max_tokens=max_tokens)
+
+    # Deterministic actions (e.g. Fix grammar, Translate) can opt in to the on-disk response cache
+    request_key = make_cache_key(messages, model, temperature, max_tokens)
+    cache_key = None
+    if action_config.get("cache", False) and n == 1:
+        with run_metrics.span("cache_lookup"):
+            cache_key = request_key
+            cached_content = get_cached_response(cache_key, action_config.get("cache_ttl_seconds"))
+        run_metrics.set(cached=cached_content is not None)
+        if cached_content is not None:
+            if DEBUG_MODE:
+                print(f"DEBUG text_processor: Cache hit for {cache_key}", file=sys.stderr)
+            return {"text": cached_content, "error": False, "usage": None, "cached": True}
+
+    if prefetching:
+        if not prefetch.begin(request_key, action_config.get("timeout_seconds") or REQUEST_TIMEOUT_SECONDS):
+            return {"text": "Error: Already prefetched", "error": True, "usage": None, "cached": False}
+    elif claim_prefetch and prefetch.ENABLED and n == 1:
+        with run_metrics.span("prefetch_wait"):
+            prefetched = prefetch.claim(request_key)
+        run_metrics.set(prefetched=prefetched is not None)
+        if prefetched is not None:
+            if DEBUG_MODE:
+                print(f"DEBUG text_processor: Using the prefetched result for {request_key}", file=sys.stderr)
+            return prefetched
 
+    api_started_at = time.time()
+    # What a prefetch publishes if the request dies past the except below (KeyboardInterrupt, SystemExit):
+    # a "running" entry left behind would hold the form's claim until its deadline
+    result = {"text": "Error: Request interrupted", "error": True, "usage": None, "cached": False}
     try:
-        completion = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-        content = completion.choices[0].message.content.strip()
+        # A reply cut off by max_tokens is continued with the action's full "max_tokens"
+        continue_max_tokens = action_config.get("max_tokens", 2000)
+        if stream:
+            content, usage = stream_with_continuation(model, messages, max_tokens, continue_max_tokens, temperature,
+                                                      on_delta=on_delta, options=request_options(action_config))
+        elif n == 1:
+            # Deadline, retries, optional hedging and the action's fallback_model (see openai_client.py)
+            content, usage = complete_with_continuation(model, messages, max_tokens=max_tokens,
+                                                        continue_max_tokens=continue_max_tokens, temperature=temperature,
+                                                        **request_options(action_config))
+        else:
+            # Samples are not continued: one cut short is just a weaker variant to pick from
+            completion = create_completion(
+                model,
+                messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=n,
+                **request_options(action_config)
+            )
+            content = completion.choices[0].message.content
+            usage = usage_to_dict(completion.usage)
+        run_metrics.add_span("api", time.time() - api_started_at)
+        run_metrics.add_usage(usage)
         # Remove leading/trailing quotes if present
-        if len(content) >= 2 and content.startswith('"') and content.endswith('"'):
-            content = content[1:-1]
-        return content
+        content = strip_wrapping_quotes(content)
+        if cache_key:
+            store_response(cache_key, content, model=model)
+        result = {"text": content, "error": False, "usage": usage, "cached": False}
+        if n > 1:
+            result["texts"] = [strip_wrapping_quotes(choice.message.content or "") for choice in completion.choices]
     except Exception as e:
-        return f"OpenAI API Error: {e}"
+        run_metrics.add_span("api", time.time() - api_started_at)
+        run_metrics.set(ok=False, error=type(e).__name__)
+        result = {"text": f"OpenAI API Error: {e}", "error": True, "usage": None, "cached": False}
+    finally:
+        if prefetching:
+            prefetch.publish(request_key, result) # Errors too, so a waiting claim stops waiting
+    return result
 
-if __name__ == "__main__":
-    # Start loading popup
-    loading_thread = threading.Thread(target=show_loading_popup_in_thread, daemon=True)
-    loading_thread.start()
-    # Brief pause to allow the Tkinter window to initialize and appear.
-    # Adjust if the window doesn't appear reliably before the API call starts.
-    time.sleep(0.3) 
+def parse_variants(spec: str, tone: str):
+    """Reads the form's variants choice: "Each tone", "<n> samples" or comma-separated tone names.
+
+    Returns a list of (label, tone, sample_count) requests, at most MAX_VARIANTS variants in all.
+    """
+    spec = spec.strip()
+    samples = re.match(r"^(\d+)(\s+samples?)?$", spec, re.IGNORECASE)
+    if samples:
+        count = max(1, min(int(samples.group(1)), MAX_VARIANTS))
+        return [(tone, tone, count)]
+    if spec.lower() in ("each tone", "all tones"):
+        tones = get_tones_list()
+    else:
+        tones = [name.strip() for name in spec.split(",") if name.strip()]
+    return [(name, name, 1) for name in tones[:MAX_VARIANTS]]
+
+def start_variants(action_name: str, tone: str, input_text: str, target_language: str, custom_instructions: str, spec: str) -> list:
+    """Starts every variant request at once and returns the chooser slots: [{"label", "future", "choice"}].
+
+    One request per tone, all in flight concurrently; "<n> samples" is a single request
+    for n completions (see variant_chooser.slot_text).
+    """
+    slots = []
+    for label, variant_tone, count in parse_variants(spec, tone):
+        future = start_in_thread(lambda variant_tone=variant_tone, count=count: process_text(
+            action_name, variant_tone, input_text, target_language, custom_instructions, stream=False, n=count))
+        if count == 1:
+            slots.append({"label": label, "future": future, "choice": 0})
+        else:
+            slots.extend({"label": f"{label} #{index + 1}", "future": future, "choice": index} for index in range(count))
+    return slots
+
+def run_variants(args, choose=None):
+    """Runs the variants mode (text_processor.py with a 6th argument) and returns the picked text for Espanso.
+
+    choose(slots) shows the variants as they arrive and returns the picked slot index or
+    None (variant_chooser.choose_variant by default).
+    """
+    action_arg, tone_arg, original_text_arg, target_language_arg, custom_instructions_arg, spec = args
+    run_metrics = metrics.start_run("variants", action_arg)
+    prewarm_client() # Import openai in the background while the prompts are built
+    prefetch.cancel_all() # Submitted in variants mode: the form's prefetch (a single answer) is of no use
+    if not original_text_arg.strip():
+        print("Input text is empty. Please provide some text in the form.", file=sys.stderr)
+        run_metrics.finish()
+        return ""
+    choose = choose or choose_variant
+
+    started_at = time.time()
+    slots = start_variants(action_arg, tone_arg, original_text_arg, target_language_arg, custom_instructions_arg, spec)
+    futures = list({id(slot["future"]): slot["future"] for slot in slots}.values())
+    finished_after = [] # Seconds from start to each request's answer (appended from the worker threads)
+    for future in futures:
+        future.add_done_callback(lambda future: finished_after.append(time.time() - started_at))
+    run_metrics.set(variants=len(slots), model=get_action(action_arg).get("model", "gpt-4o-mini"))
+    chosen_text = ""
+    try:
+        with run_metrics.span("choose"):
+            chosen = choose(slots) if slots else None
+        if chosen is not None:
+            chosen_text, error = slot_text(slots[chosen])
+            run_metrics.set(chosen=chosen, ok=not error)
+    except Exception as e:
+        run_metrics.set(ok=False, error=type(e).__name__)
+        print(f"Error in variants mode: {e}", file=sys.stderr)
+    finally:
+        # Requests still running (the user picked before they finished) are not waited for
+        if finished_after:
+            run_metrics.add_span("first_variant", min(finished_after))
+            run_metrics.add_span("api", max(finished_after)) # Wall time until the last answer so far
+        for future in futures:
+            if future.done() and future.exception() is None:
+                run_metrics.add_usage(future.result()["usage"])
+        run_metrics.set(variants_finished=len(finished_after))
+        run_metrics.finish()
+    return chosen_text
+
+def run(args):
+    """Runs one text transformation for the form arguments and returns the text for Espanso."""
+    if len(args) == 6 and args[5].strip():
+        return run_variants(args)
+    run_metrics = metrics.start_run("action", args[0] if args else None)
+    prewarm_client() # Import openai in the background while the prompt is built
+    # Only becomes visible if the request is still running after ESPANSO_GPT_SPINNER_DELAY (see loading_popup.py)
+    popup = start_loading_popup()
 
     modified_text_result = ""
     try:
-        if len(sys.argv) != 6: # Updated to 6 arguments
+        if len(args) != 5:
             print("Usage: python text_processor.py <action> <tone> \"<input_text>\" <target_language> \"[custom_instructions]\"", file=sys.stderr)
             modified_text_result = "Error: Incorrect number of arguments."
             # sys.exit(1) # Don't exit, let finally close the popup, then print error
         else:
-            action_arg = sys.argv[1]
-            tone_arg = sys.argv[2]
-            original_text_arg = sys.argv[3]
-            target_language_arg = sys.argv[4]
-            custom_instructions_arg = sys.argv[5] # New argument
+            action_arg = args[0]
+            tone_arg = args[1]
+            original_text_arg = args[2]
+            target_language_arg = args[3]
+            custom_instructions_arg = args[4] # New argument
 
             if not original_text_arg.strip():
                 print("Input text is empty. Please provide some text in the form.", file=sys.stderr)
                 modified_text_result = "" # Espanso will just remove the trigger if output is empty
             else:
                 # Make the API call
-                modified_text_result = get_modified_text(action_arg, tone_arg, original_text_arg, target_language_arg, custom_instructions_arg)
+                modified_text_result = get_modified_text(action_arg, tone_arg, original_text_arg, target_language_arg, custom_instructions_arg,
+                                                         on_delta=lambda partial_text: update_preview(popup, partial_text),
+                                                         claim_prefetch=True)
     
     except Exception as e_main:
         modified_text_result = f"Script Error: {e_main}"
+        run_metrics.set(ok=False, error=type(e_main).__name__)
         print(f"Error in main script execution: {e_main}", file=sys.stderr)
     
     finally:
-        # Stop and close the loading window
-        if loading_popup_obj.get('root'):
-            loading_popup_obj['running'] = False # Signal spinner to stop
-            try:
-                # Schedule destroy from Tkinter thread to avoid cross-thread issues
-                loading_popup_obj['root'].after(0, loading_popup_obj['root'].destroy)
-            except tk.TclError:
-                pass # Window might already be destroyed or in process
-        
-        # Ensure the thread has a moment to process the destroy command and terminate.
-        # If the popup sometimes lingers, increasing this timeout or ensuring the thread fully exits might be needed.
-        if loading_thread.is_alive():
-            loading_thread.join(timeout=0.5) 
-
-    print(modified_text_result) 
\ No newline at end of file
+        # Closes the spinner (or cancels it before it ever shows) without waiting for it
+        with run_metrics.span("output"):
+            run_metrics.set(spinner_shown=stop_loading_popup(popup))
+        run_metrics.finish()
+
+    return modified_text_result
+
+if __name__ == "__main__":
+    # Ensure stdout is UTF-8 encoded
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf8')
+    metrics.mark_imports_done()
+    print(run(sys.argv[1:])) 
\ No newline at end of file
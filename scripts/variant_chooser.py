@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import sys
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# The pick-one window of the variants mode (text_processor.py with a variants choice).
+# It opens as soon as the requests are sent, with one card per variant that fills in as
+# its answer arrives, so the first variant can be read (and picked) while the others are
+# still running. Pick with a card's button or its number key; Escape cancels.
+# Without a display it falls back to the first variant that succeeds.
+POLL_MS = 100
+WINDOW_WIDTH = 700
+CARD_HEIGHT = 170
+MAX_WINDOW_HEIGHT = 720
+
+def slot_text(slot):
+    """Returns (text, error) of a finished slot ({"label", "future", "choice"}; the future yields a process_text() result)."""
+    try:
+        result = slot["future"].result()
+    except Exception as e:
+        return f"Error: {e}", True
+    texts = result.get("texts") or [result["text"]]
+    return (texts[slot["choice"]] if slot["choice"] < len(texts) else ""), result["error"]
+
+def choose_variant(slots):
+    """Shows the variants of slots ([{"label", "future", "choice"}], see text_processor.start_variants) and returns the picked index or None."""
+    try:
+        import customtkinter
+        root = customtkinter.CTk()
+    except Exception as e: # No display (or no customtkinter): no choice to offer
+        print(f"variant_chooser: cannot open the chooser ({e}); using the first variant that succeeds", file=sys.stderr)
+        return first_successful(slots)
+
+    picked = {"index": None, "poll": None}
+    root.title("Pick a variant")
+    root.attributes("-topmost", True)
+    height = min(MAX_WINDOW_HEIGHT, 90 + CARD_HEIGHT * len(slots))
+    x = (root.winfo_screenwidth() // 2) - (WINDOW_WIDTH // 2)
+    y = (root.winfo_screenheight() // 2) - (height // 2)
+    root.geometry(f"{WINDOW_WIDTH}x{height}+{x}+{y}")
+
+    def pick(index):
+        picked["index"] = index
+        if picked["poll"]:
+            root.after_cancel(picked["poll"])
+        root.destroy()
+
+    status = customtkinter.CTkLabel(root, text=f"0 of {len(slots)} ready")
+    status.pack(padx=20, pady=(12, 4))
+    cards_frame = customtkinter.CTkScrollableFrame(root)
+    cards_frame.pack(padx=10, pady=(0, 10), fill="both", expand=True)
+    cards = []
+    for index, slot in enumerate(slots):
+        card = customtkinter.CTkFrame(cards_frame)
+        card.pack(pady=5, padx=5, fill="x")
+        customtkinter.CTkLabel(card, text=f"{index + 1}. {slot['label']}", anchor="w").pack(padx=10, pady=(6, 0), fill="x")
+        textbox = customtkinter.CTkTextbox(card, height=CARD_HEIGHT - 70, wrap="word")
+        textbox.insert("1.0", "Waiting for the answer...")
+        textbox.configure(state="disabled")
+        textbox.pack(padx=10, pady=4, fill="x")
+        button = customtkinter.CTkButton(card, text="Use this", state="disabled", command=lambda index=index: pick(index))
+        button.pack(padx=10, pady=(0, 8), anchor="e")
+        cards.append({"textbox": textbox, "button": button, "shown": False, "usable": False})
+        if index < 9:
+            root.bind(str(index + 1), lambda event, index=index: pick(index) if cards[index]["usable"] else None)
+    root.bind("<Escape>", lambda event: pick(None))
+    root.protocol("WM_DELETE_WINDOW", lambda: pick(None))
+
+    def poll():
+        for slot, card in zip(slots, cards):
+            if card["shown"] or not slot["future"].done():
+                continue
+            text, error = slot_text(slot)
+            card["textbox"].configure(state="normal")
+            card["textbox"].delete("1.0", "end")
+            card["textbox"].insert("1.0", text)
+            card["textbox"].configure(state="disabled")
+            card["shown"], card["usable"] = True, not error
+            if not error:
+                card["button"].configure(state="normal")
+        status.configure(text=f"{sum(card['shown'] for card in cards)} of {len(slots)} ready")
+        picked["poll"] = root.after(POLL_MS, poll)
+
+    poll()
+    root.focus_force()
+    root.mainloop()
+    return picked["index"]
+
+def first_successful(slots):
+    """Waits for the variants in arrival order and returns the index of the first one without an error (or None)."""
+    pending = {slot["future"] for slot in slots} # Each request has its own deadline (openai_client.py)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for index, slot in enumerate(slots):
+            if slot["future"] in done and not slot_text(slot)[1]:
+                return index
+    return None